@@ -0,0 +1,72 @@
+import contextlib
+import contextvars
+
+
+class Account:
+  '''An AWS account whose budgets are reconciled
+
+  Budgets are made with the account's end user role name and notification
+  topic, and managed through the Budgets API with the credentials of
+  role_arn, or the lambda's own credentials when it is None. Each account
+  has its own rate limiter, as the Budgets API limits the rate of calls per
+  account.
+  '''
+
+  def __init__(self, account_id, end_user_role_name, notification_topic_arn,
+      role_arn, rate_limiter):
+    self.account_id = account_id
+    self.end_user_role_name = end_user_role_name
+    self.notification_topic_arn = notification_topic_arn
+    self.role_arn = role_arn
+    self.rate_limiter = rate_limiter
+
+
+  def __str__(self):
+    return self.account_id
+
+
+# the account the current thread is reconciling, or None for the lambda's own
+_current = contextvars.ContextVar('account', default=None)
+
+
+def get_current():
+  '''Returns the account being reconciled, or None if it is not set'''
+  return _current.get()
+
+
+def set_current(account):
+  '''Sets the account being reconciled
+
+  Returns a token that reset() takes to set the account back.
+  '''
+  return _current.set(account)
+
+
+def reset(token):
+  '''Sets the account being reconciled back to what it was before set_current'''
+  _current.reset(token)
+
+
+@contextlib.contextmanager
+def use(account):
+  '''Sets the account being reconciled within a with block'''
+  token = set_current(account)
+  try:
+    yield account
+  finally:
+    reset(token)
+
+
+def bind(func):
+  '''Returns func wrapped to run with the account being reconciled now
+
+  Context variables do not carry over to the threads of an executor, so a
+  function submitted to one is wrapped first.
+  '''
+  account = _current.get()
+
+  def call(*args, **kwargs):
+    with use(account):
+      return func(*args, **kwargs)
+
+  return call
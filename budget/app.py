@@ -1,49 +1,343 @@
+import itertools
 import json
 import logging
+import os
+import threading
+import time
 import traceback
-import synapseclient
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 from botocore.exceptions import ClientError
-from budget.config import Config
+from budget import accounts, clients
+from budget.accounts import Account
+from budget.batch import BatchResult, RunResult, run_batch
+from budget.clients import get_client
+from budget.config import (
+  Config,
+  DEFAULT_BUDGETS_MAX_TPS,
+  DEFAULT_BUDGETS_MAX_WORKERS,
+  DEFAULT_LOG_LEVEL,
+  DEFAULT_SYNAPSE_MAX_WORKERS,
+  DEFAULT_TEAM_SNAPSHOT_MAX_AGE,
+  REPORT_FORMATS
+)
+from budget.fingerprints import (
+  FINGERPRINT_INDEX_KEY,
+  FINGERPRINT_TAG_KEY,
+  RECONCILED_STATE_KEY,
+  FingerprintIndex,
+  get_budget_fingerprint,
+  get_state_digest
+)
+from budget.deadline import Deadline
+from budget.logs import SAMPLE_SIZE, Lazy, summarize, to_json, warn_on_change
+from budget.metrics import MetricsLogger
+from budget.report import get_spend_record, write_spend_report
+from budget.shards import (
+  LambdaInvoker,
+  LocalInvoker,
+  get_shard,
+  invoke_shards,
+  split_users
+)
+from budget.state import FileStore
+from budget.templates import BudgetTemplate
+from budget.throttle import AdaptiveRateLimiter, call_with_backoff
+from budget.timing import PhaseTimer
 
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-
-synapseclient.core.cache.CACHE_ROOT_DIR = '/tmp/.synapseCache'
+# set from LOG_LEVEL once the configuration is loaded
+log.setLevel(DEFAULT_LOG_LEVEL)
 
 BUDGET_NAME_PREFIX = 'service-catalog_'
 
+TEAM_SNAPSHOT_KEY_PREFIX = 'team-members-'
+
+# the budget changes a run was out of time for, resumed by the next run
+CHECKPOINT_KEY = 'checkpoint'
+
+# the largest page size the describe_budgets API accepts
+DESCRIBE_BUDGETS_PAGE_SIZE = 1000
+
+# the number of fingerprint tags read between saves of the fingerprint index
+FINGERPRINT_LOOKUP_BATCH_SIZE = 50
+
+# the number of budget changes the async engine queues ahead of its workers
+MUTATION_QUEUE_SIZE = 100
+
+# the lowest Budgets API rate, in calls per second, given to each shard
+MIN_SHARD_MAX_TPS = 1.0
+
+# the counts a coordinator sums over its workers, by what the workers did
+WORKER_COUNTS = {
+  'report': ['budgets'],
+  'plan': ['create', 'update', 'delete'],
+  'run': ['created', 'updated', 'removed', 'failed', 'deferred']
+}
+
+# event keys of targeted runs, which reconcile one user or one team
+TARGETED_EVENT_KEYS = ['reconcile_user', 'reconcile_team', 'remove_user']
+
+# the state store key of the last duplicate team memberships warning
+DUPLICATES_WARNING_KEY = 'duplicate-memberships'
+
 configuration = None
 
+# shared by every thread that calls the AWS Budgets API, and kept between
+# warm invocations so that the rate learned by one run carries over to the next
+budgets_rate_limiter = AdaptiveRateLimiter(DEFAULT_BUDGETS_MAX_TPS)
+
+# the rate limiters of the other accounts in ACCOUNTS, by account id, kept
+# between warm invocations like budgets_rate_limiter
+_account_rate_limiters = {}
+_account_rate_limiters_lock = threading.Lock()
+
+# budget templates by account id and team, for the configuration they were
+# made from
+_budget_templates = {}
+_budget_templates_version = None
+_budget_templates_lock = threading.Lock()
+
+def get_account(account_id):
+  '''Returns the account of ACCOUNTS with the given account id
+
+  The lambda's own account uses budgets_rate_limiter, and every other
+  account a rate limiter of its own.
+  '''
+  for settings in configuration.accounts:
+    if settings['account_id'] == account_id:
+      break
+  else:
+    raise ValueError(f'Account {account_id} is not in ACCOUNTS')
+  if account_id == configuration.account_id:
+    rate_limiter = budgets_rate_limiter
+  else:
+    with _account_rate_limiters_lock:
+      rate_limiter = _account_rate_limiters.get(account_id)
+      if rate_limiter is None:
+        rate_limiter = AdaptiveRateLimiter(configuration.budgets_max_tps)
+        _account_rate_limiters[account_id] = rate_limiter
+  rate_limiter.set_max_rate(configuration.budgets_max_tps)
+  return Account(
+    account_id,
+    settings['end_user_role_name'],
+    settings['notification_topic_arn'],
+    settings['role_arn'],
+    rate_limiter
+  )
+
+
+def get_current_account():
+  '''Returns the account whose budgets are being reconciled
+
+  That is the account an account worker was started for, or else the
+  lambda's own account.
+  '''
+  account = accounts.get_current()
+  if account is None:
+    account = Account(
+      configuration.account_id,
+      configuration.end_user_role_name,
+      configuration.notification_topic_arn,
+      None,
+      budgets_rate_limiter
+    )
+  return account
+
+
 def _get_budget_name(synapse_id):
   return f'{BUDGET_NAME_PREFIX}{synapse_id}'
 
 
-def get_client(service):
-  return boto3.client(service)
+def _get_budget_arn(budget_name):
+  account_id = get_current_account().account_id
+  return f'arn:aws:budgets::{account_id}:budget/{budget_name}'
+
+
+def _call_budgets(operation, **kwargs):
+  '''Calls an AWS Budgets API operation under the rate limit of the account'''
+  account = get_current_account()
+  budgets_client = get_client('budgets', account.role_arn)
+  return call_with_backoff(
+    account.rate_limiter,
+    getattr(budgets_client, operation),
+    **kwargs
+    )
 
 
-def get_users(teams):
+def _describe_all(operation, result_key, **kwargs):
+  '''Calls a paginated AWS Budgets describe operation until the last page'''
+  results = []
+  while True:
+    response = _call_budgets(operation, **kwargs)
+    results.extend(response.get(result_key, []))
+    if not response.get('NextToken'):
+      return results
+    kwargs['NextToken'] = response['NextToken']
+
+
+def get_state_store():
+  '''Returns the store that keeps state between invocations'''
+  return FileStore(configuration.state_dir)
+
+
+def _get_team_member_ids(syn, team_id):
+  '''Get the ids of the non-admin members of a synapse team'''
+  return [
+    result['member']['ownerId']
+    for result in syn.getTeamMembers(team_id) if not result['isAdmin']
+  ]
+
+
+def _get_team_member_count(syn, team_id):
+  '''Get the number of members of a synapse team, including admins'''
+  return syn.restGET(f'/teamMembers/count/{team_id}')['count']
+
+
+def _is_team_member(syn, team_id, synapse_id):
+  '''Whether a synapse user is a non-admin member of a synapse team'''
+  try:
+    member = syn.restGET(f'/team/{team_id}/member/{synapse_id}')
+  except Exception as e:
+    # Synapse answers 404 Not Found for users outside the team
+    response = getattr(e, 'response', None)
+    if response is not None and response.status_code == 404:
+      return False
+    raise
+  return not member['isAdmin']
+
+
+def get_user_teams(synapse_id, teams, max_workers=DEFAULT_SYNAPSE_MAX_WORKERS):
+  '''Get the teams, among the given teams, that a synapse user is a member of
+
+  Membership of each team is checked concurrently, and the teams are
+  returned in the order they were given.
+  '''
+  teams = list(teams)
+  if not teams:
+    return []
+
+  def is_member(team_id):
+    return clients.call_synapse(
+      lambda syn: _is_team_member(syn, team_id, synapse_id)
+    )
+
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(teams))) as executor:
+    return [
+      team_id
+      for (team_id, member) in zip(teams, executor.map(is_member, teams))
+      if member
+    ]
+
+
+def _get_team_member_ids_incremental(syn, team_id, store, max_age):
+  '''Get the ids of the non-admin members of a synapse team
+
+  The roster is kept in a snapshot in the state store, and is only fetched
+  again when the team's member count differs from the snapshot, or when the
+  snapshot is older than max_age seconds. The age limit bounds how long a
+  change that leaves the count the same, such as one member leaving while
+  another joins, can go unnoticed.
+  '''
+  key = f'{TEAM_SNAPSHOT_KEY_PREFIX}{team_id}'
+  count = _get_team_member_count(syn, team_id)
+  snapshot = store.get(key)
+  now = time.time()
+  if (
+    snapshot and
+    snapshot['count'] == count and
+    now - snapshot['refreshed'] < max_age
+  ):
+    return snapshot['member_ids']
+
+  log.debug('Refreshing the roster of team %s', team_id)
+  member_ids = _get_team_member_ids(syn, team_id)
+  store.put(key, {'count': count, 'member_ids': member_ids, 'refreshed': now})
+  return member_ids
+
+
+def get_team_roster(team_id, store=None,
+    snapshot_max_age=DEFAULT_TEAM_SNAPSHOT_MAX_AGE, team_timer=None):
+  '''Get the ids of the non-admin members of a synapse team
+
+  If a state store is given, the roster is read from its snapshot in the
+  store while the team has not changed. If a PhaseTimer is given as
+  team_timer, the time taken is recorded in it under the team id.
+  '''
+  def get_member_ids(syn):
+    if store is None:
+      return _get_team_member_ids(syn, team_id)
+    return _get_team_member_ids_incremental(
+      syn,
+      team_id,
+      store,
+      snapshot_max_age
+    )
+
+  timer = team_timer or PhaseTimer()
+  with timer.phase(team_id):
+    return clients.call_synapse(get_member_ids)
+
+
+def _add_team_members(teams_by_user_id, team_id, user_ids):
+  '''Adds a team to the memberships of its members
+
+  Returns the ids of the members who were not yet in any team
+  '''
+  new_user_ids = []
+  for user_id in user_ids:
+    if user_id in teams_by_user_id:
+      teams_by_user_id[user_id].append(team_id)
+    else:
+      teams_by_user_id[user_id] = [team_id]
+      new_user_ids.append(user_id)
+  return new_user_ids
+
+
+def get_users(teams, max_workers=DEFAULT_SYNAPSE_MAX_WORKERS, store=None,
+    snapshot_max_age=DEFAULT_TEAM_SNAPSHOT_MAX_AGE, team_timer=None):
   '''Get users from synapse teams
 
+  Team rosters are fetched concurrently on a bounded thread pool, then
+  merged in the order the teams were given so that team memberships are
+  always listed in the same order from one run to the next. If a state store
+  is given, rosters of teams that have not changed are read from snapshots
+  kept in the store instead of from Synapse. If a PhaseTimer is given as
+  team_timer, the time taken by each team's roster is recorded in it.
+
   Returns a dictionary of users with a list of their team memberships
   '''
-  syn = synapseclient.Synapse()
+  teams = list(teams)
   teams_by_user_id = {}
-  for team_id in teams:
-    user_ids = [
-      result['member']['ownerId']
-      for result in syn.getTeamMembers(team_id) if not result['isAdmin']
-    ]
-    for user_id in user_ids:
-      if user_id in teams_by_user_id:
-        teams_by_user_id[user_id].append(team_id)
-      else:
-        teams_by_user_id[user_id] = [team_id]
+  if not teams:
+    return teams_by_user_id
+
+  def get_roster(team_id):
+    return get_team_roster(team_id, store, snapshot_max_age, team_timer)
+
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(teams))) as executor:
+    rosters = executor.map(get_roster, teams)
+    for team_id, user_ids in zip(teams, rosters):
+      _add_team_members(teams_by_user_id, team_id, user_ids)
   return teams_by_user_id
 
 
+def _warn_duplicates(store, teams_by_user_id):
+  '''Warns of users in more than one team, unless the same users were
+  warned of last
+  '''
+  duplicates = check_user_duplicates(teams_by_user_id)
+  lines = duplicates.splitlines()
+  warn_on_change(
+    log,
+    store,
+    DUPLICATES_WARNING_KEY,
+    duplicates,
+    'Duplicate team memberships were found for %s',
+    Lazy(summarize, lines)
+  )
+
+
 def check_user_duplicates(teams_by_user_id):
   '''Verify that no users occur in multiple teams'''
 
@@ -61,33 +355,70 @@ def check_user_duplicates(teams_by_user_id):
     ])
 
 
-def compare_budgets_and_users(users):
-  '''Finds users who lack a budget
+def list_service_catalog_budgets(budgets_client):
+  '''Streams the Service Catalog budgets in the account
 
-  This checks budget names against the user list,
-  returning a list of user ids that need a budget to be made
+  Pages through describe_budgets, requesting the largest page size allowed,
+  and yields only the budgets whose names carry BUDGET_NAME_PREFIX as each
+  page arrives, so the full inventory is never held in memory at once.
+  Each page is requested under the rate limit of the account.
   '''
-  budgets_client = get_client('budgets')
+  account = get_current_account()
+  kwargs = {
+    'AccountId': account.account_id,
+    'MaxResults': DESCRIBE_BUDGETS_PAGE_SIZE
+  }
+  while True:
+    page = call_with_backoff(
+      account.rate_limiter,
+      budgets_client.describe_budgets,
+      **kwargs
+      )
+    for budget in page.get('Budgets', []):
+      if budget['BudgetName'].startswith(BUDGET_NAME_PREFIX):
+        yield budget
+    if not page.get('NextToken'):
+      return
+    kwargs['NextToken'] = page['NextToken']
 
-  # get budgets
-  budgets = budgets_client.describe_budgets(
-    AccountId=configuration.account_id
-    ).get('Budgets')
 
-  # get just the Service Catalog budget names
-  service_catalog_budget_names = []
-  if budgets:
-    service_catalog_budget_names = [
-      budget['BudgetName'] for budget in budgets
-      if budget['BudgetName'].startswith(BUDGET_NAME_PREFIX)
-    ]
-  log.debug(f'Service Catalog budget names: {service_catalog_budget_names}')
+def list_budget_user_ids(shard=None):
+  '''Returns the set of synapse ids that have a Service Catalog budget
+
+  If a shard is given, as a dictionary with the shard's index and the
+  number of shards, only the synapse ids in that shard are returned.
+  '''
+  budgets_client = get_client('budgets', get_current_account().role_arn)
+
+  # derive user ids from the names of the Service Catalog budgets
+  service_catalog_budgets_user_ids = set(
+    budget['BudgetName'][len(BUDGET_NAME_PREFIX):]
+    for budget in list_service_catalog_budgets(budgets_client)
+  )
+  if shard is not None:
+    service_catalog_budgets_user_ids = set(
+      synapse_id for synapse_id in service_catalog_budgets_user_ids
+      if get_shard(synapse_id, shard['count']) == shard['index']
+    )
+  log.debug(
+    'Service Catalog budgets found for synapse ids: %s',
+    Lazy(summarize, service_catalog_budgets_user_ids)
+  )
+  return service_catalog_budgets_user_ids
+
 
-  # derive user ids from budget names
-  service_catalog_budgets_user_ids = set([
-    budget_name.split(BUDGET_NAME_PREFIX)[1]
-    for budget_name in service_catalog_budget_names
-  ])
+def compare_budgets_and_users(users, shard=None, budget_user_ids=None):
+  '''Finds users who lack a budget
+
+  This checks budget names against the user list,
+  returning a list of user ids that need a budget to be made.
+  If a shard is given, only the budgets in that shard are checked. The
+  budgets are listed, unless the synapse ids of their names are given as
+  budget_user_ids.
+  '''
+  if budget_user_ids is None:
+    budget_user_ids = list_budget_user_ids(shard)
+  service_catalog_budgets_user_ids = set(budget_user_ids)
 
   users = set(users)
 
@@ -107,13 +438,12 @@ def create_budget_definition(synapse_id, team):
   This is part of the payload that will be submitted through the boto3
   client when creating an AWS budget.
   '''
-  log.debug(f'Creating budget for synapse user {synapse_id}, member of team {team}')
-
   team_budget_rules = configuration.budget_rules.get('teams').get(team)
   if not team_budget_rules:
     raise ValueError(f'No budget rules available for team {team}')
   budget_amount = team_budget_rules['amount']
   budget_period = team_budget_rules['period']
+  account = get_current_account()
   budget_definition = {
     'BudgetName': _get_budget_name(synapse_id),
     'BudgetLimit': {
@@ -124,8 +454,8 @@ def create_budget_definition(synapse_id, team):
       'TagKeyValue': [
         (
           'aws:servicecatalog:provisioningPrincipalArn$arn:aws:sts::'
-          f'{configuration.account_id}:assumed-role/'
-          f'{configuration.end_user_role_name}/{synapse_id}'
+          f'{account.account_id}:assumed-role/'
+          f'{account.end_user_role_name}/{synapse_id}'
         )
       ]
     },
@@ -160,7 +490,7 @@ def _create_notification_definition(synapse_id, threshold, admin_emails=None):
   # add sns subscription for the user
   subscribers.append({
     'SubscriptionType': 'SNS',
-    'Address': configuration.notification_topic_arn
+    'Address': get_current_account().notification_topic_arn
     })
 
   notification_definition = {
@@ -203,93 +533,1672 @@ def create_notification_definitions(synapse_id, team):
   return notification_definitions
 
 
+def get_budget_template(team):
+  '''Returns the budget template of a team
+
+  Templates are made once for each account and version of the
+  configuration, and are made again when the configuration changes.
+  '''
+  global _budget_templates_version
+  version = (id(configuration), configuration.fingerprint)
+  key = (get_current_account().account_id, team)
+  with _budget_templates_lock:
+    if version != _budget_templates_version:
+      _budget_templates.clear()
+      _budget_templates_version = version
+    template = _budget_templates.get(key)
+    if template is None:
+      template = BudgetTemplate(
+        lambda synapse_id: (
+          create_budget_definition(synapse_id, team),
+          create_notification_definitions(synapse_id, team)
+        )
+      )
+      _budget_templates[key] = template
+    return template
+
+
+def _get_budget_definitions(synapse_id, team):
+  '''Creates the budget and notification definitions of a synapse user'''
+  return get_budget_template(team).render(synapse_id)
+
+
+def _get_fingerprint_tags(budget_definition, notification_definitions):
+  return [{
+    'Key': FINGERPRINT_TAG_KEY,
+    'Value': get_budget_fingerprint(budget_definition, notification_definitions)
+  }]
+
+
 def create_budget(budget_definition, notification_definitions):
-  '''Creates an AWS budget'''
-  budgets_client = get_client('budgets')
-  return budgets_client.create_budget(
-    AccountId=configuration.account_id,
+  '''Creates an AWS budget
+
+  The budget is tagged with the fingerprint of its definition, which is
+  used later on to find budgets whose definition has drifted.
+  '''
+  return _call_budgets(
+    'create_budget',
+    AccountId=get_current_account().account_id,
     Budget=budget_definition,
-    NotificationsWithSubscribers=notification_definitions
+    NotificationsWithSubscribers=notification_definitions,
+    ResourceTags=_get_fingerprint_tags(
+      budget_definition,
+      notification_definitions
+    )
+    )
+
+
+def create_user_budget(synapse_id, team, fingerprints=None):
+  '''Creates the AWS budget of a synapse id, as a member of team
+
+  The fingerprint of the new budget is recorded in the fingerprint index, if
+  one is given.
+  '''
+  log.debug(
+    'Creating budget for synapse user %s, member of team %s',
+    synapse_id,
+    team
+  )
+  budget_definition, notification_definitions = _get_budget_definitions(
+    synapse_id,
+    team
+  )
+  create_budget(budget_definition, notification_definitions)
+  if fingerprints is not None:
+    fingerprints.set(
+      synapse_id,
+      get_budget_fingerprint(budget_definition, notification_definitions)
     )
 
 
-def create_budgets(user_ids_without_budget, teams_by_user_id):
-  '''Creates an AWS budget for each synapse id'''
-  new_budgets_created = []
-  for synapse_id in user_ids_without_budget:
-    team = teams_by_user_id[synapse_id][0]
-    budget_definition = create_budget_definition(synapse_id, team)
-    notification_definitions = create_notification_definitions(synapse_id, team)
-    create_budget(budget_definition, notification_definitions)
-    new_budgets_created.append(synapse_id)
+def create_budgets(user_ids_without_budget, teams_by_user_id,
+    max_workers=DEFAULT_BUDGETS_MAX_WORKERS, fingerprints=None,
+    should_stop=None):
+  '''Creates an AWS budget for each synapse id
 
+  Budgets are created concurrently, and a failure for one synapse id does not
+  stop the others. The fingerprints of new budgets are recorded in the
+  fingerprint index, if one is given. Budgets not yet started when
+  should_stop returns True are deferred. Returns a BatchResult with the
+  outcome for each synapse id.
+  '''
+  return run_batch(
+    lambda synapse_id: create_user_budget(
+      synapse_id,
+      teams_by_user_id[synapse_id][0],
+      fingerprints
+    ),
+    user_ids_without_budget,
+    max_workers,
+    should_stop
+  )
+
+
+def _get_budget_fingerprint_tag(synapse_id):
+  '''Reads the fingerprint tag of a budget, or None if it has none'''
+  tags = _call_budgets(
+    'list_tags_for_resource',
+    ResourceARN=_get_budget_arn(_get_budget_name(synapse_id))
+    ).get('ResourceTags', [])
+  for tag in tags:
+    if tag['Key'] == FINGERPRINT_TAG_KEY:
+      return tag['Value']
+  return None
+
+
+def budget_exists(synapse_id):
+  '''Whether a synapse id has an AWS budget'''
+  try:
+    _call_budgets(
+      'describe_budget',
+      AccountId=get_current_account().account_id,
+      BudgetName=_get_budget_name(synapse_id)
+      )
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'NotFoundException':
+      return False
+    raise
+  return True
+
+
+def find_drifted_budgets(synapse_ids, teams_by_user_id, fingerprints,
+    max_workers=DEFAULT_BUDGETS_MAX_WORKERS, should_stop=None):
+  '''Finds budgets whose desired definition has changed
+
+  The fingerprint of each user's desired budget is compared with the
+  fingerprint of the definition the budget was made from. Known fingerprints
+  come from the fingerprint index; the budgets missing from the index have
+  their fingerprint tags read concurrently, and are added to it. The index is
+  saved after every FINGERPRINT_LOOKUP_BATCH_SIZE tags, so that tags read by
+  an invocation that times out are not read again by the next one. Budgets
+  without a fingerprint tag, such as budgets made before budgets were tagged,
+  are treated as drifted. Tags not yet read when should_stop returns True are
+  skipped, and their budgets are treated as not drifted; they stay out of the
+  index, so the next run reads them.
+
+  Returns a list of synapse ids whose budgets need to be updated
+  '''
+  desired_fingerprints = {
+    synapse_id: get_budget_fingerprint(
+      *_get_budget_definitions(synapse_id, teams_by_user_id[synapse_id][0])
+    )
+    for synapse_id in synapse_ids
+  }
+
+  def load_fingerprint_tag(synapse_id):
+    fingerprint = _get_budget_fingerprint_tag(synapse_id)
+    if fingerprint:
+      fingerprints.set(synapse_id, fingerprint)
+
+  unknown_synapse_ids = [
+    synapse_id for synapse_id in desired_fingerprints
+    if fingerprints.get(synapse_id) is None
+  ]
+  skipped = set()
+  for start in range(0, len(unknown_synapse_ids), FINGERPRINT_LOOKUP_BATCH_SIZE):
+    batch = unknown_synapse_ids[start:start + FINGERPRINT_LOOKUP_BATCH_SIZE]
+    if should_stop is not None and should_stop():
+      skipped.update(unknown_synapse_ids[start:])
+      break
+    lookups = run_batch(load_fingerprint_tag, batch, max_workers, should_stop)
+    fingerprints.save()
+    skipped.update(lookups.deferred)
+    for (synapse_id, error) in lookups.failed.items():
+      log.warning(
+        'Could not read the fingerprint of synapse id %s: %s',
+        synapse_id,
+        error
+      )
+  if skipped:
+    log.warning(
+      'Out of time to read fingerprints; %d budgets left for the next run',
+      len(skipped)
+    )
+
+  return [
+    synapse_id
+    for (synapse_id, fingerprint) in desired_fingerprints.items()
+    if synapse_id not in skipped and fingerprints.get(synapse_id) != fingerprint
+  ]
+
+
+def _get_notification_key(notification):
   return (
-    'Budgets created for synapse ids: '
-    f'{"none" if not new_budgets_created else ", ".join(new_budgets_created)}'
+    notification['NotificationType'],
+    notification['ComparisonOperator'],
+    float(notification['Threshold']),
+    notification.get('ThresholdType', 'PERCENTAGE')
   )
 
 
-def delete_budgets(synapse_ids):
-  '''Deletes AWS budgets'''
-  budgets_client = get_client('budgets')
-  budgets_removed = []
-  for synapse_id in synapse_ids:
-    budget_name = _get_budget_name(synapse_id)
-    response = budgets_client.delete_budget(
-      AccountId=configuration.account_id,
+def _get_subscriber_key(subscriber):
+  return (subscriber['SubscriptionType'], subscriber['Address'])
+
+
+def _update_subscribers(budget_name, notification, subscribers):
+  '''Changes the subscribers of a budget notification to match subscribers'''
+  existing = {
+    _get_subscriber_key(subscriber): subscriber
+    for subscriber in _describe_all(
+      'describe_subscribers_for_notification',
+      'Subscribers',
+      AccountId=get_current_account().account_id,
+      BudgetName=budget_name,
+      Notification=notification
+    )
+  }
+  desired = {
+    _get_subscriber_key(subscriber): subscriber for subscriber in subscribers
+  }
+  for key in desired.keys() - existing.keys():
+    _call_budgets(
+      'create_subscriber',
+      AccountId=get_current_account().account_id,
+      BudgetName=budget_name,
+      Notification=notification,
+      Subscriber=desired[key]
+      )
+  for key in existing.keys() - desired.keys():
+    _call_budgets(
+      'delete_subscriber',
+      AccountId=get_current_account().account_id,
+      BudgetName=budget_name,
+      Notification=notification,
+      Subscriber=existing[key]
+      )
+
+
+def update_budget(budget_definition, notification_definitions):
+  '''Updates an existing AWS budget to match its definition
+
+  The budget is replaced with budget_definition, notifications and their
+  subscribers are added or removed to match notification_definitions, and
+  the budget's fingerprint tag is updated.
+  '''
+  budget_name = budget_definition['BudgetName']
+  _call_budgets(
+    'update_budget',
+    AccountId=get_current_account().account_id,
+    NewBudget=budget_definition
+    )
+
+  existing = {
+    _get_notification_key(notification): notification
+    for notification in _describe_all(
+      'describe_notifications_for_budget',
+      'Notifications',
+      AccountId=get_current_account().account_id,
       BudgetName=budget_name
+    )
+  }
+  desired = {
+    _get_notification_key(definition['Notification']): definition
+    for definition in notification_definitions
+  }
+  for (key, notification) in existing.items():
+    if key not in desired:
+      _call_budgets(
+        'delete_notification',
+        AccountId=get_current_account().account_id,
+        BudgetName=budget_name,
+        Notification=notification
+        )
+  for (key, definition) in desired.items():
+    if key in existing:
+      _update_subscribers(
+        budget_name,
+        existing[key],
+        definition['Subscribers']
+      )
+    else:
+      _call_budgets(
+        'create_notification',
+        AccountId=get_current_account().account_id,
+        BudgetName=budget_name,
+        Notification=definition['Notification'],
+        Subscribers=definition['Subscribers']
+        )
+
+  _call_budgets(
+    'tag_resource',
+    ResourceARN=_get_budget_arn(budget_name),
+    ResourceTags=_get_fingerprint_tags(
+      budget_definition,
+      notification_definitions
+    )
+    )
+
+
+def update_user_budget(synapse_id, team, fingerprints=None):
+  '''Updates the AWS budget of a synapse id to match its definition
+
+  The new fingerprint of the budget is recorded in the fingerprint index, if
+  one is given.
+  '''
+  log.debug(
+    'Updating budget for synapse user %s, member of team %s',
+    synapse_id,
+    team
+  )
+  budget_definition, notification_definitions = _get_budget_definitions(
+    synapse_id,
+    team
+  )
+  update_budget(budget_definition, notification_definitions)
+  if fingerprints is not None:
+    fingerprints.set(
+      synapse_id,
+      get_budget_fingerprint(budget_definition, notification_definitions)
+    )
+
+
+def update_budgets(synapse_ids, teams_by_user_id,
+    max_workers=DEFAULT_BUDGETS_MAX_WORKERS, fingerprints=None,
+    should_stop=None):
+  '''Updates the AWS budget of each synapse id to match its definition
+
+  Budgets are updated concurrently, and a failure for one synapse id does not
+  stop the others. The new fingerprints are recorded in the fingerprint
+  index, if one is given. Budgets not yet started when should_stop returns
+  True are deferred. Returns a BatchResult with the outcome for each synapse
+  id.
+  '''
+  return run_batch(
+    lambda synapse_id: update_user_budget(
+      synapse_id,
+      teams_by_user_id[synapse_id][0],
+      fingerprints
+    ),
+    synapse_ids,
+    max_workers,
+    should_stop
+  )
+
+
+def delete_budget(synapse_id):
+  '''Deletes the AWS budget of a synapse id
+
+  Returns False if the budget did not exist.
+  '''
+  try:
+    _call_budgets(
+      'delete_budget',
+      AccountId=get_current_account().account_id,
+      BudgetName=_get_budget_name(synapse_id)
+      )
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'NotFoundException':
+      return False
+    raise
+  return True
+
+
+def delete_user_budget(synapse_id, fingerprints=None):
+  '''Deletes the AWS budget of a synapse id
+
+  The budget is removed from the fingerprint index, if one is given. Returns
+  False if the budget did not exist.
+  '''
+  deleted = delete_budget(synapse_id)
+  if fingerprints is not None:
+    fingerprints.discard(synapse_id)
+  return deleted
+
+
+def delete_budgets(synapse_ids, max_workers=DEFAULT_BUDGETS_MAX_WORKERS,
+    fingerprints=None, should_stop=None):
+  '''Deletes AWS budgets
+
+  Budgets are deleted concurrently, and a failure for one synapse id does not
+  stop the others. Deleted budgets are removed from the fingerprint index,
+  if one is given. Budgets not yet started when should_stop returns True are
+  deferred. Returns a BatchResult with the outcome for each synapse id.
+  '''
+  return run_batch(
+    lambda synapse_id: delete_user_budget(synapse_id, fingerprints),
+    synapse_ids,
+    max_workers,
+    should_stop
+  )
+
+
+def reconcile_users(teams_by_user_id, fingerprints,
+    max_workers=DEFAULT_BUDGETS_MAX_WORKERS, should_stop=None):
+  '''Reconciles the budgets of some users, without scanning every budget
+
+  Users with teams get a budget for their first team, made or updated as
+  needed, and users without any team have their budget removed. A user in
+  the fingerprint index is known to have a budget; only the existence of
+  the budgets of other users is checked, one budget at a time. Changes not
+  yet started when should_stop returns True are deferred.
+
+  Returns a BatchResult for each of budget creation, update and removal
+  '''
+  users_with_teams = [
+    synapse_id for (synapse_id, teams) in teams_by_user_id.items() if teams
+  ]
+  users_without_teams = [
+    synapse_id for (synapse_id, teams) in teams_by_user_id.items() if not teams
+  ]
+
+  unknown_user_ids = [
+    synapse_id for synapse_id in users_with_teams
+    if fingerprints.get(synapse_id) is None
+  ]
+  user_ids_without_budget = []
+  if unknown_user_ids:
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(unknown_user_ids))) as executor:
+      user_ids_without_budget = [
+        synapse_id
+        for (synapse_id, exists) in zip(
+          unknown_user_ids,
+          executor.map(accounts.bind(budget_exists), unknown_user_ids)
+        )
+        if not exists
+      ]
+
+  budgets_created = create_budgets(
+    user_ids_without_budget,
+    teams_by_user_id,
+    max_workers,
+    fingerprints,
+    should_stop
+  )
+  budgets_to_update = find_drifted_budgets(
+    set(users_with_teams) - set(user_ids_without_budget),
+    teams_by_user_id,
+    fingerprints,
+    max_workers,
+    should_stop
+  )
+  budgets_updated = update_budgets(
+    budgets_to_update,
+    teams_by_user_id,
+    max_workers,
+    fingerprints,
+    should_stop
+  )
+  budgets_removed = delete_budgets(
+    users_without_teams,
+    max_workers,
+    fingerprints,
+    should_stop
+  )
+  return budgets_created, budgets_updated, budgets_removed
+
+
+def get_target_users(event, store, team_timer=None):
+  '''Get the users named by a targeted event, with their teams
+
+  A targeted event names one user or one team to reconcile, instead of
+  every team: {"reconcile_user": "3388489"} checks the user's membership of
+  each team; {"reconcile_team": "3412821"} reads the team's roster, and
+  also returns the members who have left the team since its last snapshot,
+  with the teams they are still in; {"remove_user": "3388489"} returns the
+  user without any team, so that their budget is removed.
+
+  Returns a dictionary of users with a list of their team memberships
+  '''
+  teams = list(configuration.budget_rules['teams'])
+
+  def get_teams(synapse_id):
+    return get_user_teams(synapse_id, teams, configuration.synapse_max_workers)
+
+  if 'remove_user' in event:
+    return {str(event['remove_user']): []}
+  if 'reconcile_user' in event:
+    synapse_id = str(event['reconcile_user'])
+    return {synapse_id: get_teams(synapse_id)}
+
+  team_id = str(event['reconcile_team'])
+  if team_id not in teams:
+    raise ValueError(f'Team {team_id} has no budget rules')
+
+  # members of an earlier team get the budget of that team
+  teams_by_user_id = get_users(
+    teams[:teams.index(team_id)],
+    configuration.synapse_max_workers,
+    store,
+    configuration.team_snapshot_max_age,
+    team_timer
+  )
+  snapshot = store.get(f'{TEAM_SNAPSHOT_KEY_PREFIX}{team_id}') or {}
+  # a snapshot of any age is refreshed, as the team is known to have changed
+  member_ids = get_team_roster(team_id, store, 0, team_timer)
+  teams_by_user_id = {
+    synapse_id: teams_by_user_id.get(synapse_id, []) + [team_id]
+    for synapse_id in member_ids
+  }
+  for synapse_id in set(snapshot.get('member_ids', [])) - set(member_ids):
+    teams_by_user_id[synapse_id] = get_teams(synapse_id)
+  return teams_by_user_id
+
+
+async def reconcile_async(teams, store, fingerprints, timer, team_timer=None,
+    should_stop=None, teams_by_user_id=None):
+  '''Reconciles budgets with team rosters, overlapping the I/O of each phase
+
+  The budget inventory and the team rosters are read at the same time. Once
+  the inventory is in, each team's roster is diffed against it as soon as it
+  arrives, in the order the teams were given, and the budgets to create or
+  update are put on a bounded MutationQueue whose workers apply them while
+  the remaining rosters are still being read. Budgets to remove are only
+  known once every roster is in, and are queued last. Roster, inventory and
+  budget calls each run on their own thread pool, sized as in the threaded
+  engine, and the time taken by the inventory and by all the rosters is
+  recorded in timer. Changes taken from the queue once should_stop returns
+  True are deferred. If the rosters were already read, and teams_by_user_id
+  is given, they are not read again, and only the inventory is read.
+
+  Returns the teams of each user, the number of budgets found, and a
+  BatchResult for each of 'create', 'update' and 'delete'
+  '''
+  # imported here, as asyncio is a large part of a cold start and only
+  # the async engine uses it
+  import asyncio
+  from budget.pipeline import MutationQueue
+
+  loop = asyncio.get_running_loop()
+  teams = list(teams)
+  read_teams_by_user_id = teams_by_user_id
+  teams_by_user_id = {}
+
+  def timed(phase, func, *args):
+    with timer.phase(phase):
+      return func(*args)
+
+  async def timed_async(phase, awaitable):
+    with timer.phase(phase):
+      return await awaitable
+
+  def get_roster(team_id):
+    return get_team_roster(
+      team_id,
+      store,
+      configuration.team_snapshot_max_age,
+      team_timer
+    )
+
+  def get_read_roster(team_id):
+    roster = loop.create_future()
+    roster.set_result([
+      synapse_id
+      for (synapse_id, user_teams) in read_teams_by_user_id.items()
+      if team_id in user_teams
+    ])
+    return roster
+
+  with ThreadPoolExecutor(max_workers=1) as planner, \
+    ThreadPoolExecutor(max_workers=configuration.synapse_max_workers) as synapse, \
+    ThreadPoolExecutor(max_workers=configuration.budgets_max_workers) as budgets:
+    inventory = loop.run_in_executor(
+      planner,
+      timed,
+      'inventory',
+      list_budget_user_ids
+    )
+    if read_teams_by_user_id is None:
+      rosters = [
+        loop.run_in_executor(synapse, get_roster, team_id) for team_id in teams
+      ]
+    else:
+      rosters = [get_read_roster(team_id) for team_id in teams]
+    all_rosters = asyncio.ensure_future(
+      timed_async('roster', asyncio.gather(*rosters))
+    )
+    mutations = MutationQueue(
+      budgets,
+      configuration.budgets_max_workers,
+      MUTATION_QUEUE_SIZE,
+      should_stop
+    )
+
+    try:
+      budget_user_ids = await inventory
+      for (team_id, roster) in zip(teams, rosters):
+        new_user_ids = _add_team_members(teams_by_user_id, team_id, await roster)
+        for synapse_id in new_user_ids:
+          if synapse_id not in budget_user_ids:
+            await mutations.put(
+              'create',
+              lambda synapse_id, team_id=team_id: create_user_budget(
+                synapse_id,
+                team_id,
+                fingerprints
+              ),
+              synapse_id
+            )
+
+        # the drift check mostly reads the fingerprint index, so it runs
+        # off the event loop, on the planner thread
+        drifted = await loop.run_in_executor(
+          planner,
+          find_drifted_budgets,
+          [synapse_id for synapse_id in new_user_ids if synapse_id in budget_user_ids],
+          teams_by_user_id,
+          fingerprints,
+          configuration.budgets_max_workers,
+          should_stop
+        )
+        for synapse_id in drifted:
+          await mutations.put(
+            'update',
+            lambda synapse_id, team_id=team_id: update_user_budget(
+              synapse_id,
+              team_id,
+              fingerprints
+            ),
+            synapse_id
+          )
+      await all_rosters
+
+      for synapse_id in budget_user_ids - set(teams_by_user_id):
+        await mutations.put(
+          'delete',
+          lambda synapse_id: delete_user_budget(synapse_id, fingerprints),
+          synapse_id
+        )
+      await mutations.join()
+    except BaseException:
+      # skip the rosters not yet started, and let the changes already queued
+      # finish, so that the fingerprint index matches the budgets
+      all_rosters.cancel()
+      await mutations.join()
+      raise
+
+  return (
+    teams_by_user_id,
+    len(budget_user_ids),
+    *[
+      mutations.results.get(action, BatchResult())
+      for action in ['create', 'update', 'delete']
+    ]
+  )
+
+
+def get_checkpoint(budgets_created, budgets_updated, budgets_removed,
+    teams_by_user_id):
+  '''Returns the changes deferred by a run, as a checkpoint to resume
+
+  The checkpoint maps each synapse id whose budget is still to be created or
+  updated to the team of its budget, and lists the synapse ids whose budget
+  is still to be removed, for example {"create": {"3388489": "3412821"},
+  "update": {}, "delete": ["3406211"]}. Returns None if nothing was deferred.
+  '''
+  if not (
+    budgets_created.deferred or
+    budgets_updated.deferred or
+    budgets_removed.deferred
+  ):
+    return None
+  return {
+    'create': {
+      synapse_id: teams_by_user_id[synapse_id][0]
+      for synapse_id in budgets_created.deferred
+    },
+    'update': {
+      synapse_id: teams_by_user_id[synapse_id][0]
+      for synapse_id in budgets_updated.deferred
+    },
+    'delete': list(budgets_removed.deferred)
+  }
+
+
+def resume_checkpoint(checkpoint, fingerprints,
+    max_workers=DEFAULT_BUDGETS_MAX_WORKERS, should_stop=None):
+  '''Makes the changes an earlier run was out of time for
+
+  Budgets are created first, as their users have no budget at all, then
+  updated, then removed. Changes not yet started when should_stop returns
+  True are deferred again.
+
+  Returns a BatchResult for each of budget creation, update and removal
+  '''
+  teams_by_user_id = {
+    synapse_id: [team_id]
+    for action in ['create', 'update']
+    for (synapse_id, team_id) in checkpoint[action].items()
+  }
+  budgets_created = create_budgets(
+    checkpoint['create'],
+    teams_by_user_id,
+    max_workers,
+    fingerprints,
+    should_stop
+  )
+  budgets_updated = update_budgets(
+    checkpoint['update'],
+    teams_by_user_id,
+    max_workers,
+    fingerprints,
+    should_stop
+  )
+  budgets_removed = delete_budgets(
+    checkpoint['delete'],
+    max_workers,
+    fingerprints,
+    should_stop
+  )
+  return budgets_created, budgets_updated, budgets_removed
+
+
+def get_budget_performance_history(budget_name):
+  '''Reads the budgeted and actual amounts of a budget in each past period'''
+  kwargs = {
+    'AccountId': get_current_account().account_id,
+    'BudgetName': budget_name
+  }
+  history = []
+  while True:
+    response = _call_budgets('describe_budget_performance_history', **kwargs)
+    history.extend(
+      response.get('BudgetPerformanceHistory', {})
+      .get('BudgetedAndActualAmountsList', [])
+    )
+    if not response.get('NextToken'):
+      return history
+    kwargs['NextToken'] = response['NextToken']
+
+
+def get_spend_records(teams_by_user_id, history=False, should_stop=None):
+  '''Streams a spend record for each Service Catalog budget
+
+  The spend of each budget comes with the budget in the describe_budgets
+  pages, so reading it costs one call per page. Budgets are joined to their
+  synapse id and to the user's first team, or None for users in no team.
+  With history, the performance history of the budgets on each page is
+  read on the budgets worker threads, one call or more per budget, until
+  should_stop returns True; records after that are streamed without their
+  history, as are the records of annual budgets, which have none, and of
+  budgets whose history could not be read.
+  '''
+  budgets_client = get_client('budgets', get_current_account().role_arn)
+
+  def get_history(budget):
+    if budget.get('TimeUnit') == 'ANNUALLY':
+      return None
+    if should_stop is not None and should_stop():
+      return None
+    try:
+      return get_budget_performance_history(budget['BudgetName'])
+    except Exception as e:
+      log.error(
+        'Budget performance history of %s not read: %s',
+        budget['BudgetName'],
+        e
+      )
+      return None
+
+  budgets = list_service_catalog_budgets(budgets_client)
+  with ThreadPoolExecutor(max_workers=configuration.budgets_max_workers) as executor:
+    while True:
+      page = list(itertools.islice(budgets, DESCRIBE_BUDGETS_PAGE_SIZE))
+      if not page:
+        return
+      histories = (
+        executor.map(accounts.bind(get_history), page) if history
+        else itertools.repeat(None)
       )
-    budgets_removed.append(synapse_id)
+      for (budget, budget_history) in zip(page, histories):
+        synapse_id = budget['BudgetName'][len(BUDGET_NAME_PREFIX):]
+        yield get_spend_record(
+          synapse_id,
+          (teams_by_user_id.get(synapse_id) or [None])[0],
+          budget,
+          budget_history
+        )
+
+
+def run_spend_report(event, store, deadline, timer, team_timer, metrics,
+    teams_by_user_id=None, suffix=''):
+  '''Writes a report of the spend of every Service Catalog budget
+
+  The report is written to the event's "report_output", or REPORT_OUTPUT,
+  with suffix added to the file name, as the event's "report_format", or
+  REPORT_FORMAT. With "history": true in the event, it also holds the
+  performance history of each budget, read until the deadline.
+
+  The rosters are not read if teams_by_user_id is given.
+
+  Returns the handler result
+  '''
+  if teams_by_user_id is None:
+    teams_by_user_id = _read_rosters(store, timer, team_timer)
+  metrics.put_metric('Users', len(teams_by_user_id))
+
+  report_path = _add_suffix(
+    event.get('report_output', configuration.report_output),
+    suffix
+  )
+  report_format = event.get('report_format', configuration.report_format)
+  if report_format not in REPORT_FORMATS:
+    raise ValueError(f'Report format must be one of {REPORT_FORMATS}')
+  with timer.phase('report'):
+    count = write_spend_report(
+      report_path,
+      get_spend_records(
+        teams_by_user_id,
+        event.get('history', False),
+        deadline.expired
+      ),
+      report_format
+    )
+  metrics.put_metric('BudgetsSeen', count)
 
-  return ('Budgets removed for synapse ids: '
-    f'{"none" if not budgets_removed else ", ".join(budgets_removed)}'
+  report_message = (
+    f'Budget spend report of {count} budgets written to {report_path}'
   )
+  log.info(report_message)
+  return {
+    'message': report_message,
+    'report': {
+      'path': report_path,
+      'format': report_format,
+      'count': count
+    }
+  }
+
+
+def write_plan(path, user_ids_without_budget, budgets_to_update,
+    budgets_to_remove, teams_by_user_id, timings):
+  '''Writes a reconciliation plan to a file as JSON Lines
+
+  Each line is one change that a run would make, for example
+  {"action": "create", "synapse_id": "3388489", "team": "3412821"},
+  and the last line holds the time each phase took. Lines are written one
+  at a time, so the plan is never held in memory as a whole.
+
+  Returns the number of changes of each kind
+  '''
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  changes = [
+    ('create', user_ids_without_budget),
+    ('update', budgets_to_update),
+    ('delete', budgets_to_remove)
+  ]
+  counts = {}
+  with open(path, 'w') as f:
+    for (action, synapse_ids) in changes:
+      counts[action] = 0
+      for synapse_id in synapse_ids:
+        record = {'action': action, 'synapse_id': synapse_id}
+        if synapse_id in teams_by_user_id:
+          record['team'] = teams_by_user_id[synapse_id][0]
+        f.write(json.dumps(record) + '\n')
+        counts[action] += 1
+    f.write(json.dumps({'timings': timings}) + '\n')
+  return counts
+
+
+def prime():
+  '''Pays the one-time costs of a run ahead of the first invocation
+
+  Loads the configuration, imports the Synapse client and makes the AWS
+  Budgets client, which loads its service model. Called while the lambda
+  initializes when PRIME_ON_INIT is true, so that the work is done in the
+  init phase, and captured in the snapshot when SnapStart is in use,
+  instead of in the first invocation.
+  '''
+  global configuration
+  configuration = Config.load()
+  clients.configure(
+    configuration.aws_max_pool_connections,
+    configuration.aws_retry_mode
+  )
+  clients.import_synapseclient()
+  get_client('budgets')
+
+
+def _read_rosters(store, timer, team_timer, snapshot_max_age=None):
+  '''Reads the rosters of every team in the budget rules
+
+  Rosters are served from their snapshots in the store for up to
+  TEAM_SNAPSHOT_MAX_AGE seconds, or snapshot_max_age if it is given. The
+  time taken is recorded in timer as the roster phase.
+
+  Returns a dictionary of users with a list of their team memberships
+  '''
+  if snapshot_max_age is None:
+    snapshot_max_age = configuration.team_snapshot_max_age
+  with timer.phase('roster'):
+    return get_users(
+      configuration.budget_rules['teams'].keys(),
+      configuration.synapse_max_workers,
+      store,
+      snapshot_max_age,
+      team_timer
+    )
+
+
+def _save_reconciled_state(store, teams_by_user_id, failed_count, checked):
+  '''Records the state a full run left the budgets in
+
+  The state is only kept when every change succeeded, so that a run after
+  a failure always checks every budget again.
+  '''
+  if failed_count:
+    store.delete(RECONCILED_STATE_KEY)
+  else:
+    store.put(RECONCILED_STATE_KEY, {
+      'digest': get_state_digest(teams_by_user_id, configuration.fingerprint),
+      'checked': checked
+    })
+
+
+def _combine_results(kind, names, results, mode, timer, metrics):
+  '''Combines the results of the workers a coordinator started
+
+  kind is what a worker is, "shard" or "account", and names holds the name
+  of each worker, in the order of results. mode is what the workers did:
+  "report" counts the budgets in their spend reports, "plan" the changes in
+  their plans, and "run" the changes they made. The number of workers that
+  failed is put as the ShardsFailed or AccountsFailed metric.
+
+  Returns the handler result, the counts summed over the workers that
+  succeeded, and the number of workers that failed
+  '''
+  counts = dict.fromkeys(WORKER_COUNTS[mode], 0)
+  errors = []
+  for (name, result) in zip(names, results):
+    if 'error' in result:
+      errors.append(f'{kind} {name} ({result["error"]})')
+      continue
+    if mode == 'report':
+      worker_counts = {'budgets': result['report']['count']}
+    elif mode == 'plan':
+      worker_counts = result['plan']['counts']
+    else:
+      worker_counts = result['counts']
+    for action in counts:
+      counts[action] += worker_counts[action]
+  metrics.put_metric(f'{kind.capitalize()}sFailed', len(errors))
+
+  workers = f'{len(results)} {kind}s'
+  if mode == 'report':
+    message = (
+      f'Budget spend reports of {counts["budgets"]} budgets written '
+      f'for {workers}'
+    )
+  elif mode == 'plan':
+    message = (
+      f'Budget maker plans written for {workers}; '
+      f'{counts["create"]} to create, '
+      f'{counts["update"]} to update, '
+      f'{counts["delete"]} to delete'
+    )
+  else:
+    message = (
+      f'Budget maker run complete in {workers}; '
+      f'Budgets created: {counts["created"]}; '
+      f'Budgets updated: {counts["updated"]}; '
+      f'Budgets removed: {counts["removed"]}; '
+      f'Budgets failed: {counts["failed"]}; '
+      f'Budgets left for the next run: {counts["deferred"]}'
+    )
+  result = {
+    'counts': counts,
+    'timings': {
+      phase: round(seconds, 3) for (phase, seconds) in timer.timings.items()
+    }
+  }
+  if errors:
+    result['error'] = (
+      f'{len(errors)} of {workers} failed: {", ".join(errors)}'
+    )
+    log.error('%s; %s', message, result['error'])
+  else:
+    result['message'] = message
+    log.info(message)
+  return (result, counts, len(errors))
+
+
+def run_shards(context, store, deadline, timer, team_timer, metrics,
+    run_start, teams_by_user_id=None):
+  '''Reconciles budgets in shards, each in an invocation of its own
+
+  The team rosters are read once, here, and the users are split into shards
+  by a hash of their synapse id. Each shard is then reconciled at the same
+  time by a worker invocation, which is given the users of its shard and
+  only looks at the budgets in its shard. Workers are invocations of this
+  lambda function, or calls of the handler in this process when
+  SHARD_INVOCATION is "local". Workers stop at this invocation's deadline,
+  if it comes before their own, so that the results of every shard are
+  back before this invocation times out; the reconciled state is only kept
+  when the shards finished before it.
+
+  The rosters are not read again if teams_by_user_id is given.
+
+  Returns the handler result, with the changes made by all of the shards
+  '''
+  if teams_by_user_id is None:
+    teams_by_user_id = _read_rosters(store, timer, team_timer)
+  metrics.put_metric('Users', len(teams_by_user_id))
+
+  # verify that no users appear in multiple teams
+  _warn_duplicates(store, teams_by_user_id)
+
+  shard_count = configuration.shard_count
+  events = [
+    {
+      'shard': {'index': index, 'count': shard_count, 'users': users},
+      'deadline': deadline.timestamp()
+    }
+    for (index, users) in enumerate(split_users(teams_by_user_id, shard_count))
+  ]
+  if configuration.shard_invocation == 'local':
+    # local shards share this process's rate limiter, and so its rate
+    invoke = LocalInvoker(lambda_handler, context)
+  else:
+    # the shards call the Budgets API of one account at the same time, so
+    # each is given its share of the account's rate
+    max_tps = max(MIN_SHARD_MAX_TPS, configuration.budgets_max_tps / shard_count)
+    for event in events:
+      event['max_tps'] = max_tps
+    invoke = LambdaInvoker(context.function_name)
+  with timer.phase('shards'):
+    results = invoke_shards(invoke, events)
+
+  (result, counts, failed) = _combine_results(
+    'shard',
+    range(shard_count),
+    results,
+    'run',
+    timer,
+    metrics
+  )
+  # past the deadline, shards may have skipped budgets without deferring
+  # them, such as budgets whose fingerprints were not read
+  if not deadline.expired():
+    _save_reconciled_state(
+      store,
+      teams_by_user_id,
+      counts['failed'] + counts['deferred'] + failed,
+      run_start
+    )
+  return result
+
+
+def run_accounts(event, context, store, deadline, timer, team_timer, metrics,
+    run_start, targeted, full_run, teams_by_user_id=None):
+  '''Reconciles the budgets of every account in ACCOUNTS at the same time
+
+  The team rosters, or the users named by a targeted event, are read once,
+  here, and shared by all of the accounts. Each account is then reconciled
+  by a call of the handler on a thread of its own, which is given the users
+  and manages the account's budgets with a budgets client, rate limiter and
+  state of its own. In plan mode each account writes a plan of its own, and
+  for a report event a spend report of its own. The accounts share the
+  configuration this invocation loaded.
+
+  The rosters are not read again if teams_by_user_id is given. The accounts
+  share the invocation's deadline, and the reconciled state is only kept
+  when the run finished before it.
+
+  Returns the handler result, with the changes made in all of the accounts
+  and the result of each account by account id
+  '''
+  if teams_by_user_id is None and targeted:
+    # the budgets may no longer match the last full check
+    store.delete(RECONCILED_STATE_KEY)
+    with timer.phase('roster'):
+      teams_by_user_id = get_target_users(event, store, team_timer)
+  elif teams_by_user_id is None:
+    teams_by_user_id = _read_rosters(store, timer, team_timer)
+  metrics.put_metric('Users', len(teams_by_user_id))
+
+  # verify that no users appear in multiple teams
+  if not targeted:
+    _warn_duplicates(store, teams_by_user_id)
+
+  account_ids = [account['account_id'] for account in configuration.accounts]
+  events = [
+    dict(event, account={'id': account_id, 'users': teams_by_user_id})
+    for account_id in account_ids
+  ]
+  with timer.phase('accounts'):
+    results = invoke_shards(LocalInvoker(lambda_handler, context), events)
+
+  if event.get('report'):
+    mode = 'report'
+  elif event.get('plan', configuration.plan_mode):
+    mode = 'plan'
+  else:
+    mode = 'run'
+  (result, counts, failed) = _combine_results(
+    'account',
+    account_ids,
+    results,
+    mode,
+    timer,
+    metrics
+  )
+  # past the deadline, accounts may have skipped budgets without deferring
+  # them, such as budgets whose fingerprints were not read
+  if full_run and not deadline.expired():
+    _save_reconciled_state(
+      store,
+      teams_by_user_id,
+      counts['failed'] + counts['deferred'] + failed,
+      run_start
+    )
+  result['accounts'] = dict(zip(account_ids, results))
+  return result
+
+
+def _add_suffix(path, suffix):
+  '''Adds a suffix to a file name, before its extension'''
+  (root, extension) = os.path.splitext(path)
+  return f'{root}{suffix}{extension}'
+
+
+def _find_changes(teams_by_user_id, shard, fingerprints, timer, metrics,
+    should_stop=None):
+  '''Finds the budgets to create, update and remove for the given users
+
+  The budgets are listed in the inventory phase, compared with the users in
+  the diff phase, and the fingerprints of the budgets that are kept are
+  checked in the drift phase, until should_stop returns True.
+
+  Returns the synapse ids without a budget, the synapse ids whose budgets
+  have drifted, and the synapse ids whose budgets should be removed
+  '''
+  with timer.phase('inventory'):
+    budget_user_ids = list_budget_user_ids(shard)
+  with timer.phase('diff'):
+    user_ids_without_budget, budgets_to_remove = compare_budgets_and_users(
+      teams_by_user_id.keys(),
+      shard,
+      budget_user_ids
+    )
+
+  with timer.phase('drift'):
+    users_with_budget = set(teams_by_user_id) - set(user_ids_without_budget)
+    budgets_to_update = find_drifted_budgets(
+      users_with_budget,
+      teams_by_user_id,
+      fingerprints,
+      configuration.budgets_max_workers,
+      should_stop
+    )
+  metrics.put_metric(
+    'BudgetsSeen',
+    len(users_with_budget) + len(budgets_to_remove)
+  )
+  return (user_ids_without_budget, budgets_to_update, budgets_to_remove)
+
+
+def _make_changes(user_ids_without_budget, budgets_to_update,
+    budgets_to_remove, teams_by_user_id, fingerprints, timer, should_stop):
+  '''Creates, updates and removes budgets, each in a phase of its own,
+  until should_stop returns True
+
+  Returns the BatchResults of the budgets created, updated and removed
+  '''
+  with timer.phase('create'):
+    budgets_created = create_budgets(
+      user_ids_without_budget,
+      teams_by_user_id,
+      configuration.budgets_max_workers,
+      fingerprints,
+      should_stop
+    )
+  with timer.phase('update'):
+    budgets_updated = update_budgets(
+      budgets_to_update,
+      teams_by_user_id,
+      configuration.budgets_max_workers,
+      fingerprints,
+      should_stop
+    )
+  with timer.phase('delete'):
+    budgets_removed = delete_budgets(
+      budgets_to_remove,
+      configuration.budgets_max_workers,
+      fingerprints,
+      should_stop
+    )
+  return (budgets_created, budgets_updated, budgets_removed)
+
+
+def _save_checkpoint(store, checkpoint_key, checkpoint, teams_by_user_id,
+    budgets_created, budgets_updated, budgets_removed):
+  '''Saves the changes a run was out of time for, or clears the checkpoint
+  the run resumed from when none are left
+
+  The teams of the users in the checkpoint the run resumed from are kept,
+  as the run may not have read their rosters.
+  '''
+  checkpoint_teams_by_user_id = {
+    synapse_id: [team_id]
+    for action in ['create', 'update']
+    for (synapse_id, team_id) in (checkpoint or {}).get(action, {}).items()
+  }
+  checkpoint_teams_by_user_id.update(teams_by_user_id or {})
+  new_checkpoint = get_checkpoint(
+    budgets_created,
+    budgets_updated,
+    budgets_removed,
+    checkpoint_teams_by_user_id
+  )
+  if new_checkpoint:
+    store.put(checkpoint_key, new_checkpoint)
+    log.warning(
+      'Budget maker run out of time; changes left for the next run: '
+      '%d to create, %d to update, %d to delete',
+      len(new_checkpoint['create']),
+      len(new_checkpoint['update']),
+      len(new_checkpoint['delete'])
+    )
+  elif checkpoint:
+    store.delete(checkpoint_key)
+
+
+def _check_unchanged(store, timer, team_timer, metrics, run_start):
+  '''Checks whether anything has changed since the last full check
+
+  The rosters are only read when the last full check is less than
+  FULL_CHECK_INTERVAL seconds old. Every roster is then fetched again, as a
+  snapshot would miss a member who joins a team as another leaves; the
+  snapshots are refreshed on the way.
+
+  Returns the users that were read, or None, and the handler result of a
+  skipped run, or None when the run goes on
+  '''
+  reconciled_state = store.get(RECONCILED_STATE_KEY)
+  if not (
+    reconciled_state and
+    run_start - reconciled_state['checked'] < configuration.full_check_interval
+  ):
+    return (None, None)
+  teams_by_user_id = _read_rosters(store, timer, team_timer, 0)
+  digest = get_state_digest(teams_by_user_id, configuration.fingerprint)
+  if digest != reconciled_state['digest']:
+    return (teams_by_user_id, None)
+
+  metrics.put_metric('Users', len(teams_by_user_id))
+  metrics.put_metric('Skipped', 1)
+  skipped_message = (
+    'Budget maker run skipped; nothing has changed since the last full check'
+  )
+  log.info(skipped_message)
+  return (teams_by_user_id, {'message': skipped_message})
+
+
+def _get_state_suffix(shard, account):
+  '''Returns the suffix of the state keys and files of a worker
+
+  Workers that run at the same time keep their state apart.
+  '''
+  if shard is not None:
+    return f'-{shard["index"]}-of-{shard["count"]}'
+  if account is not None:
+    return f'-{account["id"]}'
+  return ''
+
+
+def _write_run_plan(event, state_suffix, user_ids_without_budget,
+    budgets_to_update, budgets_to_remove, teams_by_user_id, timer):
+  '''Writes the plan of a run to the event's "plan_output", or PLAN_OUTPUT,
+  with state_suffix added to the file name
+
+  Returns the handler result
+  '''
+  plan_path = _add_suffix(
+    event.get('plan_output', configuration.plan_output),
+    state_suffix
+  )
+  counts = write_plan(
+    plan_path,
+    user_ids_without_budget,
+    budgets_to_update,
+    budgets_to_remove,
+    teams_by_user_id,
+    timer.timings
+  )
+  plan_message = (
+    f'Budget maker plan written to {plan_path}; '
+    f'{counts["create"]} to create, {counts["update"]} to update, '
+    f'{counts["delete"]} to delete'
+  )
+  log.info(plan_message)
+  return {
+    'message': plan_message,
+    'plan': {
+      'path': plan_path,
+      'counts': counts,
+      'timings': timer.timings
+    }
+  }
 
 
 def lambda_handler(event, context):
   '''Lambda event handler'''
-  log.debug(f'Event received: {json.dumps(event)}')
+  log.debug('Event received: %s', Lazy(to_json, event))
 
+  run_start = time.time()
+  # an account worker reconciles the budgets of one account of ACCOUNTS
+  account = event.get('account')
+  account_token = None
+  rate_limiter = budgets_rate_limiter
+  throttles_at_start = rate_limiter.throttles
+  timer = PhaseTimer()
+  team_timer = PhaseTimer()
+  metrics = MetricsLogger(
+    dimensions=None if account is None else {'Account': account['id']}
+  )
   try:
     global configuration
-    configuration = Config()
-    log.debug(f'Lambda configuration: {configuration}')
+    with timer.phase('config'):
+      # account workers share the configuration the coordinator loaded, so
+      # that every account of a run is reconciled under the same one
+      if account is None or configuration is None:
+        configuration = Config.load()
+    log.setLevel(configuration.log_level)
+    log.debug('Lambda configuration: %s', configuration)
+    clients.configure(
+      configuration.aws_max_pool_connections,
+      configuration.aws_retry_mode
+    )
+    # a shard worker invoked by a coordinator is given its share of the rate
+    budgets_rate_limiter.set_max_rate(
+      event.get('max_tps', configuration.budgets_max_tps)
+    )
+    if account is not None:
+      account_token = accounts.set_current(get_account(account['id']))
+      rate_limiter = accounts.get_current().rate_limiter
+      throttles_at_start = rate_limiter.throttles
+    # a shard worker also stops at the deadline of the coordinator
+    deadline = Deadline(
+      context,
+      configuration.deadline_reserve,
+      event.get('deadline')
+    )
 
-    # get users
+    store = get_state_store()
     teams = configuration.budget_rules['teams'].keys()
-    teams_by_user_id = get_users(teams)
+    plan_mode = event.get('plan', configuration.plan_mode)
+
+    # a report reads the budgets, and changes nothing
+    if event.get('report'):
+      if configuration.accounts and account is None:
+        return run_accounts(
+          event,
+          context,
+          store,
+          deadline,
+          timer,
+          team_timer,
+          metrics,
+          run_start,
+          targeted=False,
+          full_run=False
+        )
+      if account is None:
+        return run_spend_report(event, store, deadline, timer, team_timer, metrics)
+      return run_spend_report(
+        event,
+        store,
+        deadline,
+        timer,
+        team_timer,
+        metrics,
+        account['users'],
+        f'-{account["id"]}'
+      )
 
-    # verify that no users appear in multiple teams
-    duplicates = check_user_duplicates(teams_by_user_id)
-    if duplicates:
-      log.warn(f'One or more duplicate team memberships was found.\n{duplicates}')
+    targeted = any(key in event for key in TARGETED_EVENT_KEYS)
+    if targeted and plan_mode:
+      raise ValueError('Targeted events cannot be run in plan mode')
 
-    # check which user ids need a budget, and which budgets should be removed
-    user_ids_without_budget, budgets_to_remove = compare_budgets_and_users(
-      teams_by_user_id.keys()
+    # a shard worker is given its users, and only reconciles their budgets
+    shard = event.get('shard')
+    full_run = (
+      shard is None and
+      account is None and
+      not targeted and
+      not plan_mode
+    )
+
+    # skip the run when nothing has changed since the last full check
+    teams_by_user_id = None
+    if full_run and not event.get('full_check'):
+      (teams_by_user_id, skipped_result) = _check_unchanged(
+        store,
+        timer,
+        team_timer,
+        metrics,
+        run_start
+      )
+      if skipped_result is not None:
+        return skipped_result
+
+    if full_run and configuration.shard_count > 1:
+      return run_shards(
+        context,
+        store,
+        deadline,
+        timer,
+        team_timer,
+        metrics,
+        run_start,
+        teams_by_user_id
+      )
+    if configuration.accounts and account is None:
+      return run_accounts(
+        event,
+        context,
+        store,
+        deadline,
+        timer,
+        team_timer,
+        metrics,
+        run_start,
+        targeted,
+        full_run,
+        teams_by_user_id
+      )
+
+    state_suffix = _get_state_suffix(shard, account)
+    fingerprints = FingerprintIndex(
+      store,
+      f'{FINGERPRINT_INDEX_KEY}{state_suffix}'
+    )
+    checkpoint_key = f'{CHECKPOINT_KEY}{state_suffix}'
+
+    # first make the changes an earlier run was out of time for
+    checkpoint = None if plan_mode else store.get(checkpoint_key)
+    resumed = None
+    if checkpoint:
+      metrics.put_metric(
+        'Resumed',
+        sum(len(checkpoint[action]) for action in ['create', 'update', 'delete'])
+      )
+      with timer.phase('resume'):
+        resumed = resume_checkpoint(
+          checkpoint,
+          fingerprints,
+          configuration.budgets_max_workers,
+          deadline.expired
+        )
+    # a run with a checkpoint never has a reconciled state to keep, as the
+    # run that made the checkpoint cleared it
+    out_of_time = resumed is not None and deadline.expired()
+
+    if out_of_time:
+      # the rest of the run waits for the next run
+      (budgets_created, budgets_updated, budgets_removed) = (
+        BatchResult(),
+        BatchResult(),
+        BatchResult()
+      )
+
+    elif targeted:
+      # the budgets may no longer match the last full check
+      store.delete(RECONCILED_STATE_KEY)
+
+      # only touch the budgets of the users named by the event
+      if account is not None:
+        teams_by_user_id = account['users']
+      else:
+        with timer.phase('roster'):
+          teams_by_user_id = get_target_users(event, store, team_timer)
+      metrics.put_metric('Users', len(teams_by_user_id))
+      with timer.phase('reconcile'):
+        (
+          budgets_created,
+          budgets_updated,
+          budgets_removed
+        ) = reconcile_users(
+          teams_by_user_id,
+          fingerprints,
+          configuration.budgets_max_workers,
+          deadline.expired
+        )
+
+    elif (
+      configuration.engine == 'async' and
+      shard is None and
+      account is None and
+      not plan_mode
+    ):
+      # read rosters and inventory at the same time, and change budgets as
+      # the differences are found; asyncio is only imported by this engine
+      import asyncio
+      with timer.phase('reconcile'):
+        (
+          teams_by_user_id,
+          budgets_seen,
+          budgets_created,
+          budgets_updated,
+          budgets_removed
+        ) = asyncio.run(reconcile_async(
+          teams,
+          store,
+          fingerprints,
+          timer,
+          team_timer,
+          deadline.expired,
+          # rosters read to check for changes are not read again
+          teams_by_user_id
+        ))
+      metrics.put_metric('Users', len(teams_by_user_id))
+      metrics.put_metric('BudgetsSeen', budgets_seen)
+
+      # verify that no users appear in multiple teams
+      _warn_duplicates(store, teams_by_user_id)
+
+    else:
+      # get users, unless they were read to check for changes
+      if shard is not None:
+        teams_by_user_id = shard['users']
+      elif account is not None:
+        teams_by_user_id = account['users']
+      elif teams_by_user_id is None:
+        teams_by_user_id = _read_rosters(store, timer, team_timer)
+      metrics.put_metric('Users', len(teams_by_user_id))
+
+      # verify that no users appear in multiple teams, unless the shards or
+      # accounts coordinator already has
+      if shard is None and account is None:
+        _warn_duplicates(store, teams_by_user_id)
+
+      # a plan reads every fingerprint, as it makes no changes to defer
+      (
+        user_ids_without_budget,
+        budgets_to_update,
+        budgets_to_remove
+      ) = _find_changes(
+        teams_by_user_id,
+        shard,
+        fingerprints,
+        timer,
+        metrics,
+        None if plan_mode else deadline.expired
+      )
+
+      # in plan mode, report the changes instead of making them
+      if plan_mode:
+        fingerprints.save()
+        return _write_run_plan(
+          event,
+          state_suffix,
+          user_ids_without_budget,
+          budgets_to_update,
+          budgets_to_remove,
+          teams_by_user_id,
+          timer
+        )
+
+      (budgets_created, budgets_updated, budgets_removed) = _make_changes(
+        user_ids_without_budget,
+        budgets_to_update,
+        budgets_to_remove,
+        teams_by_user_id,
+        fingerprints,
+        timer,
+        deadline.expired
+      )
+
+    if resumed is not None:
+      budgets_created = resumed[0].extend(budgets_created)
+      budgets_updated = resumed[1].extend(budgets_updated)
+      budgets_removed = resumed[2].extend(budgets_removed)
+
+    # save the changes this run was out of time for, or clear the checkpoint
+    _save_checkpoint(
+      store,
+      checkpoint_key,
+      checkpoint,
+      teams_by_user_id,
+      budgets_created,
+      budgets_updated,
+      budgets_removed
     )
 
-    # create budgets, if applicable
-    budgets_created_message = create_budgets(user_ids_without_budget, teams_by_user_id)
+    run_result = RunResult(
+      {
+        'created': budgets_created,
+        'updated': budgets_updated,
+        'removed': budgets_removed
+      },
+      timer.timings
+    )
+    failures = [
+      (action, synapse_id, error)
+      for (action, batch) in run_result.batches.items()
+      for (synapse_id, error) in batch.failed.items()
+    ]
+    for (action, synapse_id, error) in failures[:SAMPLE_SIZE]:
+      log.error('Budget %s failed for synapse id %s: %s', action, synapse_id, error)
+    if len(failures) > SAMPLE_SIZE:
+      log.error('%d more budget changes failed', len(failures) - SAMPLE_SIZE)
 
-    # remove budgets, if applicable
-    budgets_removed_message = delete_budgets(budgets_to_remove)
+    fingerprints.save()
 
-    success_message = 'Budget maker run complete'
-    if budgets_created_message:
-      success_message = f'{success_message}; {budgets_created_message}'
-    if budgets_removed_message:
-      success_message = f'{success_message}; {budgets_removed_message}'
+    counts = run_result.counts()
+    metrics.put_metric('Created', counts['created'])
+    metrics.put_metric('Updated', counts['updated'])
+    metrics.put_metric('Deleted', counts['removed'])
+    metrics.put_metric('Failed', counts['failed'])
+    metrics.put_metric('Deferred', counts['deferred'])
 
+    # past the deadline, budgets may have been skipped without being deferred,
+    # such as budgets whose fingerprints were not read
+    if full_run and not deadline.expired():
+      _save_reconciled_state(
+        store,
+        teams_by_user_id,
+        counts['failed'] + counts['deferred'],
+        run_start
+      )
+
+    success_message = '; '.join([
+      'Budget maker run complete',
+      budgets_created.summary('created'),
+      budgets_updated.summary('updated'),
+      budgets_removed.summary('removed')
+    ])
     log.info(success_message)
 
-    return {
-      'message': success_message
-    }
+    result = dict(run_result.summary(), message=success_message)
+    result_output = event.get('result_output', configuration.result_output)
+    if result_output:
+      # workers run at the same time, so each writes a file of its own
+      result_output = _add_suffix(result_output, state_suffix)
+      run_result.write(result_output)
+      result['output'] = result_output
+    return result
 
   except Exception as e:
     log.error(e, exc_info=True)
+    metrics.put_metric('Errors', 1)
 
     return {
       'error': str(e)
     }
+
+  finally:
+    metrics.put_metric(
+      'BudgetsRate',
+      round(rate_limiter.rate, 3),
+      unit='Count/Second'
+    )
+    metrics.put_metric(
+      'BudgetsThrottles',
+      rate_limiter.throttles - throttles_at_start
+    )
+    metrics.put_timings(timer.timings)
+    for (team_id, seconds) in team_timer.timings.items():
+      metrics.put_timings({'roster': seconds}, dimensions={'Team': team_id})
+    metrics.flush()
+    if account_token is not None:
+      accounts.reset(account_token)
+
+
+try:
+  if Config._get_bool_env_var('PRIME_ON_INIT'):
+    prime()
+except Exception as e:
+  # the first invocation reports the error, and pays the cost instead
+  log.warning('Priming failed: %s', e)
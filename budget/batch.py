@@ -0,0 +1,197 @@
+import contextvars
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from budget.logs import SAMPLE_SIZE
+
+
+def _join(items):
+  '''Joins items with commas, showing at most SAMPLE_SIZE of them'''
+  items = list(items)
+  joined = ', '.join(items[:SAMPLE_SIZE])
+  if len(items) > SAMPLE_SIZE:
+    joined = f'{joined} and {len(items) - SAMPLE_SIZE} more'
+  return joined
+
+
+class BatchResult:
+  '''Per-item outcome of a batch of budget changes
+
+  Items are synapse ids. Succeeded and unchanged ids are kept in the order
+  they were submitted; unchanged ids were already in the wanted state, such
+  as a budget that was already gone when it was deleted. Failed ids map to
+  the exception that was raised for them. Deferred ids were not tried, as
+  the run was out of time.
+  '''
+
+  def __init__(self):
+    self.succeeded = []
+    self.unchanged = []
+    self.failed = {}
+    self.deferred = []
+
+
+  def extend(self, other):
+    '''Adds the outcomes of another batch to this one, and returns it'''
+    self.succeeded.extend(other.succeeded)
+    self.unchanged.extend(other.unchanged)
+    self.failed.update(other.failed)
+    self.deferred.extend(other.deferred)
+    return self
+
+
+  def summary(self, action):
+    '''Describes the batch, e.g. "Budgets created for synapse ids: 123"
+
+    Only the first few synapse ids of each outcome are listed, followed by
+    the number of the others.
+    '''
+    message = (
+      f'Budgets {action} for synapse ids: '
+      f'{"none" if not self.succeeded else _join(self.succeeded)}'
+    )
+    if self.unchanged:
+      message = (
+        f'{message}; Budgets already {action} for synapse ids: '
+        f'{_join(self.unchanged)}'
+      )
+    if self.failed:
+      failures = _join(
+        f'{item} ({error})' for (item, error) in self.failed.items()
+      )
+      message = f'{message}; Budgets not {action} for synapse ids: {failures}'
+    if self.deferred:
+      message = (
+        f'{message}; Budgets left to be {action} by the next run: '
+        f'{len(self.deferred)}'
+      )
+    return message
+
+
+class RunResult:
+  '''The outcome of a run, with a size that does not depend on the run's
+
+  batches maps each action, "created", "updated" and "removed", to the
+  BatchResult of that action. summary() only counts the synapse ids of each
+  outcome and lists the first few of them, so the handler's response stays
+  the same size however many budgets a run changes; write() writes every
+  synapse id to a file instead.
+  '''
+
+  def __init__(self, batches, timings):
+    self.batches = batches
+    self.timings = timings
+
+
+  def counts(self):
+    '''The number of budgets of each action that succeeded, and the number
+    of changes that failed and that were deferred, over all actions
+    '''
+    counts = {
+      action: len(batch.succeeded) for (action, batch) in self.batches.items()
+    }
+    counts['failed'] = sum(len(batch.failed) for batch in self.batches.values())
+    counts['deferred'] = sum(
+      len(batch.deferred) for batch in self.batches.values()
+    )
+    return counts
+
+
+  def summary(self, sample_size=SAMPLE_SIZE):
+    '''Returns the counts, the phase timings in seconds, and up to
+    sample_size synapse ids of each action and outcome
+    '''
+    samples = {}
+    for (action, batch) in self.batches.items():
+      sample = {
+        'succeeded': batch.succeeded[:sample_size],
+        'unchanged': batch.unchanged[:sample_size],
+        'failed': {
+          item: str(batch.failed[item])
+          for item in list(batch.failed)[:sample_size]
+        },
+        'deferred': batch.deferred[:sample_size]
+      }
+      samples[action] = {
+        outcome: items for (outcome, items) in sample.items() if items
+      }
+    return {
+      'counts': self.counts(),
+      'timings': {
+        phase: round(seconds, 3) for (phase, seconds) in self.timings.items()
+      },
+      'samples': samples
+    }
+
+
+  def write(self, path):
+    '''Writes every synapse id of the run to a file as JSON Lines
+
+    Each line is one synapse id, for example
+    {"action": "created", "outcome": "failed", "synapse_id": "3388489",
+    "error": "..."}, and the last line holds the counts and timings.
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+      for (action, batch) in self.batches.items():
+        for (outcome, items) in [
+          ('succeeded', batch.succeeded),
+          ('unchanged', batch.unchanged),
+          ('failed', batch.failed),
+          ('deferred', batch.deferred)
+        ]:
+          for item in items:
+            record = {'action': action, 'outcome': outcome, 'synapse_id': item}
+            if outcome == 'failed':
+              record['error'] = str(batch.failed[item])
+            f.write(json.dumps(record) + '\n')
+      summary = self.summary()
+      f.write(json.dumps({
+        'counts': summary['counts'],
+        'timings': summary['timings']
+      }) + '\n')
+
+
+# returned for an item that was not tried because the batch was stopped
+_DEFERRED = object()
+
+
+def run_batch(func, items, max_workers, should_stop=None):
+  '''Calls func once for each item on a bounded thread pool
+
+  An exception raised for one item is recorded against that item and does
+  not stop the rest of the batch. func returns False for an item that was
+  already in the wanted state and needed no change. Once should_stop, if
+  given, returns True, the items that have not been started are deferred
+  instead of being passed to func. func runs with the caller's context
+  variables, such as the account being reconciled.
+  '''
+  items = list(items)
+  result = BatchResult()
+  if not items:
+    return result
+
+  def call(item):
+    if should_stop is not None and should_stop():
+      return _DEFERRED
+    return func(item)
+
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+    futures = [
+      executor.submit(contextvars.copy_context().run, call, item)
+      for item in items
+    ]
+    for item, future in zip(items, futures):
+      try:
+        changed = future.result()
+      except Exception as e:
+        result.failed[item] = e
+      else:
+        if changed is _DEFERRED:
+          result.deferred.append(item)
+        elif changed is False:
+          result.unchanged.append(item)
+        else:
+          result.succeeded.append(item)
+  return result
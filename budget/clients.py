@@ -0,0 +1,210 @@
+import os
+import threading
+
+from budget.config import (
+  DEFAULT_AWS_MAX_POOL_CONNECTIONS,
+  DEFAULT_AWS_RETRY_MODE
+)
+
+SYNAPSE_CACHE_ROOT_DIR = '/tmp/.synapseCache'
+ROLE_SESSION_NAME = 'lambda-budgets'
+
+# AWS clients are kept for the life of the process, so that warm invocations
+# reuse the loaded service models and the open keep-alive connections.
+# boto3 and synapseclient are only imported when the first client is made,
+# as importing them is a large part of a cold start.
+_lock = threading.Lock()
+_session = None
+# sessions with the credentials of assumed roles, by role ARN
+_role_sessions = {}
+# clients by service and role ARN, where a role of None is the lambda's own
+_clients = {}
+_injected_clients = {}
+_synapse_client = None
+_client_settings = {
+  'max_pool_connections': DEFAULT_AWS_MAX_POOL_CONNECTIONS,
+  'retry_mode': DEFAULT_AWS_RETRY_MODE
+}
+
+
+def configure(max_pool_connections, retry_mode):
+  '''Sets the connection pool size and retry mode used by new clients
+
+  The pool should be at least as large as the number of threads sharing a
+  client. Clients made with different settings are dropped, and made again
+  on their next use; clients registered with set_client are kept.
+  '''
+  settings = {
+    'max_pool_connections': max_pool_connections,
+    'retry_mode': retry_mode
+  }
+  with _lock:
+    if _client_settings == settings:
+      return
+    _client_settings.update(settings)
+    _clients.clear()
+
+
+def get_client(service, role_arn=None):
+  '''Returns the shared client for an AWS service
+
+  With a role_arn, the client uses the credentials of that role, as for a
+  service of another account. The role is assumed on the client's first
+  call, and again shortly before its credentials expire.
+  '''
+  global _session
+  key = (service, role_arn)
+  with _lock:
+    client = _injected_clients.get(key) or _clients.get(key)
+    if client is None:
+      import boto3
+      from botocore.config import Config as BotoConfig
+      if _session is None:
+        _session = boto3.session.Session()
+      session = _session if role_arn is None else _get_role_session(role_arn)
+      client = session.client(service, config=BotoConfig(
+        max_pool_connections=_client_settings['max_pool_connections'],
+        retries={'mode': _client_settings['retry_mode']},
+        tcp_keepalive=True
+      ))
+      _clients[key] = client
+    return client
+
+
+def set_client(service, client, role_arn=None):
+  '''Registers the client returned for a service, such as a stubbed client,
+  optionally for the service as used with a role_arn
+  '''
+  with _lock:
+    _injected_clients[(service, role_arn)] = client
+
+
+def _get_role_session(role_arn):
+  # called with the lock held, after the lambda's own session is made
+  session = _role_sessions.get(role_arn)
+  if session is None:
+    import boto3
+    from botocore.credentials import DeferredRefreshableCredentials
+    from botocore.session import get_session
+    sts = _session.client('sts')
+
+    def assume_role():
+      credentials = sts.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName=ROLE_SESSION_NAME
+      )['Credentials']
+      return {
+        'access_key': credentials['AccessKeyId'],
+        'secret_key': credentials['SecretAccessKey'],
+        'token': credentials['SessionToken'],
+        'expiry_time': credentials['Expiration'].isoformat()
+      }
+
+    botocore_session = get_session()
+    botocore_session._credentials = DeferredRefreshableCredentials(
+      refresh_using=assume_role,
+      method='sts-assume-role'
+    )
+    session = boto3.session.Session(botocore_session=botocore_session)
+    _role_sessions[role_arn] = session
+  return session
+
+
+def get_synapse_client():
+  '''Returns the shared Synapse client
+
+  The client logs in with a personal access token when one is available,
+  from the SYNAPSE_AUTH_TOKEN environment variable or from the file named by
+  SYNAPSE_AUTH_TOKEN_FILE, so that it gets authenticated rate limits.
+  Without a token it stays anonymous.
+  '''
+  global _synapse_client
+  with _lock:
+    if _synapse_client is None:
+      synapseclient = import_synapseclient()
+      syn = synapseclient.Synapse(skip_checks=True, silent=True)
+      auth_token = _get_synapse_auth_token()
+      if auth_token:
+        syn.login(authToken=auth_token, silent=True)
+      _synapse_client = syn
+    return _synapse_client
+
+
+def import_synapseclient():
+  '''Imports and returns the synapseclient module
+
+  The Synapse file cache is moved to /tmp, the only writable directory in
+  Lambda, before the module is used.
+  '''
+  import synapseclient
+  synapseclient.core.cache.CACHE_ROOT_DIR = SYNAPSE_CACHE_ROOT_DIR
+  return synapseclient
+
+
+def set_synapse_client(syn):
+  '''Registers the shared Synapse client, such as a fake client
+
+  The registered client is used until it fails authentication or reset()
+  is called.
+  '''
+  global _synapse_client
+  with _lock:
+    _synapse_client = syn
+
+
+def call_synapse(func):
+  '''Calls func with the shared Synapse client
+
+  If Synapse rejects the client's credentials, for example because its
+  session has expired, the client is made again and func is retried once.
+  '''
+  syn = get_synapse_client()
+  try:
+    return func(syn)
+  except Exception as e:
+    if not _is_authentication_error(e):
+      raise
+    _drop_synapse_client(syn)
+    return func(get_synapse_client())
+
+
+def _get_synapse_auth_token():
+  auth_token = os.getenv('SYNAPSE_AUTH_TOKEN')
+  auth_token_file = os.getenv('SYNAPSE_AUTH_TOKEN_FILE')
+  if not auth_token and auth_token_file:
+    with open(auth_token_file) as f:
+      auth_token = f.read().strip()
+  return auth_token
+
+
+def _is_authentication_error(error):
+  from synapseclient.core.exceptions import (
+    SynapseAuthenticationError,
+    SynapseHTTPError
+  )
+  if isinstance(error, SynapseAuthenticationError):
+    return True
+  return (
+    isinstance(error, SynapseHTTPError) and
+    error.response is not None and
+    error.response.status_code == 401
+  )
+
+
+def _drop_synapse_client(syn):
+  global _synapse_client
+  with _lock:
+    # another thread may already have replaced the failed client
+    if _synapse_client is syn:
+      _synapse_client = None
+
+
+def reset():
+  '''Drops all clients, including registered ones, and the session'''
+  global _session, _synapse_client
+  with _lock:
+    _clients.clear()
+    _injected_clients.clear()
+    _role_sessions.clear()
+    _session = None
+    _synapse_client = None
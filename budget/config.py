@@ -1,8 +1,29 @@
+import hashlib
 import os
 from pathlib import Path
 
-from cerberus import Validator
-import yaml
+from budget.logs import to_json
+from budget.rules import get_rules_source
+
+DEFAULT_SYNAPSE_MAX_WORKERS = 8
+DEFAULT_BUDGETS_MAX_WORKERS = 4
+DEFAULT_BUDGETS_MAX_TPS = 5
+DEFAULT_STATE_DIR = '/tmp/lambda-budgets'
+DEFAULT_TEAM_SNAPSHOT_MAX_AGE = 3600
+DEFAULT_FULL_CHECK_INTERVAL = 3600
+DEFAULT_AWS_MAX_POOL_CONNECTIONS = 10
+DEFAULT_AWS_RETRY_MODE = 'standard'
+AWS_RETRY_MODES = ['legacy', 'standard', 'adaptive']
+DEFAULT_ENGINE = 'threads'
+ENGINES = ['threads', 'async']
+DEFAULT_SHARD_COUNT = 1
+DEFAULT_SHARD_INVOCATION = 'lambda'
+SHARD_INVOCATIONS = ['lambda', 'local']
+DEFAULT_DEADLINE_RESERVE = 5
+DEFAULT_REPORT_FORMAT = 'csv'
+REPORT_FORMATS = ['csv', 'jsonl']
+DEFAULT_LOG_LEVEL = 'INFO'
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
 
 class Config:
 
@@ -57,17 +78,185 @@ class Config:
   }
 
 
+  _accounts_schema = {
+    'accounts': {
+      'type': 'list',
+      'minlength': 1,
+      'schema': {
+        'type': 'dict',
+        'schema': {
+          'account_id': {
+            'type': 'string',
+            'required': True,
+            # yaml reads an unquoted account id as a number
+            'coerce': str,
+            'regex': '[0-9]{12}'
+          },
+          'role_arn': {
+            'type': 'string'
+          },
+          'end_user_role_name': {
+            'type': 'string'
+          },
+          'notification_topic_arn': {
+            'type': 'string'
+          }
+        }
+      }
+    }
+  }
+
+
+  # every environment variable the configuration is read from
+  _env_var_names = (
+    'AWS_ACCOUNT_ID',
+    'NOTIFICATION_TOPIC_ARN',
+    'END_USER_ROLE_NAME',
+    'SYNAPSE_MAX_WORKERS',
+    'BUDGETS_MAX_WORKERS',
+    'BUDGETS_MAX_TPS',
+    'AWS_MAX_POOL_CONNECTIONS',
+    'AWS_RETRY_MODE',
+    'STATE_DIR',
+    'TEAM_SNAPSHOT_MAX_AGE',
+    'FULL_CHECK_INTERVAL',
+    'ENGINE',
+    'SHARD_COUNT',
+    'SHARD_INVOCATION',
+    'DEADLINE_RESERVE',
+    'PLAN_MODE',
+    'PLAN_OUTPUT',
+    'REPORT_FORMAT',
+    'REPORT_OUTPUT',
+    'LOG_LEVEL',
+    'RESULT_OUTPUT',
+    'BUDGET_RULES',
+    'BUDGET_RULES_SOURCE',
+    'THRESHOLDS',
+    'ACCOUNTS'
+  )
+
+  # the most recently loaded configuration, kept between warm invocations
+  _cached = None
+
+  # Cerberus validators, compiled once per schema
+  _validators = {}
+
+  # budget rules sources by URL, which remember the version last read
+  _budget_rules_sources = {}
+
+
   def __init__(self):
 
     self._account_id = Config._get_env_var('AWS_ACCOUNT_ID')
     self._notification_topic_arn = Config._get_env_var('NOTIFICATION_TOPIC_ARN')
     self._end_user_role_name = Config._get_env_var('END_USER_ROLE_NAME')
+    self._synapse_max_workers = Config._get_int_env_var(
+      'SYNAPSE_MAX_WORKERS',
+      DEFAULT_SYNAPSE_MAX_WORKERS
+      )
+    self._budgets_max_workers = Config._get_int_env_var(
+      'BUDGETS_MAX_WORKERS',
+      DEFAULT_BUDGETS_MAX_WORKERS
+      )
+    self._budgets_max_tps = Config._get_int_env_var(
+      'BUDGETS_MAX_TPS',
+      DEFAULT_BUDGETS_MAX_TPS
+      )
+    self._aws_retry_mode = os.getenv('AWS_RETRY_MODE') or DEFAULT_AWS_RETRY_MODE
+    if self._aws_retry_mode not in AWS_RETRY_MODES:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable AWS_RETRY_MODE must be one of {AWS_RETRY_MODES}'))
+    self._state_dir = os.getenv('STATE_DIR') or DEFAULT_STATE_DIR
+    self._team_snapshot_max_age = Config._get_int_env_var(
+      'TEAM_SNAPSHOT_MAX_AGE',
+      DEFAULT_TEAM_SNAPSHOT_MAX_AGE
+      )
+    self._full_check_interval = Config._get_int_env_var(
+      'FULL_CHECK_INTERVAL',
+      DEFAULT_FULL_CHECK_INTERVAL
+      )
+    self._engine = os.getenv('ENGINE') or DEFAULT_ENGINE
+    if self._engine not in ENGINES:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable ENGINE must be one of {ENGINES}'))
+    # every budgets worker thread needs its own pooled connection; the async
+    # engine's mutation workers, drift check workers and planner thread all
+    # share the client at the same time
+    if self._engine == 'async':
+      pooled_threads = 2 * self._budgets_max_workers + 1
+    else:
+      pooled_threads = self._budgets_max_workers
+    self._aws_max_pool_connections = Config._get_int_env_var(
+      'AWS_MAX_POOL_CONNECTIONS',
+      max(DEFAULT_AWS_MAX_POOL_CONNECTIONS, pooled_threads)
+      )
+    self._shard_count = Config._get_int_env_var(
+      'SHARD_COUNT',
+      DEFAULT_SHARD_COUNT
+      )
+    self._shard_invocation = (
+      os.getenv('SHARD_INVOCATION') or DEFAULT_SHARD_INVOCATION
+    )
+    if self._shard_invocation not in SHARD_INVOCATIONS:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable SHARD_INVOCATION must be one of {SHARD_INVOCATIONS}'))
+    self._deadline_reserve = Config._get_int_env_var(
+      'DEADLINE_RESERVE',
+      DEFAULT_DEADLINE_RESERVE
+      )
+    self._plan_mode = Config._get_bool_env_var('PLAN_MODE')
+    self._plan_output = (
+      os.getenv('PLAN_OUTPUT') or os.path.join(self._state_dir, 'plan.jsonl')
+    )
+    self._report_format = os.getenv('REPORT_FORMAT') or DEFAULT_REPORT_FORMAT
+    if self._report_format not in REPORT_FORMATS:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable REPORT_FORMAT must be one of {REPORT_FORMATS}'))
+    self._report_output = os.getenv('REPORT_OUTPUT') or os.path.join(
+      self._state_dir,
+      f'spend-report.{self._report_format}'
+    )
+    self._result_output = os.getenv('RESULT_OUTPUT') or None
+    self._log_level = (os.getenv('LOG_LEVEL') or DEFAULT_LOG_LEVEL).upper()
+    if self._log_level not in LOG_LEVELS:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable LOG_LEVEL must be one of {LOG_LEVELS}'))
     self.budget_rules = Config._load_budget_rules()
     self.thresholds = Config._load_thresholds()
+    self._accounts = self._load_accounts()
+    self._fingerprint = Config._get_fingerprint()
 
 
   def __str__(self):
-    return str(self.__dict__)
+    # long lists, such as the teams in the budget rules, are summarized
+    return to_json(self.__dict__)
+
+
+  @classmethod
+  def load(cls):
+    '''Returns the validated configuration for the current environment
+
+    The configuration is kept between invocations of a warm container, and
+    is only read, parsed and validated again when the environment variables
+    it is built from, or the budget rules read from BUDGET_RULES_SOURCE,
+    have changed. The rules source is checked on every load, with a
+    conditional fetch that only downloads rules that have changed.
+    '''
+    source = cls._get_budget_rules_source()
+    if source is not None:
+      source.fetch()
+    if cls._cached is None or cls._cached.fingerprint != cls._get_fingerprint():
+      cls._cached = cls()
+    return cls._cached
+
+
+  @property
+  def fingerprint(self):
+    '''A hash of the environment variables the configuration was read from,
+    and of the version of the budget rules source, if there is one
+    '''
+    return self._fingerprint
 
 
   @property
@@ -96,6 +285,141 @@ class Config:
     return self._end_user_role_name
 
 
+  @property
+  def synapse_max_workers(self):
+    '''Maximum number of Synapse team rosters fetched at the same time'''
+    return self._synapse_max_workers
+
+
+  @property
+  def budgets_max_workers(self):
+    '''Maximum number of AWS budgets changed at the same time'''
+    return self._budgets_max_workers
+
+
+  @property
+  def budgets_max_tps(self):
+    '''Maximum number of AWS Budgets API calls made per second'''
+    return self._budgets_max_tps
+
+
+  @property
+  def aws_max_pool_connections(self):
+    '''Size of the connection pool of each AWS client'''
+    return self._aws_max_pool_connections
+
+
+  @property
+  def aws_retry_mode(self):
+    '''The botocore retry mode used by AWS clients'''
+    return self._aws_retry_mode
+
+
+  @property
+  def state_dir(self):
+    '''Directory of the state kept between invocations'''
+    return self._state_dir
+
+
+  @property
+  def team_snapshot_max_age(self):
+    '''Seconds before a team roster snapshot is refreshed regardless
+
+    A snapshot is refreshed sooner when the team's member count changes.
+    '''
+    return self._team_snapshot_max_age
+
+
+  @property
+  def full_check_interval(self):
+    '''Seconds after which a run checks every budget, even if nothing
+    seems to have changed since the last run
+    '''
+    return self._full_check_interval
+
+
+  @property
+  def engine(self):
+    '''The reconciliation engine, either "threads" or "async"'''
+    return self._engine
+
+
+  @property
+  def shard_count(self):
+    '''Number of shards the users are split into, each reconciled by its own
+    invocation; 1 reconciles every user in one invocation
+    '''
+    return self._shard_count
+
+
+  @property
+  def shard_invocation(self):
+    '''How shards are run: "lambda" invokes this function once per shard,
+    and "local" calls the handler in the same process
+    '''
+    return self._shard_invocation
+
+
+  @property
+  def deadline_reserve(self):
+    '''Seconds before the invocation times out at which budget changes stop,
+    and the remaining changes are saved for the next run
+    '''
+    return self._deadline_reserve
+
+
+  @property
+  def plan_mode(self):
+    '''Whether runs only write a plan of the changes they would make'''
+    return self._plan_mode
+
+
+  @property
+  def plan_output(self):
+    '''Path of the JSON Lines file that plans are written to'''
+    return self._plan_output
+
+
+  @property
+  def report_format(self):
+    '''Format of spend reports, either "csv" or "jsonl"'''
+    return self._report_format
+
+
+  @property
+  def report_output(self):
+    '''Path of the file that spend reports are written to'''
+    return self._report_output
+
+
+  @property
+  def result_output(self):
+    '''Path of the JSON Lines file that every synapse id a run changed is
+    written to, or None to not write one
+    '''
+    return self._result_output
+
+
+  @property
+  def log_level(self):
+    '''The level of the messages the lambda logs, such as "INFO"'''
+    return self._log_level
+
+
+  @property
+  def accounts(self):
+    '''The AWS accounts whose budgets are reconciled, from ACCOUNTS
+
+    A list of dictionaries with the keys account_id, role_arn,
+    end_user_role_name and notification_topic_arn, where role_arn is the
+    role assumed to manage the account's budgets, or None to use the
+    lambda's own credentials; the end user role name and notification topic
+    default to the lambda's own. The list is empty when ACCOUNTS is not set,
+    and only the lambda's own account is reconciled.
+    '''
+    return self._accounts
+
+
   @property
   def budget_rules(self):
     '''A dictionary containing the rules that are used for budget creation.
@@ -131,6 +455,27 @@ class Config:
     self._thresholds = candidate_thresholds
 
 
+  def _get_fingerprint():
+    digest = hashlib.sha256()
+    for name in Config._env_var_names:
+      digest.update(f'{name}={os.getenv(name)}\0'.encode())
+    source = Config._get_budget_rules_source()
+    if source is not None:
+      digest.update(f'budget_rules_version={source.version}\0'.encode())
+    return digest.hexdigest()
+
+
+  def _get_budget_rules_source():
+    url = os.getenv('BUDGET_RULES_SOURCE')
+    if not url:
+      return None
+    source = Config._budget_rules_sources.get(url)
+    if source is None:
+      source = get_rules_source(url)
+      Config._budget_rules_sources[url] = source
+    return source
+
+
   def _get_env_var(name):
     value = os.getenv(name)
     if not value:
@@ -139,7 +484,31 @@ class Config:
     return value
 
 
+  def _get_int_env_var(name, default):
+    value = os.getenv(name)
+    if not value:
+      return default
+    try:
+      number = int(value)
+    except ValueError:
+      number = 0
+    if number < 1:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable {name} must be a positive integer'))
+    return number
+
+
+  def _get_bool_env_var(name):
+    value = os.getenv(name) or 'false'
+    if value.lower() not in ['true', 'false']:
+      raise ValueError(('Lambda configuration error: '
+        f'environment variable {name} must be true or false'))
+    return value.lower() == 'true'
+
+
   def _load_yaml(yaml_string, config_name=None):
+    # imported on first use, to keep it out of the cold start of the lambda
+    import yaml
     try:
       output = yaml.safe_load(yaml_string)
     except yaml.YAMLError as e:
@@ -152,10 +521,47 @@ class Config:
 
 
   def _load_budget_rules():
-    return Config._load_yaml(
-      Config._get_env_var('BUDGET_RULES'),
-      'budget_rules'
-      )
+    source = Config._get_budget_rules_source()
+    if source is None:
+      return Config._load_yaml(
+        Config._get_env_var('BUDGET_RULES'),
+        'budget_rules'
+        )
+    if source.text is None:
+      source.fetch()
+    return Config._load_yaml(source.text, f'budget_rules from {source}')
+
+
+  def _load_accounts(self):
+    value = os.getenv('ACCOUNTS')
+    if not value:
+      return []
+    accounts = Config._validate_config(
+      self._accounts_schema,
+      {'accounts': Config._load_yaml(value, 'accounts')}
+      )['accounts']
+    account_ids = [account['account_id'] for account in accounts]
+    if len(set(account_ids)) < len(account_ids):
+      raise ValueError(('Lambda configuration error: '
+        'environment variable ACCOUNTS lists an account more than once'))
+    if self._shard_count > 1:
+      raise ValueError(('Lambda configuration error: '
+        'environment variables ACCOUNTS and SHARD_COUNT cannot be used together'))
+    return [
+      {
+        'account_id': account['account_id'],
+        'role_arn': account.get('role_arn'),
+        'end_user_role_name': account.get(
+          'end_user_role_name',
+          self._end_user_role_name
+          ),
+        'notification_topic_arn': account.get(
+          'notification_topic_arn',
+          self._notification_topic_arn
+          )
+      }
+      for account in accounts
+    ]
 
 
   def _load_thresholds():
@@ -164,9 +570,19 @@ class Config:
       'thresholds'
       )
 
+  def _get_validator(schema):
+    validator = Config._validators.get(id(schema))
+    if validator is None:
+      from cerberus import Validator
+      validator = Validator(schema)
+      Config._validators[id(schema)] = validator
+    return validator
+
   def _validate_config(schema, config):
-    validator = Validator(schema)
+    validator = Config._get_validator(schema)
     valid = validator.validate(config)
     if not valid:
       raise Exception(f'There was a configuration validation error: '
         f'{validator.errors}. Configuration submitted: {config}')
+    # the configuration as normalized by the schema, such as coerced types
+    return validator.document
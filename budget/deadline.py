@@ -0,0 +1,38 @@
+import time
+
+
+class Deadline:
+  '''The time by which an invocation stops starting budget changes
+
+  Lambda stops an invocation as soon as it times out, so the deadline is
+  `reserve` seconds before the timeout, which leaves time for the changes
+  already under way to finish and for the rest to be saved. The time left
+  is read from the lambda context; without one, as when the handler is
+  called directly, the deadline never passes. not_after, a Unix time such as
+  the deadline of the invocation that started this one, brings the
+  deadline forward to that time if it is sooner.
+  '''
+
+  def __init__(self, context, reserve, not_after=None):
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+      self._expires = None
+    else:
+      self._expires = time.monotonic() + get_remaining_time() / 1000 - reserve
+    if not_after is not None:
+      # Unix time can be compared between invocations, unlike monotonic time
+      expires = time.monotonic() + not_after - time.time()
+      if self._expires is None or expires < self._expires:
+        self._expires = expires
+
+
+  def expired(self):
+    '''Whether the deadline has passed'''
+    return self._expires is not None and time.monotonic() >= self._expires
+
+
+  def timestamp(self):
+    '''The deadline as a Unix time, or None if it never passes'''
+    if self._expires is None:
+      return None
+    return time.time() + self._expires - time.monotonic()
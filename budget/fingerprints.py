@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+
+# tag on each budget holding the fingerprint of the definition it was made from
+FINGERPRINT_TAG_KEY = 'lambda-budgets:fingerprint'
+
+FINGERPRINT_INDEX_KEY = 'budget-fingerprints'
+
+RECONCILED_STATE_KEY = 'reconciled-state'
+
+
+def get_budget_fingerprint(budget_definition, notification_definitions):
+  '''A hash of the desired definition of a budget and its notifications
+
+  Two definitions have the same fingerprint exactly when they would make
+  the same budget, so a budget whose stored fingerprint differs from the
+  fingerprint of its desired definition has drifted.
+  '''
+  payload = json.dumps(
+    [budget_definition, notification_definitions],
+    sort_keys=True,
+    separators=(',', ':')
+  )
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_state_digest(teams_by_user_id, config_fingerprint):
+  '''A hash of the team memberships and the configuration of a run
+
+  After a run in which every budget change succeeded, the set of budgets is
+  exactly the set of users, each with the definition given by the
+  configuration and the user's first team. A later run whose digest is the
+  same therefore has nothing to change, unless the budgets were changed by
+  something else since.
+  '''
+  payload = json.dumps(
+    [config_fingerprint, sorted(teams_by_user_id.items())],
+    separators=(',', ':')
+  )
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class FingerprintIndex:
+  '''The last known fingerprint of each budget, by synapse id
+
+  Budgets carry their fingerprint in a tag, which takes one API call per
+  budget to read. The index keeps a copy of every fingerprint in a single
+  document of the state store, so that drift can be checked for all budgets
+  at once; the tags are only read for budgets missing from the index.
+  Runs that only reconcile some of the budgets, such as the shards of a
+  sharded run, keep their own index under their own key.
+  '''
+
+  def __init__(self, store, key=FINGERPRINT_INDEX_KEY):
+    self._store = store
+    self._key = key
+    self._lock = threading.Lock()
+    self._fingerprints = store.get(key) or {}
+    self._changed = False
+
+
+  def get(self, synapse_id):
+    with self._lock:
+      return self._fingerprints.get(synapse_id)
+
+
+  def set(self, synapse_id, fingerprint):
+    with self._lock:
+      if self._fingerprints.get(synapse_id) != fingerprint:
+        self._fingerprints[synapse_id] = fingerprint
+        self._changed = True
+
+
+  def discard(self, synapse_id):
+    with self._lock:
+      if self._fingerprints.pop(synapse_id, None) is not None:
+        self._changed = True
+
+
+  def save(self):
+    '''Writes the index back to the state store, if it has changed'''
+    with self._lock:
+      if self._changed:
+        self._store.put(self._key, self._fingerprints)
+        self._changed = False
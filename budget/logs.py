@@ -0,0 +1,87 @@
+import hashlib
+import itertools
+import json
+
+# the number of items of a collection shown in a log message
+SAMPLE_SIZE = 10
+
+WARNING_KEY_PREFIX = 'warning-'
+
+
+class Lazy:
+  '''A log message argument computed only if the message is logged
+
+  Pass it in place of a value to a logging call that uses %-style
+  formatting, as in log.debug('Event: %s', Lazy(json.dumps, event)); the
+  function is only called once the message passes the log level.
+  '''
+
+  def __init__(self, func, *args):
+    self._func = func
+    self._args = args
+
+
+  def __str__(self):
+    return str(self._func(*self._args))
+
+
+def summarize(items, sample_size=SAMPLE_SIZE):
+  '''Describes a collection by its size and its first items
+
+  For example "12 items: 1, 2, 3 and 9 more" for a sample_size of 3. The
+  items of a dictionary are shown as "key: value".
+  '''
+  if isinstance(items, dict):
+    sample = [
+      f'{key}: {value}'
+      for (key, value) in itertools.islice(items.items(), sample_size)
+    ]
+  else:
+    sample = [str(item) for item in itertools.islice(items, sample_size)]
+  summary = f'{len(items)} items'
+  if sample:
+    summary = f'{summary}: {", ".join(sample)}'
+  if len(items) > sample_size:
+    summary = f'{summary} and {len(items) - sample_size} more'
+  return summary
+
+
+def shorten(value, sample_size=SAMPLE_SIZE):
+  '''Returns value with each collection longer than sample_size replaced by
+  its summary, so that it can be logged as JSON at a bounded size
+  '''
+  if isinstance(value, (dict, list, tuple, set, frozenset)):
+    if len(value) > sample_size:
+      return f'<{summarize(value, sample_size)}>'
+    if isinstance(value, dict):
+      return {
+        str(key): shorten(item, sample_size) for (key, item) in value.items()
+      }
+    return [shorten(item, sample_size) for item in value]
+  return value
+
+
+def to_json(value, sample_size=SAMPLE_SIZE):
+  '''Returns the shortened JSON of a value, for a log message'''
+  return json.dumps(shorten(value, sample_size), default=str)
+
+
+def warn_on_change(logger, store, key, content, message, *args):
+  '''Logs a warning about content, unless the same warning was logged last
+
+  A digest of the content is kept in the store under key, so a warning that
+  would repeat on every run is only logged once, and then again when the
+  content changes. Empty content clears the digest, so the warning is
+  logged again if the content comes back.
+  '''
+  store_key = f'{WARNING_KEY_PREFIX}{key}'
+  if not content:
+    store.delete(store_key)
+    return
+  digest = hashlib.sha256(content.encode()).hexdigest()
+  state = store.get(store_key)
+  if state and state.get('digest') == digest:
+    logger.debug('Warning %s unchanged since it was last logged', key)
+    return
+  logger.warning(message, *args)
+  store.put(store_key, {'digest': digest})
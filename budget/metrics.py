@@ -0,0 +1,88 @@
+import json
+import sys
+import threading
+import time
+
+METRICS_NAMESPACE = 'LambdaBudgets'
+
+SERVICE_DIMENSION = {'Service': 'lambda-budgets'}
+
+
+class MetricsLogger:
+  '''Collects the metrics of a run and logs them as CloudWatch metrics
+
+  Metrics are written to the log as CloudWatch Embedded Metric Format (EMF)
+  documents, one JSON object per line, which CloudWatch turns into metrics
+  without any API calls. Metrics are grouped by their dimensions, and each
+  group is written as one document. Every metric has the dimensions given
+  to the logger, as well as its own.
+  '''
+
+  def __init__(self, namespace=METRICS_NAMESPACE, stream=None,
+      dimensions=None):
+    self._namespace = namespace
+    self._stream = stream
+    self._dimensions = dict(SERVICE_DIMENSION, **(dimensions or {}))
+    self._lock = threading.Lock()
+    self._groups = {}
+
+
+  def put_metric(self, name, value, unit='Count', dimensions=None):
+    '''Records a metric value, replacing any earlier value of the metric'''
+    dimensions = dict(self._dimensions, **(dimensions or {}))
+    key = tuple(sorted(dimensions.items()))
+    with self._lock:
+      group = self._groups.setdefault(key, {'dimensions': dimensions, 'metrics': {}})
+      group['metrics'][name] = (value, unit)
+
+
+  def put_timings(self, timings, suffix='Time', dimensions=None):
+    '''Records phase timings, in seconds, as millisecond metrics
+
+    A phase named "roster" is recorded as the metric "RosterTime".
+    '''
+    for (phase, seconds) in timings.items():
+      self.put_metric(
+        f'{phase.capitalize()}{suffix}',
+        round(seconds * 1000, 3),
+        unit='Milliseconds',
+        dimensions=dimensions
+      )
+
+
+  def documents(self):
+    '''Returns the EMF documents of the recorded metrics'''
+    timestamp = int(time.time() * 1000)
+    with self._lock:
+      groups = list(self._groups.values())
+    documents = []
+    for group in groups:
+      document = {
+        '_aws': {
+          'Timestamp': timestamp,
+          'CloudWatchMetrics': [{
+            'Namespace': self._namespace,
+            'Dimensions': [list(group['dimensions'])],
+            'Metrics': [
+              {'Name': name, 'Unit': unit}
+              for (name, (value, unit)) in group['metrics'].items()
+            ]
+          }]
+        }
+      }
+      document.update(group['dimensions'])
+      document.update({
+        name: value for (name, (value, unit)) in group['metrics'].items()
+      })
+      documents.append(document)
+    return documents
+
+
+  def flush(self):
+    '''Writes the recorded metrics to the log, and clears them'''
+    stream = self._stream or sys.stdout
+    for document in self.documents():
+      stream.write(json.dumps(document) + '\n')
+    stream.flush()
+    with self._lock:
+      self._groups.clear()
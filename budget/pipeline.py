@@ -0,0 +1,64 @@
+import asyncio
+
+from budget.batch import BatchResult
+
+
+class MutationQueue:
+  '''A bounded queue of budget changes, applied as they arrive
+
+  Changes are put on the queue by a producer while it is still working out
+  the rest of the changes, and are applied by a fixed number of workers, each
+  running one blocking call at a time on the given executor. The queue holds
+  at most max_size changes; once it is full, put() waits for a worker to take
+  one, so a fast producer cannot get far ahead of the workers.
+
+  The outcome of each change is recorded in a BatchResult per action. As in
+  run_batch, a func that returns False marks its item as unchanged, and an
+  exception is recorded against its item without stopping the other changes.
+  Items are recorded in the order their changes finish. Once should_stop, if
+  given, returns True, the changes taken from the queue are deferred instead
+  of being applied.
+  '''
+
+  def __init__(self, executor, workers, max_size, should_stop=None):
+    self._executor = executor
+    self._should_stop = should_stop
+    self._queue = asyncio.Queue(max_size)
+    self._workers = [asyncio.create_task(self._work()) for _ in range(workers)]
+    self.results = {}
+
+
+  async def put(self, action, func, item):
+    '''Queues the change func(item), waiting while the queue is full'''
+    self.results.setdefault(action, BatchResult())
+    await self._queue.put((action, func, item))
+
+
+  async def join(self):
+    '''Waits until every queued change has been applied, and stops the workers'''
+    await self._queue.join()
+    for worker in self._workers:
+      worker.cancel()
+    await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+  async def _work(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      (action, func, item) = await self._queue.get()
+      result = self.results[action]
+      if self._should_stop is not None and self._should_stop():
+        result.deferred.append(item)
+        self._queue.task_done()
+        continue
+      try:
+        changed = await loop.run_in_executor(self._executor, func, item)
+      except Exception as e:
+        result.failed[item] = e
+      else:
+        if changed is False:
+          result.unchanged.append(item)
+        else:
+          result.succeeded.append(item)
+      finally:
+        self._queue.task_done()
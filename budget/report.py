@@ -0,0 +1,87 @@
+import csv
+import json
+import os
+
+# the columns of a spend report, in order
+SPEND_REPORT_FIELDS = [
+  'synapse_id',
+  'team',
+  'budget_name',
+  'time_unit',
+  'limit',
+  'actual_spend',
+  'forecasted_spend',
+  'unit',
+  'percent_used',
+  'history'
+]
+
+
+def _get_amount(spend, key):
+  return (spend or {}).get(key, {}).get('Amount')
+
+
+def get_spend_record(synapse_id, team, budget, history=None):
+  '''Returns the spend report record of a budget from describe_budgets
+
+  Amounts are kept as the decimal strings the API returns. percent_used is
+  the actual spend as a percentage of the limit, or None if either is
+  unknown. history, if given, is the budget's performance history, as
+  returned by describe_budget_performance_history; it is None in the record
+  when it was not read.
+  '''
+  limit = _get_amount(budget, 'BudgetLimit')
+  actual_spend = _get_amount(budget.get('CalculatedSpend'), 'ActualSpend')
+  percent_used = None
+  if limit is not None and actual_spend is not None and float(limit):
+    percent_used = round(float(actual_spend) / float(limit) * 100, 2)
+  return {
+    'synapse_id': synapse_id,
+    'team': team,
+    'budget_name': budget['BudgetName'],
+    'time_unit': budget.get('TimeUnit'),
+    'limit': limit,
+    'actual_spend': actual_spend,
+    'forecasted_spend': _get_amount(
+      budget.get('CalculatedSpend'),
+      'ForecastedSpend'
+    ),
+    'unit': budget.get('BudgetLimit', {}).get('Unit'),
+    'percent_used': percent_used,
+    'history': None if history is None else [
+      {
+        'start': str(period['TimePeriod']['Start']),
+        'end': str(period['TimePeriod']['End']),
+        'budgeted': _get_amount(period, 'BudgetedAmount'),
+        'actual': _get_amount(period, 'ActualAmount')
+      }
+      for period in history
+    ]
+  }
+
+
+def write_spend_report(path, records, report_format):
+  '''Writes spend records to a file as CSV or JSON Lines
+
+  Records are written one at a time as they are read from records, which
+  may be a generator, so the report is never held in memory as a whole. In
+  CSV the history column holds the history as JSON.
+
+  Returns the number of records written
+  '''
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  count = 0
+  with open(path, 'w', newline='') as f:
+    if report_format == 'csv':
+      writer = csv.DictWriter(f, fieldnames=SPEND_REPORT_FIELDS)
+      writer.writeheader()
+      for record in records:
+        if record['history'] is not None:
+          record = dict(record, history=json.dumps(record['history']))
+        writer.writerow(record)
+        count += 1
+    else:
+      for record in records:
+        f.write(json.dumps(record) + '\n')
+        count += 1
+  return count
@@ -0,0 +1,91 @@
+import os
+
+
+class FileRulesSource:
+  '''Budget rules kept in a local file
+
+  The file's modification time and size are its version, so the file is
+  only read again once it has been replaced or changed. A file on a mounted
+  volume, or in a local directory that stands in for an object store, can
+  be used this way.
+  '''
+
+  def __init__(self, path):
+    self._path = path
+    self.version = None
+    self.text = None
+
+
+  def __str__(self):
+    return f'file://{self._path}'
+
+
+  def fetch(self):
+    '''Reads the rules if they have changed since they were last read
+
+    Returns whether they were read.
+    '''
+    stat = os.stat(self._path)
+    version = f'{stat.st_mtime_ns}-{stat.st_size}'
+    if version == self.version:
+      return False
+    with open(self._path) as f:
+      self.text = f.read()
+    self.version = version
+    return True
+
+
+class S3RulesSource:
+  '''Budget rules kept in an S3 object
+
+  The object's ETag is its version. Each fetch is a conditional GET, which
+  S3 answers with 304 Not Modified, and no body, while the object has the
+  ETag of the rules already read.
+  '''
+
+  def __init__(self, bucket, key):
+    self._bucket = bucket
+    self._key = key
+    self.version = None
+    self.text = None
+
+
+  def __str__(self):
+    return f's3://{self._bucket}/{self._key}'
+
+
+  def fetch(self):
+    '''Downloads the rules if they have changed since they were last read
+
+    Returns whether they were downloaded.
+    '''
+    # imported here, as the clients module imports the configuration
+    from botocore.exceptions import ClientError
+    from budget import clients
+
+    kwargs = {'Bucket': self._bucket, 'Key': self._key}
+    if self.version is not None:
+      kwargs['IfNoneMatch'] = self.version
+    try:
+      response = clients.get_client('s3').get_object(**kwargs)
+    except ClientError as e:
+      if e.response['Error']['Code'] in ['304', 'NotModified']:
+        return False
+      raise
+    self.text = response['Body'].read().decode()
+    self.version = response['ETag']
+    return True
+
+
+def get_rules_source(url):
+  '''Returns the rules source for an s3://bucket/key URL, a file:// URL, or
+  a file path
+  '''
+  if url.startswith('s3://'):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    if not bucket or not key:
+      raise ValueError(f'Budget rules source {url} must be s3://bucket/key')
+    return S3RulesSource(bucket, key)
+  if url.startswith('file://'):
+    return FileRulesSource(url[len('file://'):])
+  return FileRulesSource(url)
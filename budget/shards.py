@@ -0,0 +1,79 @@
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from budget import clients
+
+
+def get_shard(synapse_id, shard_count):
+  '''Returns the shard of a synapse id, from 0 to shard_count - 1
+
+  Shards come from a hash of the synapse id that, unlike hash(), is the same
+  in every process, so a synapse id always belongs to the same shard.
+  '''
+  digest = hashlib.sha256(synapse_id.encode()).digest()
+  return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def split_users(teams_by_user_id, shard_count):
+  '''Splits users and their team memberships into shard_count shards'''
+  shards = [{} for _ in range(shard_count)]
+  for (user_id, teams) in teams_by_user_id.items():
+    shards[get_shard(user_id, shard_count)][user_id] = teams
+  return shards
+
+
+class LambdaInvoker:
+  '''Runs a shard by invoking a lambda function and waiting for its result'''
+
+  def __init__(self, function_name):
+    self._function_name = function_name
+
+
+  def __call__(self, event):
+    response = clients.get_client('lambda').invoke(
+      FunctionName=self._function_name,
+      InvocationType='RequestResponse',
+      Payload=json.dumps(event).encode()
+      )
+    payload = json.loads(response['Payload'].read())
+    if response.get('FunctionError'):
+      raise RuntimeError(
+        f'Shard invocation failed: {payload.get("errorMessage", payload)}'
+      )
+    return payload
+
+
+class LocalInvoker:
+  '''Runs a shard by calling a lambda handler in the same process
+
+  The handler is given the lambda context, if there is one, so that it
+  shares the invocation's deadline.
+  '''
+
+  def __init__(self, handler, context=None):
+    self._handler = handler
+    self._context = context
+
+
+  def __call__(self, event):
+    return self._handler(event, self._context)
+
+
+def invoke_shards(invoke, events):
+  '''Runs every shard at the same time, and returns their results in order
+
+  A shard that cannot be run gets the result {'error': ...}, as a shard that
+  fails returns itself.
+  '''
+  if not events:
+    return []
+  with ThreadPoolExecutor(max_workers=len(events)) as executor:
+    futures = [executor.submit(invoke, event) for event in events]
+  results = []
+  for future in futures:
+    try:
+      results.append(future.result())
+    except Exception as e:
+      results.append({'error': str(e)})
+  return results
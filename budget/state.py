@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+
+
+class FileStore:
+  '''Keeps small JSON documents as files in a local directory
+
+  This is the state store used between invocations. In Lambda the directory
+  is under /tmp, so state lasts as long as the container; any object with
+  the same get, put and delete methods, such as one backed by an external
+  service, can be used in its place.
+  '''
+
+  def __init__(self, directory):
+    self._directory = directory
+
+
+  def __str__(self):
+    return f'FileStore({self._directory})'
+
+
+  def get(self, key):
+    '''Returns the document stored under key, or None'''
+    try:
+      with open(self._path(key)) as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return None
+    except ValueError:
+      # a damaged document is treated as missing, and is rebuilt
+      return None
+
+
+  def put(self, key, document):
+    '''Stores a document under key, replacing any earlier document'''
+    os.makedirs(self._directory, exist_ok=True)
+    # write to a temporary file first, so readers never see a partial document
+    fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(document, f)
+      os.replace(temp_path, self._path(key))
+    except BaseException:
+      os.remove(temp_path)
+      raise
+
+
+  def delete(self, key):
+    '''Removes the document stored under key, if there is one'''
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+
+  def _path(self, key):
+    return os.path.join(self._directory, f'{key}.json')
@@ -0,0 +1,48 @@
+# stands in for the synapse id when a template is made
+_PLACEHOLDER_SYNAPSE_ID = '{synapse_id}'
+
+
+class BudgetTemplate:
+  '''The budget payload of a team, with the synapse id left to fill in
+
+  Every member of a team gets the same budget apart from the budget name and
+  the cost filter, which both end with the member's synapse id. A template
+  is made once from the payload of a placeholder member, and render() then
+  only builds the parts that hold the synapse id. The remaining parts are
+  shared by every rendered payload, and must not be modified.
+  '''
+
+  def __init__(self, make_definitions):
+    '''Makes a template from make_definitions(synapse_id), which returns the
+    budget definition and notification definitions of a team member
+    '''
+    budget_definition, notification_definitions = make_definitions(
+      _PLACEHOLDER_SYNAPSE_ID
+    )
+    self._budget_name_prefix = BudgetTemplate._strip_placeholder(
+      budget_definition['BudgetName']
+    )
+    self._cost_filter_prefixes = [
+      BudgetTemplate._strip_placeholder(tag_key_value)
+      for tag_key_value in budget_definition['CostFilters']['TagKeyValue']
+    ]
+    self._budget_definition = budget_definition
+    self._notification_definitions = notification_definitions
+
+
+  def render(self, synapse_id):
+    '''Returns the budget definition and notification definitions of a member'''
+    budget_definition = dict(self._budget_definition)
+    budget_definition['BudgetName'] = f'{self._budget_name_prefix}{synapse_id}'
+    budget_definition['CostFilters'] = {
+      'TagKeyValue': [
+        f'{prefix}{synapse_id}' for prefix in self._cost_filter_prefixes
+      ]
+    }
+    return budget_definition, self._notification_definitions
+
+
+  def _strip_placeholder(value):
+    if not value.endswith(_PLACEHOLDER_SYNAPSE_ID):
+      raise ValueError(f'Cannot make a budget template from {value}')
+    return value[:-len(_PLACEHOLDER_SYNAPSE_ID)]
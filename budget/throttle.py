@@ -0,0 +1,187 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# error codes the AWS APIs use to report that a caller is being throttled
+THROTTLING_ERROR_CODES = {
+  'Throttling',
+  'ThrottlingException',
+  'TooManyRequestsException',
+  'RequestLimitExceeded'
+}
+
+
+class RateLimiter:
+  '''A token bucket shared by every thread that calls a rate-limited API
+
+  Tokens are added at `rate` per second, up to `rate` tokens in the bucket
+  but never fewer than one, and each call takes one token, waiting for a new
+  token if none is left. Below one call per second the bucket holds a single
+  token, so that a call can still be made.
+  '''
+
+  def __init__(self, rate):
+    self._lock = threading.Lock()
+    self._rate = float(rate)
+    self._tokens = self._capacity()
+    self._updated = time.monotonic()
+
+
+  @property
+  def rate(self):
+    '''Maximum number of calls per second'''
+    return self._rate
+
+
+  def _capacity(self):
+    '''Number of tokens the bucket holds when full'''
+    return max(1.0, self._rate)
+
+
+  def set_rate(self, rate):
+    with self._lock:
+      self._rate = float(rate)
+      self._tokens = min(self._tokens, self._capacity())
+
+
+  def record_success(self, started, latency):
+    '''Called after a call made at time.monotonic() `started` succeeds'''
+
+
+  def record_throttle(self, started):
+    '''Called after a call made at time.monotonic() `started` is throttled'''
+
+
+  def acquire(self):
+    '''Blocks until a call may be made under the rate limit'''
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(
+          self._capacity(),
+          self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self._rate
+      time.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+  '''A RateLimiter whose rate adapts to how the API responds
+
+  The rate follows additive increase, multiplicative decrease (AIMD), as in
+  TCP congestion control. A throttled call cuts the rate by decrease_factor,
+  down to min_rate. The rate is cut at most once every decrease_interval
+  seconds, the window over which APIs count calls, and only by calls made
+  after the last cut, as calls made before it were sent at the old rate.
+  Each call that succeeds raises the
+  rate by increase / rate, which adds about `increase` calls per second
+  every second, up to max_rate. Calls slower than slow_latency seconds, a
+  sign that the API is under load, hold the rate where it is.
+  '''
+
+  def __init__(self, max_rate, min_rate=0.5, increase=1.0, decrease_factor=0.5,
+      decrease_interval=1.0, slow_latency=2.0):
+    super().__init__(max_rate)
+    self._max_rate = float(max_rate)
+    self._min_rate = min(float(min_rate), self._max_rate)
+    self._increase = increase
+    self._decrease_factor = decrease_factor
+    self._decrease_interval = decrease_interval
+    self._slow_latency = slow_latency
+    self._decreased = None
+    self.throttles = 0
+
+
+  @property
+  def max_rate(self):
+    '''The rate is never raised above this number of calls per second'''
+    return self._max_rate
+
+
+  def set_max_rate(self, max_rate):
+    '''Sets the highest rate
+
+    The rate learned so far is kept while the highest rate stays the same.
+    A new highest rate is a new setting, and the rate starts again from it.
+    '''
+    with self._lock:
+      if float(max_rate) == self._max_rate:
+        return
+      self._max_rate = float(max_rate)
+      self._min_rate = min(self._min_rate, self._max_rate)
+      self._rate = self._max_rate
+      self._tokens = min(self._tokens, self._capacity())
+
+
+  def record_success(self, started, latency):
+    if latency > self._slow_latency:
+      return
+    with self._lock:
+      self._rate = min(self._max_rate, self._rate + self._increase / self._rate)
+
+
+  def record_throttle(self, started):
+    with self._lock:
+      self.throttles += 1
+      if self._decreased is not None and (
+        started < self._decreased or
+        time.monotonic() - self._decreased < self._decrease_interval
+      ):
+        return
+      self._rate = max(self._min_rate, self._rate * self._decrease_factor)
+      self._tokens = min(self._tokens, self._capacity())
+      self._decreased = time.monotonic()
+
+
+def _was_retried(response):
+  '''Whether botocore had to retry a call before it succeeded'''
+  return (
+    isinstance(response, dict) and
+    response.get('ResponseMetadata', {}).get('RetryAttempts', 0) > 0
+  )
+
+
+def is_throttling_error(error):
+  '''Whether an exception is an AWS throttling error'''
+  return (
+    isinstance(error, ClientError) and
+    error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+  )
+
+
+def call_with_backoff(rate_limiter, func, max_attempts=5, base_delay=0.25,
+    max_delay=8.0, **kwargs):
+  '''Calls func under the rate limit, retrying when it is throttled
+
+  Retries back off exponentially with full jitter, so that threads that were
+  throttled together do not all retry at the same moment. Errors other than
+  throttling, and the last throttling error, are raised to the caller.
+
+  Every outcome is reported to the rate limiter. botocore retries some
+  throttled calls itself before returning, so a response that needed
+  retries is reported as a throttle too.
+  '''
+  for attempt in range(max_attempts):
+    rate_limiter.acquire()
+    started = time.monotonic()
+    try:
+      response = func(**kwargs)
+    except ClientError as e:
+      if not is_throttling_error(e):
+        raise
+      rate_limiter.record_throttle(started)
+      if attempt == max_attempts - 1:
+        raise
+      time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+    else:
+      if _was_retried(response):
+        rate_limiter.record_throttle(started)
+      else:
+        rate_limiter.record_success(started, time.monotonic() - started)
+      return response
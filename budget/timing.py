@@ -0,0 +1,29 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PhaseTimer:
+  '''Records how long each phase of a run takes, in seconds
+
+  Phases may be timed from several threads at once.
+  '''
+
+  def __init__(self):
+    self.timings = {}
+    self._lock = threading.Lock()
+
+
+  @contextmanager
+  def phase(self, name):
+    '''Times the enclosed block as the named phase
+
+    A phase that runs more than once accumulates the time of every run.
+    '''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
@@ -0,0 +1,74 @@
+'''Measures the per-user cost of building budget payloads
+
+Compares building each user's budget and notification definitions from the
+configuration with rendering them from a precompiled team template.
+
+Run from the root of the project:
+
+  python -m tests.benchmark.bench_definitions
+'''
+import argparse
+import time
+from types import SimpleNamespace
+
+from budget import app
+
+
+def _make_configuration(emails_per_team):
+  return SimpleNamespace(
+    account_id='012345678901',
+    end_user_role_name='ServiceCatalogExternalEndusers',
+    notification_topic_arn='arn:aws:sns:us-east-1:012345678901:topic',
+    fingerprint='benchmark',
+    budget_rules={
+      'teams': {
+        '3412821': {
+          'amount': '100',
+          'period': 'ANNUALLY',
+          'unit': 'USD',
+          'community_manager_emails': [
+            f'manager{i}@example.org' for i in range(emails_per_team)
+          ]
+        }
+      }
+    },
+    thresholds={
+      'notify_user_only': [25.0, 50.0, 80.0],
+      'notify_admins_too': [90.0, 100.0, 110.0]
+    }
+  )
+
+
+def _time_per_user(make_definitions, users):
+  start = time.perf_counter()
+  for synapse_id in users:
+    make_definitions(synapse_id, '3412821')
+  return (time.perf_counter() - start) / len(users)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--users', type=int, default=100000)
+  parser.add_argument('--emails-per-team', type=int, default=5)
+  args = parser.parse_args()
+
+  app.configuration = _make_configuration(args.emails_per_team)
+  users = [str(3000000 + i) for i in range(args.users)]
+
+  direct = _time_per_user(
+    lambda synapse_id, team: (
+      app.create_budget_definition(synapse_id, team),
+      app.create_notification_definitions(synapse_id, team)
+    ),
+    users
+  )
+  templated = _time_per_user(app._get_budget_definitions, users)
+
+  print(f'users: {args.users}')
+  print(f'from configuration: {direct * 1e6:8.2f} us per user')
+  print(f'from template:      {templated * 1e6:8.2f} us per user')
+  print(f'speedup:            {direct / templated:8.1f}x')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,212 @@
+'''Measures lambda_handler end to end against in-process fakes
+
+For each account size the handler is run three times: against an empty
+account, after some users have joined and left teams, and with nothing
+changed. Wall time, API calls and peak memory are reported for each phase
+of each run. With --engine async the phases overlap, so only the total of
+each run is reported.
+
+Run from the root of the project:
+
+  python -m tests.benchmark.bench_handler --sizes 100 10000 100000
+'''
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from unittest.mock import patch
+
+from budget import app, clients
+from tests.unit.helpers import FakeBudgetsClient, FakeSynapse
+
+# the handler functions timed as phases, by phase name
+PHASES = {
+  'roster': 'get_users',
+  'inventory': 'list_budget_user_ids',
+  'diff': 'compare_budgets_and_users',
+  'drift': 'find_drifted_budgets',
+  'create': 'create_budgets',
+  'update': 'update_budgets',
+  'delete': 'delete_budgets'
+}
+
+
+def _make_budget_rules(team_ids):
+  lines = ['teams:']
+  for team_id in team_ids:
+    lines.extend([
+      f"  '{team_id}':",
+      "    amount: '100'",
+      '    period: ANNUALLY',
+      '    unit: USD',
+      '    community_manager_emails:',
+      '      - manager@example.org'
+    ])
+  return '\n'.join(lines)
+
+
+def _make_environment(team_ids, state_dir, args):
+  return {
+    'AWS_ACCOUNT_ID': '012345678901',
+    'NOTIFICATION_TOPIC_ARN': 'arn:aws:sns:us-east-1:012345678901:topic',
+    'END_USER_ROLE_NAME': 'ServiceCatalogExternalEndusers',
+    'BUDGET_RULES': _make_budget_rules(team_ids),
+    'THRESHOLDS': 'notify_user_only: [50.0]\nnotify_admins_too: [100.0]',
+    'STATE_DIR': state_dir,
+    'BUDGETS_MAX_WORKERS': str(args.workers),
+    'BUDGETS_MAX_TPS': str(args.client_tps),
+    'SYNAPSE_MAX_WORKERS': str(args.workers),
+    'ENGINE': args.engine
+  }
+
+
+class _PhaseRecorder:
+  '''Wraps the handler's phase functions to measure each call'''
+
+  def __init__(self, budgets_client, syn, trace_memory):
+    self._budgets_client = budgets_client
+    self._syn = syn
+    self._trace_memory = trace_memory
+    self.results = {}
+
+
+  def _api_calls(self):
+    return (
+      sum(self._budgets_client.calls.values()) +
+      sum(self._syn.calls.values())
+    )
+
+
+  def wrap(self, phase, func):
+    def measured(*args, **kwargs):
+      calls_before = self._api_calls()
+      if self._trace_memory:
+        tracemalloc.reset_peak()
+      start = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self._trace_memory else 0
+        self.results[phase] = {
+          'seconds': seconds,
+          'api_calls': self._api_calls() - calls_before,
+          'peak_mb': peak / 2 ** 20
+        }
+    return measured
+
+
+def _run_handler(label, size, budgets_client, syn, trace_memory, event=None):
+  recorder = _PhaseRecorder(budgets_client, syn, trace_memory)
+  patches = [
+    patch.object(app, name, recorder.wrap(phase, getattr(app, name)))
+    for (phase, name) in PHASES.items()
+  ]
+  for p in patches:
+    p.start()
+  try:
+    calls_before = recorder._api_calls()
+    start = time.perf_counter()
+    result = app.lambda_handler(event or {}, None)
+    total = time.perf_counter() - start
+    api_calls = recorder._api_calls() - calls_before
+  finally:
+    for p in patches:
+      p.stop()
+  if 'error' in result:
+    raise RuntimeError(f'{label} run failed: {result["error"]}')
+  if 'counts' not in result:
+    raise RuntimeError(f'{label} run did not reconcile: {result["message"]}')
+
+  for (phase, measures) in recorder.results.items():
+    print(
+      f'{size:>8} {label:<8} {phase:<10} {measures["seconds"]:>9.3f} '
+      f'{measures["api_calls"]:>9} {measures["peak_mb"]:>9.1f}'
+    )
+  print(f'{size:>8} {label:<8} {"total":<10} {total:>9.3f} {api_calls:>9}')
+
+
+def run_size(size, args):
+  # at least two teams, so that users who churn move between teams
+  team_count = max(2, size // args.users_per_team)
+  team_ids = [str(3400000 + i) for i in range(team_count)]
+  members_by_team = {team_id: [] for team_id in team_ids}
+  for i in range(size):
+    members_by_team[team_ids[i % team_count]].append(str(1000000 + i))
+
+  budgets_client = FakeBudgetsClient(
+    latency=args.budgets_latency,
+    max_tps=args.budgets_tps
+  )
+  syn = FakeSynapse(members_by_team, latency=args.synapse_latency)
+  clients.reset()
+  clients.set_client('budgets', budgets_client)
+  clients.set_synapse_client(syn)
+
+  with tempfile.TemporaryDirectory() as state_dir, \
+    patch.dict('os.environ', _make_environment(team_ids, state_dir, args)):
+    _run_handler('initial', size, budgets_client, syn, args.memory)
+
+    # some users join the first team, and as many leave the last one; the
+    # later runs are full checks, so that they measure reconciliation rather
+    # than a skipped run
+    churn = max(1, size // 100)
+    members_by_team[team_ids[0]].extend(
+      str(9000000 + i) for i in range(churn)
+    )
+    del members_by_team[team_ids[-1]][:churn]
+    _run_handler(
+      'churn',
+      size,
+      budgets_client,
+      syn,
+      args.memory,
+      {'full_check': True}
+    )
+
+    _run_handler(
+      'steady',
+      size,
+      budgets_client,
+      syn,
+      args.memory,
+      {'full_check': True}
+    )
+
+  clients.reset()
+  print(
+    f'{size:>8} budgets API calls: {dict(budgets_client.calls)}; '
+    f'synapse calls: {dict(syn.calls)}'
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000])
+  parser.add_argument('--users-per-team', type=int, default=500)
+  parser.add_argument('--workers', type=int, default=16)
+  parser.add_argument('--client-tps', type=int, default=2000,
+    help='calls per second the handler allows itself')
+  parser.add_argument('--budgets-tps', type=int, default=None,
+    help='calls per second the fake budgets API allows before throttling')
+  parser.add_argument('--budgets-latency', type=float, default=0.001)
+  parser.add_argument('--synapse-latency', type=float, default=0.002)
+  parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+  parser.add_argument('--no-memory', dest='memory', action='store_false',
+    help='skip peak memory tracing, which slows the runs down')
+  args = parser.parse_args()
+
+  if args.memory:
+    tracemalloc.start()
+  print(
+    f'{"users":>8} {"run":<8} {"phase":<10} {"seconds":>9} '
+    f'{"api calls":>9} {"peak MB":>9}'
+  )
+  for size in args.sizes:
+    run_size(size, args)
+
+
+if __name__ == '__main__':
+  main()
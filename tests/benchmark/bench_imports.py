@@ -0,0 +1,86 @@
+'''Measures the import cost of the lambda at a cold start
+
+Imports budget.app in fresh interpreters with `python -X importtime`, and
+reports the total import time and the modules that took longest. The cost
+of the imports deferred to the first run is reported separately.
+
+Run from the root of the project:
+
+  python -m tests.benchmark.bench_imports --runs 5 --max-ms 100
+
+With --max-ms the benchmark exits with an error when the median import time
+of budget.app is over the limit, so that it can be used as a regression
+check.
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+
+# the modules imported on first use rather than when the lambda starts
+DEFERRED_MODULES = ['boto3', 'synapseclient', 'cerberus', 'yaml']
+
+
+def _import_times(statement, module):
+  '''Returns the cumulative import time, in ms, of module and of each
+  module imported by it, when statement runs in a fresh interpreter
+  '''
+  result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', statement],
+    capture_output=True,
+    text=True,
+    check=True
+  )
+  # each import is listed after its own imports, which are indented under it
+  times = {}
+  for line in result.stderr.splitlines():
+    # import time: self [us] | cumulative | imported package
+    if not line.startswith('import time:') or 'imported package' in line:
+      continue
+    (_, cumulative, name) = line.split('|')
+    if not name.startswith(' ' * 2):
+      if name.strip() == module:
+        times[module] = int(cumulative) / 1000
+        return times
+      # a top-level import other than module, such as site
+      times = {}
+      continue
+    times[name.strip()] = int(cumulative) / 1000
+  raise RuntimeError(f'{module} was not imported by: {statement}')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--top', type=int, default=10)
+  parser.add_argument('--max-ms', type=float, default=None,
+    help='fail when the median import time of budget.app is over this')
+  args = parser.parse_args()
+
+  runs = [
+    _import_times('import budget.app', 'budget.app') for _ in range(args.runs)
+  ]
+  totals = [times['budget.app'] for times in runs]
+  median = statistics.median(totals)
+
+  # the slowest modules imported by budget.app, counting their own imports
+  slowest = sorted(runs[-1].items(), key=lambda item: -item[1])
+  slowest = [(name, ms) for (name, ms) in slowest if name != 'budget.app']
+  print(f'{"module":<32} {"ms":>9}')
+  for (name, ms) in slowest[:args.top]:
+    print(f'{name:<32} {ms:>9.1f}')
+  print(f'{"budget.app (median)":<32} {median:>9.1f}')
+
+  for name in DEFERRED_MODULES:
+    deferred = _import_times(f'import budget.app, {name}', name)
+    print(f'{name + " (deferred)":<32} {deferred[name]:>9.1f}')
+
+  if args.max_ms is not None and median > args.max_ms:
+    sys.exit(
+      f'budget.app took {median:.1f} ms to import, over the limit of '
+      f'{args.max_ms} ms'
+    )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,358 @@
+'''Shared helpers of the tests that drive lambda_handler
+
+FakeBudgetsClient and FakeSynapse are in-process stand-ins for the AWS
+Budgets API and Synapse team rosters. They keep their data in memory, count
+every call, and can add latency to calls and throttle callers that go over
+a set rate, so that the handler can be driven at scale without touching
+real services; the benchmarks use them too. HandlerTestCase runs the
+handler against them.
+'''
+import io
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+from requests import Response
+from synapseclient.core.exceptions import SynapseHTTPError
+
+from budget import clients
+from budget.state import FileStore
+
+
+def _client_error(code, operation):
+  return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class _FakePaginator:
+
+  def __init__(self, client, operation):
+    self._client = client
+    self._operation = operation
+
+
+  def paginate(self, PaginationConfig=None, **kwargs):
+    page_size = (PaginationConfig or {}).get('PageSize')
+    if page_size:
+      kwargs['MaxResults'] = page_size
+    method = getattr(self._client, self._operation)
+    while True:
+      page = method(**kwargs)
+      yield page
+      if not page.get('NextToken'):
+        return
+      kwargs['NextToken'] = page['NextToken']
+
+
+class FakeBudgetsClient:
+  '''An AWS Budgets client that keeps budgets in memory
+
+  latency: seconds added to every call
+  max_tps: calls per second allowed before callers get ThrottlingException
+  max_page_size: the largest page describe_budgets returns
+  '''
+
+  def __init__(self, latency=0.0, max_tps=None, max_page_size=1000):
+    self.latency = latency
+    self.max_tps = max_tps
+    self.max_page_size = max_page_size
+    self.calls = Counter()
+    self.budgets = {}
+    self.notifications = {}
+    self.tags = {}
+    self._lock = threading.Lock()
+    self._window_start = time.monotonic()
+    self._window_calls = 0
+
+
+  def get_paginator(self, operation):
+    return _FakePaginator(self, operation)
+
+
+  def add_budget(self, budget, notifications=None, tags=None):
+    '''Adds a budget directly, without counting a call'''
+    self.budgets[budget['BudgetName']] = budget
+    self.notifications[budget['BudgetName']] = notifications or []
+    self.tags[budget['BudgetName']] = tags or []
+
+
+  def _call(self, operation):
+    with self._lock:
+      self.calls[operation] += 1
+      if self.max_tps:
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+          self._window_start = now
+          self._window_calls = 0
+        self._window_calls += 1
+        throttled = self._window_calls > self.max_tps
+      else:
+        throttled = False
+    if self.latency:
+      time.sleep(self.latency)
+    if throttled:
+      with self._lock:
+        self.calls['throttled'] += 1
+      raise _client_error('ThrottlingException', operation)
+
+
+  def _budget_name(self, arn):
+    return arn.split(':budget/')[1]
+
+
+  def describe_budgets(self, AccountId, MaxResults=100, NextToken=None):
+    self._call('describe_budgets')
+    start = int(NextToken or 0)
+    end = start + min(MaxResults, self.max_page_size)
+    with self._lock:
+      names = list(self.budgets)[start:end]
+      budgets = [self.budgets[name] for name in names]
+      total = len(self.budgets)
+    page = {'Budgets': budgets}
+    if end < total:
+      page['NextToken'] = str(end)
+    return page
+
+
+  def describe_budget(self, AccountId, BudgetName):
+    self._call('describe_budget')
+    with self._lock:
+      if BudgetName not in self.budgets:
+        raise _client_error('NotFoundException', 'DescribeBudget')
+      return {'Budget': self.budgets[BudgetName]}
+
+
+  def create_budget(self, AccountId, Budget, NotificationsWithSubscribers=None,
+      ResourceTags=None):
+    self._call('create_budget')
+    with self._lock:
+      if Budget['BudgetName'] in self.budgets:
+        raise _client_error('DuplicateRecordException', 'CreateBudget')
+      self.add_budget(
+        Budget,
+        [n['Notification'] for n in NotificationsWithSubscribers or []],
+        ResourceTags
+      )
+    return {}
+
+
+  def update_budget(self, AccountId, NewBudget):
+    self._call('update_budget')
+    with self._lock:
+      if NewBudget['BudgetName'] not in self.budgets:
+        raise _client_error('NotFoundException', 'UpdateBudget')
+      self.budgets[NewBudget['BudgetName']] = NewBudget
+    return {}
+
+
+  def delete_budget(self, AccountId, BudgetName):
+    self._call('delete_budget')
+    with self._lock:
+      if self.budgets.pop(BudgetName, None) is None:
+        raise _client_error('NotFoundException', 'DeleteBudget')
+      self.notifications.pop(BudgetName, None)
+      self.tags.pop(BudgetName, None)
+    return {}
+
+
+  def describe_budget_performance_history(self, AccountId, BudgetName,
+      NextToken=None):
+    self._call('describe_budget_performance_history')
+    with self._lock:
+      if BudgetName not in self.budgets:
+        raise _client_error('NotFoundException', 'DescribeBudgetPerformanceHistory')
+      budget = self.budgets[BudgetName]
+    # one past period, in which the budget's current spend was reached
+    spend = budget.get('CalculatedSpend', {}).get('ActualSpend')
+    amounts = []
+    if spend:
+      amounts.append({
+        'BudgetedAmount': budget['BudgetLimit'],
+        'ActualAmount': spend,
+        'TimePeriod': {'Start': '2024-01-01', 'End': '2024-02-01'}
+      })
+    return {
+      'BudgetPerformanceHistory': {
+        'BudgetName': BudgetName,
+        'BudgetedAndActualAmountsList': amounts
+      }
+    }
+
+
+  def list_tags_for_resource(self, ResourceARN):
+    self._call('list_tags_for_resource')
+    with self._lock:
+      return {'ResourceTags': self.tags.get(self._budget_name(ResourceARN), [])}
+
+
+  def tag_resource(self, ResourceARN, ResourceTags):
+    self._call('tag_resource')
+    with self._lock:
+      self.tags[self._budget_name(ResourceARN)] = ResourceTags
+    return {}
+
+
+  def describe_notifications_for_budget(self, AccountId, BudgetName, NextToken=None):
+    self._call('describe_notifications_for_budget')
+    with self._lock:
+      return {'Notifications': list(self.notifications.get(BudgetName, []))}
+
+
+  def describe_subscribers_for_notification(self, AccountId, BudgetName,
+      Notification, NextToken=None):
+    self._call('describe_subscribers_for_notification')
+    return {'Subscribers': []}
+
+
+  def create_notification(self, AccountId, BudgetName, Notification, Subscribers):
+    self._call('create_notification')
+    with self._lock:
+      self.notifications.setdefault(BudgetName, []).append(Notification)
+    return {}
+
+
+  def delete_notification(self, AccountId, BudgetName, Notification):
+    self._call('delete_notification')
+    with self._lock:
+      self.notifications[BudgetName].remove(Notification)
+    return {}
+
+
+  def create_subscriber(self, **kwargs):
+    self._call('create_subscriber')
+    return {}
+
+
+  def delete_subscriber(self, **kwargs):
+    self._call('delete_subscriber')
+    return {}
+
+
+class FakeSynapse:
+  '''A Synapse client serving team rosters from memory
+
+  members_by_team: the non-admin member ids of each team; every team also
+  gets one admin, who is never given a budget
+  latency: seconds added to every request, including each page of a roster
+  page_size: the number of members returned in one page of a roster
+  '''
+
+  def __init__(self, members_by_team, latency=0.0, page_size=50):
+    self.members_by_team = members_by_team
+    self.latency = latency
+    self.page_size = page_size
+    self.calls = Counter()
+    self._lock = threading.Lock()
+
+
+  def _call(self, operation):
+    with self._lock:
+      self.calls[operation] += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+
+  def _members(self, team_id):
+    yield {'teamId': team_id, 'member': {'ownerId': f'admin-{team_id}'}, 'isAdmin': True}
+    for member_id in self.members_by_team[team_id]:
+      yield {'teamId': team_id, 'member': {'ownerId': member_id}, 'isAdmin': False}
+
+
+  def getTeamMembers(self, team_id):
+    page = []
+    for member in self._members(team_id):
+      if not page:
+        self._call('team_members_page')
+      page.append(member)
+      if len(page) == self.page_size:
+        yield from page
+        page = []
+    yield from page
+
+
+  def restGET(self, uri):
+    if uri.startswith('/teamMembers/count/'):
+      team_id = uri.split('/teamMembers/count/')[1]
+      self._call('team_members_count')
+      return {'count': len(self.members_by_team[team_id]) + 1}
+
+    # /team/{team_id}/member/{member_id}
+    (_, _, team_id, _, member_id) = uri.split('/')
+    self._call('team_member')
+    for member in self._members(team_id):
+      if member['member']['ownerId'] == member_id:
+        return member
+    response = Response()
+    response.status_code = 404
+    raise SynapseHTTPError('404 Client Error: Not Found', response=response)
+
+
+def team_rules(team_id, amount='100', period='ANNUALLY'):
+  '''Returns the budget rules of one team, as yaml under "teams:"'''
+  return (
+    f'  \'{team_id}\':\n'
+    f'    amount: \'{amount}\'\n'
+    f'    period: {period}\n'
+    '    unit: USD\n'
+    '    community_manager_emails:\n'
+    '      - manager@example.org\n'
+  )
+
+
+class HandlerTestCase(unittest.TestCase):
+  '''Runs lambda_handler against a FakeBudgetsClient and a FakeSynapse
+
+  Each test gets the environment of a deployment, with a state directory
+  of its own, and its output is kept off the console. members_by_team
+  holds the members of each team, and amounts the budget amount of each
+  team in the budget rules. Subclasses change what they need in
+  get_environment.
+  '''
+
+  members_by_team = {'111': ['1', '2']}
+  amounts = {'111': '10'}
+  period = 'ANNUALLY'
+
+
+  def get_environment(self):
+    return {
+      'AWS_ACCOUNT_ID': '012345678901',
+      'NOTIFICATION_TOPIC_ARN': 'arn:aws:sns:us-east-1:012345678901:topic',
+      'END_USER_ROLE_NAME': 'ServiceCatalogExternalEndusers',
+      'BUDGET_RULES': 'teams:\n' + ''.join(
+        team_rules(team_id, amount, self.period)
+        for (team_id, amount) in self.amounts.items()
+      ),
+      'THRESHOLDS': 'notify_user_only: [50.0]\nnotify_admins_too: [100.0]',
+      'STATE_DIR': self.state_dir.name,
+      'BUDGETS_MAX_TPS': '1000'
+    }
+
+
+  def setUp(self):
+    self.budgets_client = FakeBudgetsClient()
+    self.syn = FakeSynapse({
+      team_id: list(member_ids)
+      for (team_id, member_ids) in self.members_by_team.items()
+    })
+    clients.set_client('budgets', self.budgets_client)
+    clients.set_synapse_client(self.syn)
+    self.state_dir = tempfile.TemporaryDirectory()
+    self.store = FileStore(self.state_dir.name)
+    self.environment = self.get_environment()
+    self.patches = [
+      patch.dict('os.environ', self.environment),
+      patch('sys.stdout', new_callable=io.StringIO)
+    ]
+    for p in self.patches:
+      p.start()
+
+
+  def tearDown(self):
+    for p in self.patches:
+      p.stop()
+    self.state_dir.cleanup()
+    clients.reset()
@@ -0,0 +1,166 @@
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from budget import accounts, app, clients
+from budget.accounts import Account
+from tests.unit.helpers import FakeBudgetsClient, HandlerTestCase
+
+OTHER_ROLE_ARN = 'arn:aws:iam::111111111111:role/budget-maker'
+
+
+class TestAccounts(unittest.TestCase):
+
+  def test_use(self):
+    account = Account('111111111111', 'Endusers', 'topic', None, MagicMock())
+    self.assertIsNone(accounts.get_current())
+    with accounts.use(account):
+      self.assertIs(accounts.get_current(), account)
+    self.assertIsNone(accounts.get_current())
+
+
+  def test_bind_carries_account_to_threads(self):
+    account = Account('111111111111', 'Endusers', 'topic', None, MagicMock())
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      with accounts.use(account):
+        bound = accounts.bind(accounts.get_current)
+      self.assertIs(executor.submit(bound).result(), account)
+      self.assertIsNone(executor.submit(accounts.get_current).result())
+
+
+class TestAccountsHandler(HandlerTestCase):
+
+  members_by_team = {'3412821': [str(user_id) for user_id in range(10)]}
+  amounts = {'3412821': '100'}
+
+
+  def get_environment(self):
+    return dict(
+      super().get_environment(),
+      ACCOUNTS=(
+        '- account_id: \'012345678901\'\n'
+        '- account_id: \'111111111111\'\n'
+        f'  role_arn: {OTHER_ROLE_ARN}\n'
+        '  end_user_role_name: OtherEndusers'
+      )
+    )
+
+
+  def setUp(self):
+    super().setUp()
+    self.other_budgets_client = FakeBudgetsClient()
+    # a budget for a user who has left the team, in the other account
+    self.other_budgets_client.add_budget({'BudgetName': 'service-catalog_999'})
+    clients.set_client('budgets', self.other_budgets_client, OTHER_ROLE_ARN)
+
+
+  def _run(self, *events):
+    return [app.lambda_handler(event, None) for event in events]
+
+
+  def test_accounts_run(self):
+    (result, skipped_result, second_result) = self._run(
+      {},
+      {},
+      {'full_check': True}
+    )
+
+    self.assertEqual(
+      result['counts'],
+      {'created': 20, 'updated': 0, 'removed': 1, 'failed': 0, 'deferred': 0}
+    )
+    self.assertIn('complete in 2 accounts', result['message'])
+    self.assertEqual(result['accounts']['111111111111']['counts']['removed'], 1)
+    expected_budgets = sorted(f'service-catalog_{user_id}' for user_id in range(10))
+    self.assertEqual(sorted(self.budgets_client.budgets), expected_budgets)
+    self.assertEqual(sorted(self.other_budgets_client.budgets), expected_budgets)
+    # each account's budgets use its own end user role
+    self.assertIn(
+      'arn:aws:sts::111111111111:assumed-role/OtherEndusers/3',
+      self.other_budgets_client.budgets['service-catalog_3']['CostFilters']
+      ['TagKeyValue'][0]
+    )
+    self.assertIn(
+      'arn:aws:sts::012345678901:assumed-role/ServiceCatalogExternalEndusers/3',
+      self.budgets_client.budgets['service-catalog_3']['CostFilters']
+      ['TagKeyValue'][0]
+    )
+    self.assertIn('skipped', skipped_result['message'])
+    self.assertEqual(second_result['counts']['created'], 0)
+    self.assertEqual(second_result['counts']['updated'], 0)
+    # the rosters are read once per run, and shared by the accounts
+    self.assertEqual(self.syn.calls['team_members_count'], 3)
+
+
+  def test_accounts_have_their_own_rate_limiters(self):
+    self._run({})
+    self.assertIsNot(
+      app._account_rate_limiters['111111111111'],
+      app.budgets_rate_limiter
+    )
+    self.assertNotIn('012345678901', app._account_rate_limiters)
+
+
+  def test_accounts_share_configuration(self):
+    with patch('budget.app.Config.load', wraps=app.Config.load) as load_mock:
+      self._run({})
+    # loaded by the coordinator only, not again by each account
+    load_mock.assert_called_once()
+
+
+  def test_report_per_account(self):
+    with tempfile.TemporaryDirectory() as report_dir:
+      (_, result) = self._run(
+        {},
+        {'report': True, 'report_output': os.path.join(report_dir, 'report.csv')}
+      )
+      self.assertEqual(
+        sorted(os.listdir(report_dir)),
+        ['report-012345678901.csv', 'report-111111111111.csv']
+      )
+    self.assertEqual(result['counts'], {'budgets': 20})
+    self.assertIn('reports of 20 budgets written for 2 accounts', result['message'])
+
+
+  def test_report_history_per_account(self):
+    with tempfile.TemporaryDirectory() as report_dir:
+      self._run({
+        'report': True,
+        'report_format': 'jsonl',
+        'report_output': os.path.join(report_dir, 'report.jsonl'),
+        'history': True
+      })
+      with open(os.path.join(report_dir, 'report-111111111111.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+    # the history is read in the account that holds the budget
+    self.assertEqual(
+      self.other_budgets_client.calls['describe_budget_performance_history'],
+      1
+    )
+    self.assertNotIn(
+      'describe_budget_performance_history',
+      self.budgets_client.calls
+    )
+    self.assertEqual(records[0]['history'], [])
+
+
+  def test_targeted_accounts_run(self):
+    (result,) = self._run({'remove_user': '999'})
+    self.assertEqual(result['counts']['removed'], 1)
+    self.assertNotIn('service-catalog_999', self.other_budgets_client.budgets)
+    self.assertEqual(self.budgets_client.budgets, {})
+
+
+  def test_failed_account(self):
+    self.other_budgets_client.describe_budgets = MagicMock(
+      side_effect=RuntimeError('access denied')
+    )
+    (result,) = self._run({})
+    self.assertEqual(
+      result['error'],
+      '1 of 2 accounts failed: account 111111111111 (access denied)'
+    )
+    self.assertEqual(result['counts']['created'], 10)
@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from budget.batch import BatchResult, RunResult, run_batch
+
+
+class TestRunBatch(unittest.TestCase):
+
+  def test_run_batch_outcomes(self):
+    def func(item):
+      if item == 'bad':
+        raise ValueError('bad item')
+      if item == 'done':
+        return False
+    result = run_batch(func, ['a', 'bad', 'done', 'b'], max_workers=2)
+    self.assertEqual(result.succeeded, ['a', 'b'])
+    self.assertEqual(result.unchanged, ['done'])
+    self.assertEqual(list(result.failed), ['bad'])
+
+
+  def test_run_batch_runs_items_concurrently(self):
+    # every call waits for the others, so this only finishes if all of
+    # the items are in flight at the same time
+    barrier = threading.Barrier(4, timeout=5)
+    result = run_batch(lambda item: barrier.wait(), ['1', '2', '3', '4'], 4)
+    self.assertEqual(result.succeeded, ['1', '2', '3', '4'])
+    self.assertEqual(result.failed, {})
+
+
+  def test_run_batch_stops(self):
+    calls = []
+    result = run_batch(
+      calls.append,
+      ['1', '2', '3', '4'],
+      max_workers=1,
+      should_stop=lambda: len(calls) >= 2
+    )
+    self.assertEqual(calls, ['1', '2'])
+    self.assertEqual(result.succeeded, ['1', '2'])
+    self.assertEqual(result.deferred, ['3', '4'])
+
+
+  def test_extend(self):
+    result = BatchResult()
+    result.succeeded = ['1']
+    other = BatchResult()
+    other.succeeded = ['2']
+    other.failed = {'3': ValueError('oops')}
+    other.deferred = ['4']
+    self.assertIs(result.extend(other), result)
+    self.assertEqual(result.succeeded, ['1', '2'])
+    self.assertEqual(list(result.failed), ['3'])
+    self.assertEqual(result.deferred, ['4'])
+
+
+  def test_summary(self):
+    result = BatchResult()
+    result.succeeded = ['1']
+    result.unchanged = ['2']
+    result.failed = {'3': ValueError('oops')}
+    expected = (
+      'Budgets removed for synapse ids: 1; '
+      'Budgets already removed for synapse ids: 2; '
+      'Budgets not removed for synapse ids: 3 (oops)'
+    )
+    self.assertEqual(result.summary('removed'), expected)
+
+
+  def test_summary_of_many(self):
+    result = BatchResult()
+    result.succeeded = [str(n) for n in range(25)]
+    self.assertEqual(
+      result.summary('created'),
+      'Budgets created for synapse ids: 0, 1, 2, 3, 4, 5, 6, 7, 8, 9 and 15 more'
+    )
+
+
+class TestRunResult(unittest.TestCase):
+
+  def _run_result(self):
+    created = BatchResult()
+    created.succeeded = [str(n) for n in range(25)]
+    created.deferred = ['30']
+    removed = BatchResult()
+    removed.failed = {'40': ValueError('oops')}
+    return RunResult(
+      {'created': created, 'updated': BatchResult(), 'removed': removed},
+      {'create': 1.23456}
+    )
+
+
+  def test_summary(self):
+    summary = self._run_result().summary(sample_size=3)
+    self.assertEqual(summary, {
+      'counts': {
+        'created': 25, 'updated': 0, 'removed': 0, 'failed': 1, 'deferred': 1
+      },
+      'timings': {'create': 1.235},
+      'samples': {
+        'created': {'succeeded': ['0', '1', '2'], 'deferred': ['30']},
+        'updated': {},
+        'removed': {'failed': {'40': 'oops'}}
+      }
+    })
+
+
+  def test_write(self):
+    with tempfile.TemporaryDirectory() as output_dir:
+      path = os.path.join(output_dir, 'runs', 'result.jsonl')
+      self._run_result().write(path)
+      with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    self.assertEqual(len(lines), 28)
+    self.assertEqual(
+      lines[0],
+      {'action': 'created', 'outcome': 'succeeded', 'synapse_id': '0'}
+    )
+    self.assertEqual(
+      lines[26],
+      {'action': 'removed', 'outcome': 'failed', 'synapse_id': '40', 'error': 'oops'}
+    )
+    self.assertEqual(lines[27]['counts']['created'], 25)
@@ -0,0 +1,155 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from budget import app
+from budget.deadline import Deadline
+from budget.fingerprints import RECONCILED_STATE_KEY
+from tests.unit.helpers import HandlerTestCase
+
+
+class TestDeadline(unittest.TestCase):
+
+  def test_no_context(self):
+    self.assertFalse(Deadline(None, 5).expired())
+    self.assertFalse(Deadline({}, 5).expired())
+
+
+  def test_reserve(self):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    self.assertFalse(Deadline(context, 5).expired())
+    self.assertTrue(Deadline(context, 20).expired())
+
+
+  def test_not_after(self):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 60000
+    # the deadline of a coordinator that has already passed
+    self.assertTrue(Deadline(context, 5, time.time() - 1).expired())
+    self.assertTrue(Deadline(None, 5, time.time() - 1).expired())
+    # a later deadline does not extend the invocation's own
+    deadline = Deadline(context, 5, time.time() + 3600)
+    self.assertAlmostEqual(deadline.timestamp(), time.time() + 55, delta=1)
+
+
+  def test_timestamp(self):
+    self.assertIsNone(Deadline(None, 5).timestamp())
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    self.assertAlmostEqual(
+      Deadline(context, 5).timestamp(),
+      time.time() + 5,
+      delta=1
+    )
+
+
+class TestCheckpoint(HandlerTestCase):
+
+  members_by_team = {'111': [str(user_id) for user_id in range(10)]}
+
+
+  def get_environment(self):
+    return dict(
+      super().get_environment(),
+      # one change at a time, so the deadline stops the run at a known point
+      BUDGETS_MAX_WORKERS='1'
+    )
+
+
+  def _run(self, event=None, max_creates=None):
+    '''Runs the handler, with a deadline that passes after max_creates
+    budgets have been created by this and earlier runs
+    '''
+    def expired(deadline):
+      return (
+        max_creates is not None and
+        self.budgets_client.calls['create_budget'] >= max_creates
+      )
+    with patch.object(Deadline, 'expired', expired):
+      return app.lambda_handler(event or {}, None)
+
+
+  def test_out_of_time_run_saves_checkpoint(self):
+    result = self._run(max_creates=4)
+
+    self.assertIn('Budgets left to be created by the next run: 6', result['message'])
+    self.assertEqual(len(self.budgets_client.budgets), 4)
+    checkpoint = self.store.get(app.CHECKPOINT_KEY)
+    self.assertEqual(len(checkpoint['create']), 6)
+    self.assertEqual(set(checkpoint['create'].values()), {'111'})
+    self.assertEqual(checkpoint['update'], {})
+    self.assertEqual(checkpoint['delete'], [])
+    self.assertFalse(
+      set(checkpoint['create']) &
+      {name[len(app.BUDGET_NAME_PREFIX):] for name in self.budgets_client.budgets}
+    )
+    # the run was not complete, so the next run checks every budget
+    self.assertIsNone(self.store.get(RECONCILED_STATE_KEY))
+
+
+  def test_next_run_resumes_checkpoint(self):
+    self._run(max_creates=4)
+    checkpoint = self.store.get(app.CHECKPOINT_KEY)
+    result = self._run()
+
+    self.assertIn(
+      f'Budgets created for synapse ids: {", ".join(checkpoint["create"])};',
+      result['message']
+    )
+    self.assertEqual(len(self.budgets_client.budgets), 10)
+    self.assertIsNone(self.store.get(app.CHECKPOINT_KEY))
+    self.assertIsNotNone(self.store.get(RECONCILED_STATE_KEY))
+
+
+  def test_resume_out_of_time(self):
+    self._run(max_creates=4)
+    checkpoint = list(self.store.get(app.CHECKPOINT_KEY)['create'])
+    self.budgets_client.calls.clear()
+    # two budgets are created from the checkpoint before the deadline
+    result = self._run(max_creates=2)
+
+    self.assertIn(
+      f'Budgets created for synapse ids: {", ".join(checkpoint[:2])};',
+      result['message']
+    )
+    # the rest of the run waits, without listing any budgets
+    self.assertEqual(self.budgets_client.calls['describe_budgets'], 0)
+    self.assertEqual(
+      list(self.store.get(app.CHECKPOINT_KEY)['create']),
+      checkpoint[2:]
+    )
+
+
+  def test_plan_mode_ignores_checkpoint(self):
+    self._run(max_creates=4)
+    result = self._run({'plan': True})
+
+    self.assertEqual(result['plan']['counts']['create'], 6)
+    self.assertEqual(len(self.budgets_client.budgets), 4)
+    self.assertIsNotNone(self.store.get(app.CHECKPOINT_KEY))
+
+
+  def test_fingerprint_lookups_stop_at_deadline(self):
+    self._run()
+    # a new container, with none of the fingerprints in its index
+    self.store.delete(app.FINGERPRINT_INDEX_KEY)
+    self.store.delete(RECONCILED_STATE_KEY)
+    self.budgets_client.calls.clear()
+
+    def expired(deadline):
+      return self.budgets_client.calls['list_tags_for_resource'] >= 3
+    with patch.object(Deadline, 'expired', expired):
+      result = app.lambda_handler({'full_check': True}, None)
+
+    self.assertEqual(self.budgets_client.calls['list_tags_for_resource'], 3)
+    # the budgets whose tags were not read are not treated as drifted
+    self.assertEqual(result['counts']['updated'], 0)
+    self.assertEqual(len(self.store.get(app.FINGERPRINT_INDEX_KEY)), 3)
+    self.assertIsNone(self.store.get(RECONCILED_STATE_KEY))
+
+    # the next run only reads the tags that were left
+    self.budgets_client.calls.clear()
+    self._run({'full_check': True})
+    self.assertEqual(self.budgets_client.calls['list_tags_for_resource'], 7)
+    self.assertIsNotNone(self.store.get(RECONCILED_STATE_KEY))
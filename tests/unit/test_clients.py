@@ -0,0 +1,135 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from requests import Response
+from synapseclient.core.exceptions import SynapseHTTPError
+
+from budget import clients
+
+
+def _http_error(status_code):
+  response = Response()
+  response.status_code = status_code
+  return SynapseHTTPError(f'{status_code} Client Error', response=response)
+
+
+class TestClients(unittest.TestCase):
+
+  def tearDown(self):
+    clients.reset()
+    clients.configure(10, 'standard')
+
+
+  def test_get_client_reuses_client(self):
+    first = clients.get_client('budgets')
+    second = clients.get_client('budgets')
+    self.assertIs(first, second)
+
+
+  def test_get_client_shares_session(self):
+    with patch('boto3.session.Session') as session_mock:
+      clients.get_client('budgets')
+      clients.get_client('sts')
+    session_mock.assert_called_once()
+    self.assertEqual(session_mock.return_value.client.call_count, 2)
+
+
+  def test_get_client_with_role(self):
+    role_arn = 'arn:aws:iam::111111111111:role/budget-maker'
+    own = clients.get_client('budgets')
+    other = clients.get_client('budgets', role_arn)
+    self.assertIsNot(own, other)
+    self.assertIs(clients.get_client('budgets', role_arn), other)
+    stub = MagicMock()
+    clients.set_client('budgets', stub, role_arn)
+    self.assertIs(clients.get_client('budgets', role_arn), stub)
+    self.assertIs(clients.get_client('budgets'), own)
+
+
+  def test_configure_sets_pool_and_retries(self):
+    clients.configure(32, 'adaptive')
+    client = clients.get_client('budgets')
+    self.assertEqual(client.meta.config.max_pool_connections, 32)
+    self.assertEqual(client.meta.config.retries['mode'], 'adaptive')
+
+
+  def test_configure_drops_clients_only_when_changed(self):
+    client = clients.get_client('budgets')
+    clients.configure(10, 'standard')
+    self.assertIs(clients.get_client('budgets'), client)
+    clients.configure(20, 'standard')
+    self.assertIsNot(clients.get_client('budgets'), client)
+
+
+  def test_set_client(self):
+    stub = MagicMock()
+    clients.set_client('budgets', stub)
+    # registered clients outlive configuration changes
+    clients.configure(20, 'legacy')
+    self.assertIs(clients.get_client('budgets'), stub)
+    clients.reset()
+    self.assertIsNot(clients.get_client('budgets'), stub)
+
+
+  @patch('synapseclient.Synapse')
+  def test_synapse_client_reused_and_anonymous(self, MockSynapse):
+    with patch.dict('os.environ', {}, clear=True):
+      first = clients.get_synapse_client()
+      second = clients.get_synapse_client()
+    self.assertIs(first, second)
+    MockSynapse.assert_called_once()
+    MockSynapse.return_value.login.assert_not_called()
+
+
+  @patch('synapseclient.Synapse')
+  def test_synapse_client_logs_in_with_token(self, MockSynapse):
+    with patch.dict('os.environ', {'SYNAPSE_AUTH_TOKEN': 'secret'}):
+      clients.get_synapse_client()
+    MockSynapse.return_value.login.assert_called_once_with(
+      authToken='secret', silent=True
+    )
+
+
+  @patch('synapseclient.Synapse')
+  def test_synapse_client_logs_in_with_token_file(self, MockSynapse):
+    with tempfile.NamedTemporaryFile('w', delete=False) as f:
+      f.write('secret-from-file\n')
+    try:
+      with patch.dict('os.environ', {'SYNAPSE_AUTH_TOKEN_FILE': f.name}, clear=True):
+        clients.get_synapse_client()
+    finally:
+      os.remove(f.name)
+    MockSynapse.return_value.login.assert_called_once_with(
+      authToken='secret-from-file', silent=True
+    )
+
+
+  @patch('synapseclient.Synapse')
+  def test_call_synapse_rebuilds_client_after_auth_failure(self, MockSynapse):
+    expired, fresh = MagicMock(name='expired'), MagicMock(name='fresh')
+    MockSynapse.side_effect = [expired, fresh]
+    func = MagicMock(side_effect=[_http_error(401), 'roster'])
+    result = clients.call_synapse(func)
+    self.assertEqual(result, 'roster')
+    self.assertEqual(func.call_args_list[0][0][0], expired)
+    self.assertEqual(func.call_args_list[1][0][0], fresh)
+    self.assertIs(clients.get_synapse_client(), fresh)
+
+
+  @patch('synapseclient.Synapse')
+  def test_call_synapse_keeps_client_after_other_errors(self, MockSynapse):
+    func = MagicMock(side_effect=_http_error(404))
+    with self.assertRaises(SynapseHTTPError):
+      clients.call_synapse(func)
+    func.assert_called_once()
+    MockSynapse.assert_called_once()
+
+
+  @patch('synapseclient.Synapse')
+  def test_set_synapse_client(self, MockSynapse):
+    fake = MagicMock()
+    clients.set_synapse_client(fake)
+    self.assertIs(clients.get_synapse_client(), fake)
+    MockSynapse.assert_not_called()
@@ -6,7 +6,7 @@ import boto3
 from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 
-from budget import app
+from budget import app, clients
 
 
 class TestCompareBudgetsAndUsers(unittest.TestCase):
@@ -18,6 +18,7 @@ class TestCompareBudgetsAndUsers(unittest.TestCase):
 
   def tearDown(self):
     app.configuration = None
+    clients.reset()
 
 
   # these are very truncated mock responses containing as few fields as possible
@@ -43,7 +44,7 @@ class TestCompareBudgetsAndUsers(unittest.TestCase):
   def test_no_difference(self):
     budgets_client = boto3.client('budgets')
     with Stubber(budgets_client) as stubber:
-      app.get_client = MagicMock(return_value=budgets_client)
+      clients.set_client('budgets', budgets_client)
       stubber.add_response('describe_budgets', self.mock_budget_response_1)
       user_id_list = ['3388489']
       user_ids_without_budget, budgets_to_remove = app.compare_budgets_and_users(user_id_list)
@@ -56,7 +57,7 @@ class TestCompareBudgetsAndUsers(unittest.TestCase):
   def test_missing_user(self):
     budgets_client = boto3.client('budgets')
     with Stubber(budgets_client) as stubber:
-      app.get_client = MagicMock(return_value=budgets_client)
+      clients.set_client('budgets', budgets_client)
       stubber.add_response('describe_budgets', self.mock_budget_response_1)
       user_id_list = ['3388489', '1234567']
       user_ids_without_budget, budgets_to_remove = app.compare_budgets_and_users(user_id_list)
@@ -69,7 +70,7 @@ class TestCompareBudgetsAndUsers(unittest.TestCase):
   def test_too_many_budgets(self):
     budgets_client = boto3.client('budgets')
     with Stubber(budgets_client) as stubber:
-      app.get_client = MagicMock(return_value=budgets_client)
+      clients.set_client('budgets', budgets_client)
       stubber.add_response('describe_budgets', self.mock_budget_response_2)
       user_id_list = ['3388489']
       user_ids_without_budget, budgets_to_remove = app.compare_budgets_and_users(user_id_list)
@@ -81,7 +82,7 @@ class TestCompareBudgetsAndUsers(unittest.TestCase):
   def test_non_service_catalog_budgets_present(self):
     budgets_client = boto3.client('budgets')
     with Stubber(budgets_client) as stubber:
-      app.get_client = MagicMock(return_value=budgets_client)
+      clients.set_client('budgets', budgets_client)
       # response includes a budget that uses a different naming convention
       stubber.add_response('describe_budgets', self.mock_budget_response_3)
       user_id_list = ['3388489']
@@ -91,3 +92,48 @@ class TestCompareBudgetsAndUsers(unittest.TestCase):
       expected_budgets_to_remove = []
       self.assertCountEqual(user_ids_without_budget, expected_without_budget)
       self.assertCountEqual(budgets_to_remove, expected_budgets_to_remove)
+
+
+  def test_paginated_budgets(self):
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      clients.set_client('budgets', budgets_client)
+      # the second page holds a budget that a single call would never see
+      first_page = dict(self.mock_budget_response_3, NextToken='page-2')
+      stubber.add_response('describe_budgets', first_page, {
+        'AccountId': '012345678901',
+        'MaxResults': app.DESCRIBE_BUDGETS_PAGE_SIZE
+      })
+      stubber.add_response('describe_budgets', self.mock_budget_response_2, {
+        'AccountId': '012345678901',
+        'MaxResults': app.DESCRIBE_BUDGETS_PAGE_SIZE,
+        'NextToken': 'page-2'
+      })
+      user_id_list = ['3388489', '1234567']
+      user_ids_without_budget, budgets_to_remove = app.compare_budgets_and_users(user_id_list)
+      stubber.assert_no_pending_responses()
+    self.assertCountEqual(user_ids_without_budget, [])
+    self.assertCountEqual(budgets_to_remove, [])
+
+
+  def test_list_service_catalog_budgets_filters_prefix(self):
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      stubber.add_response('describe_budgets', self.mock_budget_response_3)
+      result = [
+        budget['BudgetName']
+        for budget in app.list_service_catalog_budgets(budgets_client)
+      ]
+    self.assertEqual(result, ['service-catalog_3388489'])
+
+
+  def test_compare_listed_budgets(self):
+    with patch('budget.app.list_budget_user_ids') as list_mock:
+      user_ids_without_budget, budgets_to_remove = app.compare_budgets_and_users(
+        ['3388489', '1234567'],
+        budget_user_ids={'3388489', '3406211'}
+      )
+    # budgets already listed are not listed again
+    list_mock.assert_not_called()
+    self.assertEqual(user_ids_without_budget, ['1234567'])
+    self.assertEqual(budgets_to_remove, ['3406211'])
@@ -1,9 +1,12 @@
 from pathlib import Path
 import json
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 
 from budget.config import Config
+from cerberus import Validator
 import yaml
 
 
@@ -39,12 +42,201 @@ class TestConfig(unittest.TestCase):
     self.assertEqual(config.account_id, account_id)
     self.assertEqual(config.notification_topic_arn, topic_arn)
     self.assertEqual(config.end_user_role_name, end_user_role_name)
+    self.assertEqual(config.synapse_max_workers, 8)
     expected_budget_rules = yaml.safe_load(budget_rules)
     expected_thresholds = yaml.safe_load(thresholds)
     self.assertDictEqual(config.budget_rules, expected_budget_rules)
     self.assertDictEqual(config.thresholds, expected_thresholds)
 
 
+  def _environment(self):
+    return {
+      'AWS_ACCOUNT_ID': '012345678901',
+      'NOTIFICATION_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:mytopic',
+      'END_USER_ROLE_NAME': 'SomeRoleName',
+      'BUDGET_RULES': (
+        'teams:\n'
+        '  \'3412821\':\n'
+        '    amount: \'10\'\n'
+        '    period: ANNUALLY\n'
+        '    unit: USD\n'
+        '    community_manager_emails:\n'
+        '      - someone@example.org'
+        ),
+      'THRESHOLDS': (
+        'notify_user_only: [25.0, 50.0, 80.0]\n'
+        'notify_admins_too: [90.0, 100.0, 110.0]'
+        )
+    }
+
+
+  @patch.object(Config, '_cached', None)
+  def test_load_reuses_config(self):
+    environment = self._environment()
+    with patch.dict('os.environ', environment):
+      first = Config.load()
+      with patch('yaml.safe_load') as yaml_mock:
+        second = Config.load()
+    self.assertIs(first, second)
+    yaml_mock.assert_not_called()
+
+
+  @patch.object(Config, '_cached', None)
+  def test_load_rebuilds_config_when_environment_changes(self):
+    environment = self._environment()
+    with patch.dict('os.environ', environment):
+      first = Config.load()
+    environment['BUDGET_RULES'] = environment['BUDGET_RULES'].replace('10', '20')
+    with patch.dict('os.environ', environment):
+      second = Config.load()
+    self.assertIsNot(first, second)
+    self.assertNotEqual(first.fingerprint, second.fingerprint)
+    self.assertEqual(second.budget_rules['teams']['3412821']['amount'], '20')
+
+
+  @patch.object(Config, '_cached', None)
+  @patch.object(Config, '_budget_rules_sources', {})
+  def test_load_budget_rules_source(self):
+    environment = self._environment()
+    budget_rules = environment.pop('BUDGET_RULES')
+    with tempfile.TemporaryDirectory() as rules_dir:
+      path = os.path.join(rules_dir, 'rules.yaml')
+      with open(path, 'w') as f:
+        f.write(budget_rules)
+      environment['BUDGET_RULES_SOURCE'] = f'file://{path}'
+      with patch.dict('os.environ', environment):
+        first = Config.load()
+        with patch('yaml.safe_load') as yaml_mock:
+          second = Config.load()
+        yaml_mock.assert_not_called()
+
+        with open(path, 'w') as f:
+          f.write(budget_rules.replace('10', '20'))
+        os.utime(path, ns=(0, 0))
+        third = Config.load()
+
+    self.assertIs(first, second)
+    self.assertEqual(first.budget_rules['teams']['3412821']['amount'], '10')
+    self.assertIsNot(first, third)
+    self.assertNotEqual(first.fingerprint, third.fingerprint)
+    self.assertEqual(third.budget_rules['teams']['3412821']['amount'], '20')
+
+
+  def test_aws_client_settings(self):
+    environment = dict(self._environment(), BUDGETS_MAX_WORKERS='16')
+    with patch.dict('os.environ', environment):
+      config = Config()
+    # the pool grows to match the number of budgets workers
+    self.assertEqual(config.aws_max_pool_connections, 16)
+    self.assertEqual(config.aws_retry_mode, 'standard')
+    # the async engine runs two pools of budgets workers and a planner thread
+    with patch.dict('os.environ', dict(environment, ENGINE='async')):
+      self.assertEqual(Config().aws_max_pool_connections, 33)
+
+
+  def test_aws_retry_mode_invalid(self):
+    environment = dict(self._environment(), AWS_RETRY_MODE='sometimes')
+    with patch.dict('os.environ', environment):
+      with self.assertRaises(ValueError) as context_manager:
+        Config()
+    self.assertIn('AWS_RETRY_MODE', str(context_manager.exception))
+
+
+  def test_engine(self):
+    with patch.dict('os.environ', self._environment()):
+      self.assertEqual(Config().engine, 'threads')
+    with patch.dict('os.environ', dict(self._environment(), ENGINE='async')):
+      self.assertEqual(Config().engine, 'async')
+
+
+  def test_engine_invalid(self):
+    environment = dict(self._environment(), ENGINE='fibers')
+    with patch.dict('os.environ', environment):
+      with self.assertRaises(ValueError) as context_manager:
+        Config()
+    self.assertIn('ENGINE', str(context_manager.exception))
+
+
+  def test_log_level(self):
+    with patch.dict('os.environ', self._environment()):
+      self.assertEqual(Config().log_level, 'INFO')
+    with patch.dict('os.environ', dict(self._environment(), LOG_LEVEL='debug')):
+      self.assertEqual(Config().log_level, 'DEBUG')
+    with patch.dict('os.environ', dict(self._environment(), LOG_LEVEL='LOUD')):
+      with self.assertRaises(ValueError) as context_manager:
+        Config()
+    self.assertIn('LOG_LEVEL', str(context_manager.exception))
+
+
+  def test_report(self):
+    with patch.dict('os.environ', dict(self._environment(), STATE_DIR='/state')):
+      config = Config()
+    self.assertEqual(config.report_format, 'csv')
+    self.assertEqual(config.report_output, '/state/spend-report.csv')
+    environment = dict(self._environment(), REPORT_FORMAT='parquet')
+    with patch.dict('os.environ', environment):
+      with self.assertRaises(ValueError) as context_manager:
+        Config()
+    self.assertIn('REPORT_FORMAT', str(context_manager.exception))
+
+
+  def test_accounts(self):
+    with patch.dict('os.environ', self._environment()):
+      self.assertEqual(Config().accounts, [])
+    accounts = (
+      '- account_id: 012345678901\n'
+      '- account_id: \'111111111111\'\n'
+      '  role_arn: arn:aws:iam::111111111111:role/budget-maker\n'
+      '  end_user_role_name: OtherRoleName'
+    )
+    with patch.dict('os.environ', dict(self._environment(), ACCOUNTS=accounts)):
+      config = Config()
+    self.assertEqual(config.accounts, [
+      {
+        'account_id': '012345678901',
+        'role_arn': None,
+        'end_user_role_name': 'SomeRoleName',
+        'notification_topic_arn': 'arn:aws:sns:us-east-1:123456789012:mytopic'
+      },
+      {
+        'account_id': '111111111111',
+        'role_arn': 'arn:aws:iam::111111111111:role/budget-maker',
+        'end_user_role_name': 'OtherRoleName',
+        'notification_topic_arn': 'arn:aws:sns:us-east-1:123456789012:mytopic'
+      }
+    ])
+
+
+  def test_accounts_invalid(self):
+    duplicates = '- account_id: \'111111111111\'\n- account_id: \'111111111111\''
+    with patch.dict('os.environ', dict(self._environment(), ACCOUNTS=duplicates)):
+      with self.assertRaises(ValueError) as context_manager:
+        Config()
+    self.assertIn('more than once', str(context_manager.exception))
+    environment = dict(
+      self._environment(),
+      ACCOUNTS='- account_id: \'111111111111\'',
+      SHARD_COUNT='2'
+    )
+    with patch.dict('os.environ', environment):
+      with self.assertRaises(ValueError) as context_manager:
+        Config()
+    self.assertIn('SHARD_COUNT', str(context_manager.exception))
+    with patch.dict('os.environ', dict(self._environment(), ACCOUNTS='- role_arn: x')):
+      with self.assertRaises(Exception):
+        Config()
+
+
+  @patch.object(Config, '_validators', {})
+  def test_validators_compiled_once(self):
+    with patch.dict('os.environ', self._environment()), \
+      patch('cerberus.Validator', wraps=Validator) as validator_mock:
+      Config()
+      Config()
+    # one validator each for the budget rules and the thresholds
+    self.assertEqual(validator_mock.call_count, 2)
+
+
   def test_get_env_var_present(self):
     env_var_value = 'some_value'
     env_var_key = 'SOME_ENV_VAR'
@@ -66,6 +258,39 @@ class TestConfig(unittest.TestCase):
     self.assertEqual(str(context_manager.exception), expected)
 
 
+  def test_get_int_env_var_default(self):
+    with patch.dict('os.environ', {}, clear=True):
+      result = Config._get_int_env_var('SOME_ENV_VAR', 8)
+    self.assertEqual(result, 8)
+
+
+  def test_get_int_env_var_present(self):
+    with patch.dict('os.environ', {'SOME_ENV_VAR': '3'}):
+      result = Config._get_int_env_var('SOME_ENV_VAR', 8)
+    self.assertEqual(result, 3)
+
+
+  def test_get_int_env_var_invalid(self):
+    for value in ['zero', '0', '-2']:
+      with patch.dict('os.environ', {'SOME_ENV_VAR': value}):
+        with self.assertRaises(ValueError) as context_manager:
+          Config._get_int_env_var('SOME_ENV_VAR', 8)
+      expected = (
+        'Lambda configuration error: '
+        'environment variable SOME_ENV_VAR must be a positive integer'
+      )
+      self.assertEqual(str(context_manager.exception), expected)
+
+
+  def test_get_bool_env_var(self):
+    for (value, expected) in [('', False), ('true', True), ('FALSE', False)]:
+      with patch.dict('os.environ', {'SOME_ENV_VAR': value}):
+        self.assertEqual(Config._get_bool_env_var('SOME_ENV_VAR'), expected)
+    with patch.dict('os.environ', {'SOME_ENV_VAR': 'maybe'}):
+      with self.assertRaises(ValueError):
+        Config._get_bool_env_var('SOME_ENV_VAR')
+
+
   def test_load_yaml_happy(self):
     yaml_input = 'foo:\n  - bar'
     result = Config._load_yaml(yaml_input)
@@ -6,7 +6,9 @@ import boto3
 from botocore.exceptions import ClientError
 from botocore.stub import Stubber, ANY
 
-from budget import app
+from budget import app, clients
+from budget.fingerprints import get_budget_fingerprint
+from budget.throttle import AdaptiveRateLimiter
 
 
 class TestCreateBudgets(unittest.TestCase):
@@ -18,6 +20,7 @@ class TestCreateBudgets(unittest.TestCase):
 
   def tearDown(self):
     app.configuration = None
+    clients.reset()
 
 
   def test_create_budgets_no_new_users(self):
@@ -27,11 +30,11 @@ class TestCreateBudgets(unittest.TestCase):
     # if there are no new users, we expect a message indicating that no
     # new budgets were created
     expected = 'Budgets created for synapse ids: none'
-    self.assertEqual(result, expected)
+    self.assertEqual(result.summary('created'), expected)
+    self.assertEqual(result.failed, {})
 
 
-  @patch('budget.app.create_budget_definition', MagicMock(return_value={}))
-  @patch('budget.app.create_notification_definitions', MagicMock(return_value=[]))
+  @patch('budget.app._get_budget_definitions', MagicMock(return_value=({}, [])))
   @patch('budget.app.create_budget', MagicMock(return_value={}))
   def test_create_budgets_some_users(self):
     app.configuration.budget_rules = {'teams': {'12345': {}}}
@@ -41,7 +44,52 @@ class TestCreateBudgets(unittest.TestCase):
     # if there are new users, we expect a message that budgets were
     # created for each of them
     expected = 'Budgets created for synapse ids: 3406211, 3388489'
-    self.assertEqual(result, expected)
+    self.assertEqual(result.summary('created'), expected)
+    self.assertEqual(result.succeeded, new_users)
+
+
+  def test_create_budgets_one_user_fails(self):
+    app.configuration.budget_rules = {
+      'teams': {
+        '12345': {
+          'amount': '100',
+          'period': 'ANNUALLY',
+          'community_manager_emails': []
+        }
+      }
+    }
+    app.configuration.thresholds = {
+      'notify_user_only': [50.0],
+      'notify_admins_too': [100.0]
+    }
+    new_users = ['3406211', '3388489']
+    teams_by_user_id = {'3406211': ['foo'], '3388489': ['12345']}
+    with patch('budget.app.create_budget', MagicMock(return_value={})) as create_mock:
+      result = app.create_budgets(new_users, teams_by_user_id, max_workers=2)
+    # the failure is reported for its user, and the other budget is created
+    self.assertEqual(result.succeeded, ['3388489'])
+    self.assertEqual(list(result.failed), ['3406211'])
+    create_mock.assert_called_once_with(
+      app.create_budget_definition('3388489', '12345'),
+      app.create_notification_definitions('3388489', '12345')
+    )
+    expected = (
+      'Budgets created for synapse ids: 3388489; '
+      'Budgets not created for synapse ids: '
+      '3406211 (No budget rules available for team foo)'
+    )
+    self.assertEqual(result.summary('created'), expected)
+
+
+  @patch('budget.app.create_budget')
+  @patch('budget.app._get_budget_definitions', return_value=({}, []))
+  def test_create_user_budget_logs_synapse_id(self, definitions_mock, create_mock):
+    with self.assertLogs(app.log, 'DEBUG') as logs:
+      app.create_user_budget('3388489', '3412821')
+    self.assertEqual(logs.output, [
+      'DEBUG:budget.app:Creating budget for synapse user 3388489, '
+      'member of team 3412821'
+    ])
 
 
   def test_create_budget_definition(self):
@@ -176,11 +224,18 @@ class TestCreateBudgets(unittest.TestCase):
     notification_definitions = app.create_notification_definitions(synapse_id, team)
     budgets_client = boto3.client('budgets')
     with Stubber(budgets_client) as stubber:
-      app.get_client = MagicMock(return_value=budgets_client)
+      clients.set_client('budgets', budgets_client)
       expected_params = {
         'AccountId': '012345678901',
         'Budget': budget_definition,
-        'NotificationsWithSubscribers': notification_definitions
+        'NotificationsWithSubscribers': notification_definitions,
+        'ResourceTags': [{
+          'Key': 'lambda-budgets:fingerprint',
+          'Value': get_budget_fingerprint(
+            budget_definition,
+            notification_definitions
+          )
+        }]
       }
       # verify that the boto3 client will be called with the expected values
       # boto3 also silently verifies that what is submitted follows
@@ -189,3 +244,52 @@ class TestCreateBudgets(unittest.TestCase):
       result = app.create_budget(budget_definition, notification_definitions)
       expected = {}
       self.assertEqual(result, expected)
+
+
+  @patch('budget.throttle.time.sleep', MagicMock())
+  @patch('budget.app.budgets_rate_limiter', AdaptiveRateLimiter(100))
+  def test_create_budget_retries_throttling(self):
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      clients.set_client('budgets', budgets_client)
+      stubber.add_client_error('create_budget', 'ThrottlingException')
+      stubber.add_response('create_budget', {})
+      result = app.create_budget({
+        'BudgetName': 'service-catalog_3388489',
+        'TimeUnit': 'ANNUALLY',
+        'BudgetType': 'COST'
+      }, [])
+      stubber.assert_no_pending_responses()
+    self.assertEqual(result, {})
+
+
+  def test_budget_template_matches_definitions(self):
+    app.configuration.budget_rules = {
+      'teams': {
+        '12345': {
+          'amount': '100',
+          'period': 'ANNUALLY',
+          'community_manager_emails': ['sc-support@sagebase.org']
+        }
+      }
+    }
+    app.configuration.end_user_role_name = 'ServiceCatalogEndusers'
+    app.configuration.thresholds = {
+      'notify_user_only': [25.0, 50.0],
+      'notify_admins_too': [100.0]
+    }
+    template = app.get_budget_template('12345')
+    for synapse_id in ['3388489', '3406211']:
+      budget_definition, notification_definitions = template.render(synapse_id)
+      self.assertDictEqual(
+        budget_definition,
+        app.create_budget_definition(synapse_id, '12345')
+      )
+      self.assertEqual(
+        notification_definitions,
+        app.create_notification_definitions(synapse_id, '12345')
+      )
+    # the template is made once per team and configuration
+    self.assertIs(app.get_budget_template('12345'), template)
+    app.configuration.fingerprint = 'changed'
+    self.assertIsNot(app.get_budget_template('12345'), template)
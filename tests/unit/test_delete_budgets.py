@@ -6,7 +6,7 @@ import boto3
 from botocore.exceptions import ClientError
 from botocore.stub import Stubber, ANY
 
-from budget import app
+from budget import app, clients
 
 
 class TestDeleteBudgets(unittest.TestCase):
@@ -18,20 +18,21 @@ class TestDeleteBudgets(unittest.TestCase):
 
   def tearDown(self):
     app.configuration = None
+    clients.reset()
 
 
   def test_no_budgets_to_delete(self):
     no_budgets_to_remove = []
     result = app.delete_budgets(no_budgets_to_remove)
     expected = 'Budgets removed for synapse ids: none'
-    self.assertEqual(result, expected)
+    self.assertEqual(result.summary('removed'), expected)
 
 
   def test_budgets_deleted(self):
     synapse_ids = ['3406211', '3388489']
     budgets_client = boto3.client('budgets')
     with Stubber(budgets_client) as stubber:
-      app.get_client = MagicMock(return_value=budgets_client)
+      clients.set_client('budgets', budgets_client)
       for synapse_id in synapse_ids:
         expected_params = {
           'AccountId': '012345678901',
@@ -39,6 +40,39 @@ class TestDeleteBudgets(unittest.TestCase):
 
         }
         stubber.add_response('delete_budget', {}, expected_params)
-      result = app.delete_budgets(synapse_ids)
+      # the stubber answers calls in order, so delete one budget at a time
+      result = app.delete_budgets(synapse_ids, max_workers=1)
 
     expected = 'Budgets removed for synapse ids: 3406211, 3388489'
+    self.assertEqual(result.summary('removed'), expected)
+
+
+  def test_budget_already_gone(self):
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      clients.set_client('budgets', budgets_client)
+      stubber.add_client_error('delete_budget', 'NotFoundException')
+      result = app.delete_budgets(['3406211'])
+
+    self.assertEqual(result.succeeded, [])
+    self.assertEqual(result.unchanged, ['3406211'])
+    self.assertEqual(result.failed, {})
+    expected = (
+      'Budgets removed for synapse ids: none; '
+      'Budgets already removed for synapse ids: 3406211'
+    )
+    self.assertEqual(result.summary('removed'), expected)
+
+
+  def test_budget_delete_fails(self):
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      clients.set_client('budgets', budgets_client)
+      stubber.add_client_error('delete_budget', 'AccessDeniedException')
+      stubber.add_response('delete_budget', {})
+      # the failed delete does not stop the next one
+      result = app.delete_budgets(['3406211', '3388489'], max_workers=1)
+
+    self.assertEqual(result.succeeded, ['3388489'])
+    self.assertEqual(list(result.failed), ['3406211'])
+    self.assertIsInstance(result.failed['3406211'], ClientError)
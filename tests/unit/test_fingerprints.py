@@ -0,0 +1,53 @@
+import tempfile
+import unittest
+
+from budget.fingerprints import (
+  FingerprintIndex,
+  get_budget_fingerprint,
+  get_state_digest
+)
+from budget.state import FileStore
+
+
+class TestFingerprints(unittest.TestCase):
+
+  def test_fingerprint_ignores_key_order(self):
+    first = get_budget_fingerprint({'a': 1, 'b': 2}, [{'c': 3}])
+    second = get_budget_fingerprint({'b': 2, 'a': 1}, [{'c': 3}])
+    self.assertEqual(first, second)
+
+
+  def test_fingerprint_changes_with_definition(self):
+    first = get_budget_fingerprint({'Amount': '10'}, [])
+    second = get_budget_fingerprint({'Amount': '20'}, [])
+    self.assertNotEqual(first, second)
+
+
+  def test_state_digest(self):
+    digest = get_state_digest({'1': ['A'], '2': ['A', 'B']}, 'config')
+    self.assertEqual(
+      digest,
+      get_state_digest({'2': ['A', 'B'], '1': ['A']}, 'config')
+    )
+    # the first team of a user decides their budget
+    self.assertNotEqual(
+      digest,
+      get_state_digest({'1': ['A'], '2': ['B', 'A']}, 'config')
+    )
+    self.assertNotEqual(
+      digest,
+      get_state_digest({'1': ['A'], '2': ['A', 'B']}, 'other config')
+    )
+
+
+  def test_index_saved_to_store(self):
+    with tempfile.TemporaryDirectory() as directory:
+      store = FileStore(directory)
+      index = FingerprintIndex(store)
+      index.set('3388489', 'abc')
+      index.set('3406211', 'def')
+      index.discard('3406211')
+      index.save()
+      reloaded = FingerprintIndex(store)
+    self.assertEqual(reloaded.get('3388489'), 'abc')
+    self.assertIsNone(reloaded.get('3406211'))
@@ -1,8 +1,11 @@
 import json
+import tempfile
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 
-from budget import app
+from budget import app, clients
+from budget.state import FileStore
 import synapseclient
 
 
@@ -27,9 +30,11 @@ class TestGetUsers(unittest.TestCase):
   def setUp(self):
     app.configuration = MagicMock()
     app.configuration.account_id = '012345678901'
+    clients.reset()
 
   def tearDown(self):
     app.configuration = None
+    clients.reset()
 
   @patch('synapseclient.Synapse')
   def test_get_users(self, MockSynapse):
@@ -53,3 +58,72 @@ class TestGetUsers(unittest.TestCase):
     teams = ['something_invalid']
     with self.assertRaises(ValueError):
         app.get_users(teams)
+
+  @patch('synapseclient.Synapse')
+  def test_get_users_merges_in_team_order(self, MockSynapse):
+    # the first team answers last, but its membership must still come first
+    def slow_first_team(team_id):
+      if team_id == 'A':
+        time.sleep(0.05)
+      return [{ "teamId": team_id, "member": {"ownerId": "1111111"}, "isAdmin": False }]
+    MockSynapse.return_value.getTeamMembers=slow_first_team
+    teams = ['A', 'B', 'C']
+    result = app.get_users(teams, max_workers=3)
+    expected = { '1111111': ['A', 'B', 'C'] }
+    self.assertDictEqual(result, expected)
+
+  @patch('synapseclient.Synapse')
+  def test_get_users_no_teams(self, MockSynapse):
+    result = app.get_users([])
+    self.assertDictEqual(result, {})
+
+
+class TestGetUsersIncremental(unittest.TestCase):
+
+  def setUp(self):
+    clients.reset()
+    self.directory = tempfile.TemporaryDirectory()
+    self.store = FileStore(self.directory.name)
+
+  def tearDown(self):
+    clients.reset()
+    self.directory.cleanup()
+
+  def _mock_synapse(self, MockSynapse, counts):
+    syn = MockSynapse.return_value
+    syn.getTeamMembers = MagicMock(side_effect=mock_get_team_members)
+    syn.restGET = MagicMock(
+      side_effect=lambda uri: {'count': counts[uri.split('/')[-1]]}
+    )
+    return syn
+
+  @patch('synapseclient.Synapse')
+  def test_unchanged_team_uses_snapshot(self, MockSynapse):
+    syn = self._mock_synapse(MockSynapse, {'12345': 2, '67890': 2})
+    teams = ['12345', '67890']
+    first = app.get_users(teams, store=self.store)
+    second = app.get_users(teams, store=self.store)
+    expected = { '8901234': ['12345'], '2345678': ['67890']}
+    self.assertDictEqual(first, expected)
+    self.assertDictEqual(second, expected)
+    # each roster is only fetched once, the second run only checks counts
+    self.assertEqual(syn.getTeamMembers.call_count, 2)
+    self.assertEqual(syn.restGET.call_count, 4)
+
+  @patch('synapseclient.Synapse')
+  def test_changed_count_refreshes_team(self, MockSynapse):
+    counts = {'12345': 2, '67890': 2}
+    syn = self._mock_synapse(MockSynapse, counts)
+    teams = ['12345', '67890']
+    app.get_users(teams, store=self.store)
+    counts['67890'] = 3
+    app.get_users(teams, store=self.store)
+    fetched = [call[0][0] for call in syn.getTeamMembers.call_args_list]
+    self.assertCountEqual(fetched, ['12345', '67890', '67890'])
+
+  @patch('synapseclient.Synapse')
+  def test_old_snapshot_refreshes_team(self, MockSynapse):
+    syn = self._mock_synapse(MockSynapse, {'12345': 2})
+    app.get_users(['12345'], store=self.store)
+    app.get_users(['12345'], store=self.store, snapshot_max_age=0)
+    self.assertEqual(syn.getTeamMembers.call_count, 2)
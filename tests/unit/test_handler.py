@@ -1,46 +1,244 @@
+import io
 import json
+import tempfile
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from budget import app
+from budget.batch import BatchResult
 
 
 class TestHandler(unittest.TestCase):
 
+  def _configure(self, config_mock):
+    configuration = config_mock.load.return_value
+    configuration.aws_max_pool_connections = 10
+    configuration.aws_retry_mode = 'standard'
+    configuration.budgets_max_tps = 5
+    configuration.plan_mode = False
+    configuration.engine = 'threads'
+    configuration.shard_count = 1
+    configuration.full_check_interval = 3600
+    configuration.deadline_reserve = 5
+    configuration.log_level = 'DEBUG'
+    configuration.result_output = None
+    configuration.accounts = []
+    configuration.fingerprint = 'fingerprint'
+    return configuration
+
+
   # This test only looks at how the success message is put together
   # for the return value. All the functions it calls have their own tests.
   def test_handler_happy_path(self):
+    budgets_created = BatchResult()
+    budgets_created.succeeded = ['3388489']
+    budgets_updated = BatchResult()
+    budgets_updated.succeeded = ['3412821']
+    budgets_removed = BatchResult()
+    budgets_removed.succeeded = ['3406211']
     with patch('budget.app.Config') as config_mock, \
+      patch('budget.app.get_state_store',
+        MagicMock(return_value=MagicMock(get=MagicMock(return_value=None)))), \
       patch('budget.app.get_users',
       MagicMock(return_value={})) as users_mock, \
         patch('budget.app.check_user_duplicates',
         MagicMock(return_value='')) as dupe_mock, \
+      patch('budget.app.list_budget_user_ids', MagicMock(return_value=set())), \
       patch('budget.app.compare_budgets_and_users',
         MagicMock(return_value=([],[]))) as compare_mock, \
+      patch('budget.app.find_drifted_budgets',
+        MagicMock(return_value=[])) as drift_mock, \
       patch('budget.app.create_budgets',
-        MagicMock(
-          return_value='Budgets created for synapse ids: 3388489')
-        ) as create_mock, \
+        MagicMock(return_value=budgets_created)) as create_mock, \
+      patch('budget.app.update_budgets',
+        MagicMock(return_value=budgets_updated)) as update_mock, \
       patch('budget.app.delete_budgets',
-        MagicMock(
-          return_value='Budgets removed for synapse ids: 3406211')
-        ) as delete_mock:
+        MagicMock(return_value=budgets_removed)) as delete_mock:
+      self._configure(config_mock)
       result = app.lambda_handler({}, {})
 
-    expected = {
-      'message': (
-        'Budget maker run complete; '
-        'Budgets created for synapse ids: 3388489; '
-        'Budgets removed for synapse ids: 3406211'
-      )}
-    self.assertEqual(result, expected)
+    expected_message = (
+      'Budget maker run complete; '
+      'Budgets created for synapse ids: 3388489; '
+      'Budgets updated for synapse ids: 3412821; '
+      'Budgets removed for synapse ids: 3406211'
+    )
+    self.assertEqual(result['message'], expected_message)
+    self.assertEqual(result['counts'], {
+      'created': 1, 'updated': 1, 'removed': 1, 'failed': 0, 'deferred': 0
+    })
+    self.assertEqual(result['samples'], {
+      'created': {'succeeded': ['3388489']},
+      'updated': {'succeeded': ['3412821']},
+      'removed': {'succeeded': ['3406211']}
+    })
+    self.assertCountEqual(
+      result['timings'],
+      ['config', 'roster', 'inventory', 'diff', 'drift', 'create', 'update', 'delete']
+    )
+    self.assertNotIn('output', result)
     users_mock.assert_called_once()
     dupe_mock.assert_called_once()
     compare_mock.assert_called_once()
+    drift_mock.assert_called_once()
     create_mock.assert_called_once()
+    update_mock.assert_called_once()
     delete_mock.assert_called_once()
 
 
+  def test_handler_writes_result(self):
+    budgets_created = BatchResult()
+    budgets_created.succeeded = [str(n) for n in range(100)]
+    with tempfile.TemporaryDirectory() as directory, \
+      patch('budget.app.Config') as config_mock, \
+      patch('budget.app.get_state_store',
+        MagicMock(return_value=MagicMock(get=MagicMock(return_value=None)))), \
+      patch('budget.app.list_budget_user_ids', MagicMock(return_value=set())), \
+      patch('budget.app.compare_budgets_and_users',
+        MagicMock(return_value=([], []))), \
+      patch('budget.app.find_drifted_budgets', MagicMock(return_value=[])), \
+      patch('budget.app.create_budgets', MagicMock(return_value=budgets_created)), \
+      patch('budget.app.update_budgets', MagicMock(return_value=BatchResult())), \
+      patch('budget.app.delete_budgets', MagicMock(return_value=BatchResult())):
+      self._configure(config_mock).result_output = f'{directory}/result.jsonl'
+      result = app.lambda_handler(
+        {'shard': {'index': 1, 'count': 2, 'users': {}}},
+        {}
+      )
+      with open(f'{directory}/result-1-of-2.jsonl') as f:
+        lines = f.readlines()
+
+    self.assertEqual(result['output'], f'{directory}/result-1-of-2.jsonl')
+    self.assertEqual(result['counts']['created'], 100)
+    self.assertEqual(len(result['samples']['created']['succeeded']), 10)
+    self.assertIn('and 90 more', result['message'])
+    # every synapse id, and a line of counts and timings
+    self.assertEqual(len(lines), 101)
+
+
+  def test_handler_async_engine(self):
+    budgets_created = BatchResult()
+    budgets_created.succeeded = ['3388489']
+    budgets_removed = BatchResult()
+    budgets_removed.failed = {'3406211': ValueError('oops')}
+    reconciled = (
+      {'3388489': ['12345']}, 1, budgets_created, BatchResult(), budgets_removed
+    )
+    with patch('budget.app.Config') as config_mock, \
+      patch('budget.app.get_state_store',
+        MagicMock(return_value=MagicMock(get=MagicMock(return_value=None)))), \
+      patch('budget.app.reconcile_async',
+        AsyncMock(return_value=reconciled)) as reconcile_mock, \
+      patch('budget.app.get_users') as users_mock:
+      self._configure(config_mock).engine = 'async'
+      result = app.lambda_handler({}, {})
+
+    expected_message = (
+      'Budget maker run complete; '
+      'Budgets created for synapse ids: 3388489; '
+      'Budgets updated for synapse ids: none; '
+      'Budgets removed for synapse ids: none; '
+      'Budgets not removed for synapse ids: 3406211 (oops)'
+    )
+    self.assertEqual(result['message'], expected_message)
+    self.assertEqual(result['counts']['failed'], 1)
+    self.assertEqual(
+      result['samples']['removed'],
+      {'failed': {'3406211': 'oops'}}
+    )
+    reconcile_mock.assert_awaited_once()
+    users_mock.assert_not_called()
+
+
+  def test_handler_plan_mode(self):
+    teams_by_user_id = {'3388489': ['12345'], '3412821': ['67890']}
+    with tempfile.TemporaryDirectory() as directory, \
+      patch('budget.app.Config') as config_mock, \
+      patch('budget.app.get_state_store',
+        MagicMock(return_value=MagicMock(get=MagicMock(return_value=None)))), \
+      patch('budget.app.get_users',
+        MagicMock(return_value=teams_by_user_id)), \
+      patch('budget.app.list_budget_user_ids', MagicMock(return_value=set())), \
+      patch('budget.app.compare_budgets_and_users',
+        MagicMock(return_value=(['3388489'], ['3406211']))), \
+      patch('budget.app.find_drifted_budgets',
+        MagicMock(return_value=['3412821'])), \
+      patch('budget.app.create_budgets') as create_mock, \
+      patch('budget.app.update_budgets') as update_mock, \
+      patch('budget.app.delete_budgets') as delete_mock:
+      self._configure(config_mock)
+      plan_path = f'{directory}/plans/plan.jsonl'
+      result = app.lambda_handler({'plan': True, 'plan_output': plan_path}, {})
+      with open(plan_path) as f:
+        lines = [json.loads(line) for line in f]
+
+    # nothing is changed in plan mode
+    create_mock.assert_not_called()
+    update_mock.assert_not_called()
+    delete_mock.assert_not_called()
+    self.assertEqual(result['plan']['counts'], {'create': 1, 'update': 1, 'delete': 1})
+    self.assertEqual(
+      list(result['plan']['timings']),
+      ['config', 'roster', 'inventory', 'diff', 'drift']
+    )
+    self.assertEqual(lines[:3], [
+      {'action': 'create', 'synapse_id': '3388489', 'team': '12345'},
+      {'action': 'update', 'synapse_id': '3412821', 'team': '67890'},
+      {'action': 'delete', 'synapse_id': '3406211'}
+    ])
+    self.assertEqual(lines[3], {'timings': result['plan']['timings']})
+
+
+  def test_handler_emits_metrics(self):
+    budgets_created = BatchResult()
+    budgets_created.succeeded = ['3388489']
+    budgets_removed = BatchResult()
+    budgets_removed.failed = {'3406211': ValueError('oops')}
+
+    def get_users(*args):
+      # the handler passes a timer for the roster of each team
+      with args[4].phase('12345'):
+        return {'3388489': ['12345'], '3412821': ['12345']}
+
+    with patch('budget.app.Config') as config_mock, \
+      patch('budget.app.get_state_store',
+        MagicMock(return_value=MagicMock(get=MagicMock(return_value=None)))), \
+      patch('budget.app.get_users', get_users), \
+      patch('budget.app.list_budget_user_ids', MagicMock(return_value=set())), \
+      patch('budget.app.compare_budgets_and_users',
+        MagicMock(return_value=(['3388489'], ['3406211']))), \
+      patch('budget.app.find_drifted_budgets', MagicMock(return_value=[])), \
+      patch('budget.app.create_budgets', MagicMock(return_value=budgets_created)), \
+      patch('budget.app.update_budgets', MagicMock(return_value=BatchResult())), \
+      patch('budget.app.delete_budgets', MagicMock(return_value=budgets_removed)), \
+      patch('sys.stdout', new_callable=io.StringIO) as stdout:
+      self._configure(config_mock)
+      app.lambda_handler({}, {})
+
+    documents = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    run, team = documents
+    metric_names = [
+      metric['Name'] for metric in run['_aws']['CloudWatchMetrics'][0]['Metrics']
+    ]
+    self.assertCountEqual(metric_names, [
+      'Users', 'BudgetsSeen', 'Created', 'Updated', 'Deleted', 'Failed',
+      'Deferred', 'BudgetsRate', 'BudgetsThrottles',
+      'ConfigTime', 'RosterTime', 'InventoryTime', 'DiffTime', 'DriftTime',
+      'CreateTime', 'UpdateTime', 'DeleteTime'
+    ])
+    self.assertEqual(run['Users'], 2)
+    self.assertEqual(run['BudgetsSeen'], 2)
+    self.assertEqual(run['Created'], 1)
+    self.assertEqual(run['Deleted'], 0)
+    self.assertEqual(run['Failed'], 1)
+    self.assertEqual(
+      team['_aws']['CloudWatchMetrics'][0]['Dimensions'],
+      [['Service', 'Team']]
+    )
+    self.assertEqual(team['Team'], '12345')
+    self.assertIn('RosterTime', team)
+
+
   # Test general error handling
   def test_handler_unhappy_path(self):
     result = app.lambda_handler({}, {})
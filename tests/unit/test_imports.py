@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+from budget import app, clients
+
+# imported on first use, so that they stay out of the lambda's cold start
+DEFERRED_MODULES = ['boto3', 'synapseclient', 'cerberus', 'yaml', 'asyncio']
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+class TestImports(unittest.TestCase):
+
+  def tearDown(self):
+    clients.reset()
+    clients.configure(10, 'standard')
+
+
+  def test_import_defers_heavy_modules(self):
+    result = subprocess.run(
+      [
+        sys.executable, '-c',
+        'import sys, budget.app; '
+        f'print(",".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))'
+      ],
+      cwd=PROJECT_ROOT,
+      capture_output=True,
+      text=True,
+      check=True
+    )
+    self.assertEqual(result.stdout.strip(), '')
+
+
+  def test_import_with_invalid_prime_on_init(self):
+    result = subprocess.run(
+      [sys.executable, '-c', 'import budget.app'],
+      cwd=PROJECT_ROOT,
+      env=dict(os.environ, PRIME_ON_INIT='sometimes'),
+      capture_output=True,
+      text=True
+    )
+    # the lambda still starts, and the first invocation reports the error
+    self.assertEqual(result.returncode, 0, result.stderr)
+
+
+  def test_import_synapseclient_moves_cache(self):
+    synapseclient = clients.import_synapseclient()
+    self.assertEqual(
+      synapseclient.core.cache.CACHE_ROOT_DIR,
+      clients.SYNAPSE_CACHE_ROOT_DIR
+    )
+
+
+  def test_prime(self):
+    with patch('budget.app.Config') as config_mock, \
+      patch('budget.clients.configure') as configure_mock, \
+      patch('budget.app.get_client') as get_client_mock:
+      config_mock.load.return_value.aws_max_pool_connections = 16
+      config_mock.load.return_value.aws_retry_mode = 'adaptive'
+      try:
+        app.prime()
+        # kept for the first invocation
+        self.assertIs(app.configuration, config_mock.load.return_value)
+      finally:
+        app.configuration = None
+
+    configure_mock.assert_called_once_with(16, 'adaptive')
+    self.assertIn('synapseclient', sys.modules)
+    get_client_mock.assert_called_once_with('budgets')
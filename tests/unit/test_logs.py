@@ -0,0 +1,59 @@
+import logging
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from budget.logs import Lazy, shorten, summarize, to_json, warn_on_change
+from budget.state import FileStore
+
+
+class TestLogs(unittest.TestCase):
+
+  def test_summarize(self):
+    self.assertEqual(summarize(['1', '2'], 3), '2 items: 1, 2')
+    self.assertEqual(
+      summarize([str(n) for n in range(12)], 3),
+      '12 items: 0, 1, 2 and 9 more'
+    )
+    self.assertEqual(summarize({'1': ['A']}), '1 items: 1: [\'A\']')
+    self.assertEqual(summarize(set()), '0 items')
+
+
+  def test_shorten(self):
+    event = {'shard': {'index': 0, 'users': {str(n): ['A'] for n in range(20)}}}
+    self.assertEqual(shorten(event, 3), {
+      'shard': {
+        'index': 0,
+        'users': '<20 items: 0: [\'A\'], 1: [\'A\'], 2: [\'A\'] and 17 more>'
+      }
+    })
+    self.assertEqual(to_json({'plan': True}), '{"plan": true}')
+
+
+  def test_lazy_is_only_called_when_logged(self):
+    logger = logging.getLogger('test_logs')
+    func = MagicMock(return_value='value')
+    with self.assertLogs(logger, logging.INFO) as logs:
+      logger.debug('Debug: %s', Lazy(func, 1))
+      func.assert_not_called()
+      logger.info('Info: %s', Lazy(func, 1))
+    func.assert_called_once_with(1)
+    self.assertEqual(logs.output, ['INFO:test_logs:Info: value'])
+
+
+  def test_warn_on_change(self):
+    logger = MagicMock()
+    with tempfile.TemporaryDirectory() as state_dir:
+      store = FileStore(state_dir)
+      warn_on_change(logger, store, 'key', 'content', 'Found %s', 'content')
+      warn_on_change(logger, store, 'key', 'content', 'Found %s', 'content')
+      self.assertEqual(logger.warning.call_count, 1)
+
+      warn_on_change(logger, store, 'key', 'changed', 'Found %s', 'changed')
+      self.assertEqual(logger.warning.call_count, 2)
+
+      # the warning is logged again when the content comes back
+      warn_on_change(logger, store, 'key', '', 'Found %s', '')
+      warn_on_change(logger, store, 'key', 'changed', 'Found %s', 'changed')
+      self.assertEqual(logger.warning.call_count, 3)
+    logger.warning.assert_called_with('Found %s', 'changed')
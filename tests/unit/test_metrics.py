@@ -0,0 +1,50 @@
+import io
+import json
+import unittest
+
+from budget.metrics import MetricsLogger
+
+
+class TestMetricsLogger(unittest.TestCase):
+
+  def test_flush_writes_emf(self):
+    stream = io.StringIO()
+    metrics = MetricsLogger(namespace='Test', stream=stream)
+    metrics.put_metric('Created', 3)
+    metrics.put_timings({'inventory': 0.25})
+    metrics.flush()
+
+    document = json.loads(stream.getvalue())
+    self.assertEqual(document['_aws']['CloudWatchMetrics'], [{
+      'Namespace': 'Test',
+      'Dimensions': [['Service']],
+      'Metrics': [
+        {'Name': 'Created', 'Unit': 'Count'},
+        {'Name': 'InventoryTime', 'Unit': 'Milliseconds'}
+      ]
+    }])
+    self.assertIsInstance(document['_aws']['Timestamp'], int)
+    self.assertEqual(document['Service'], 'lambda-budgets')
+    self.assertEqual(document['Created'], 3)
+    self.assertEqual(document['InventoryTime'], 250.0)
+
+
+  def test_dimensions_make_separate_documents(self):
+    stream = io.StringIO()
+    metrics = MetricsLogger(stream=stream)
+    metrics.put_timings({'roster': 0.1}, dimensions={'Team': 'A'})
+    metrics.put_timings({'roster': 0.2}, dimensions={'Team': 'B'})
+    metrics.flush()
+
+    documents = [json.loads(line) for line in stream.getvalue().splitlines()]
+    self.assertEqual([d['Team'] for d in documents], ['A', 'B'])
+    self.assertEqual([d['RosterTime'] for d in documents], [100.0, 200.0])
+
+
+  def test_flush_clears_metrics(self):
+    stream = io.StringIO()
+    metrics = MetricsLogger(stream=stream)
+    metrics.put_metric('Created', 1)
+    metrics.flush()
+    metrics.flush()
+    self.assertEqual(len(stream.getvalue().splitlines()), 1)
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from budget.pipeline import MutationQueue
+
+
+class TestMutationQueue(unittest.TestCase):
+
+  def test_outcomes(self):
+    def func(item):
+      if item == 'bad':
+        raise ValueError('bad item')
+      if item == 'done':
+        return False
+
+    async def run():
+      mutations = MutationQueue(executor, workers=2, max_size=10)
+      for item in ['a', 'bad', 'done']:
+        await mutations.put('create', func, item)
+      await mutations.put('delete', func, 'b')
+      await mutations.join()
+      return mutations.results
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      results = asyncio.run(run())
+
+    self.assertEqual(results['create'].succeeded, ['a'])
+    self.assertEqual(results['create'].unchanged, ['done'])
+    self.assertEqual(list(results['create'].failed), ['bad'])
+    self.assertEqual(results['delete'].succeeded, ['b'])
+
+
+  def test_put_waits_while_queue_is_full(self):
+    release = threading.Event()
+    queued = []
+
+    async def run():
+      mutations = MutationQueue(executor, workers=1, max_size=1)
+      # the worker holds the first item, and the queue holds the second
+      for item in ['1', '2', '3']:
+        put = asyncio.ensure_future(
+          mutations.put('create', lambda item: release.wait(5), item)
+        )
+        await asyncio.sleep(0.05)
+        queued.append(put.done())
+      release.set()
+      await put
+      await mutations.join()
+      return mutations.results
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      results = asyncio.run(run())
+
+    self.assertEqual(queued, [True, True, False])
+    self.assertEqual(results['create'].succeeded, ['1', '2', '3'])
+
+
+  def test_stop(self):
+    calls = []
+
+    async def run():
+      mutations = MutationQueue(
+        executor,
+        workers=1,
+        max_size=10,
+        should_stop=lambda: len(calls) >= 2
+      )
+      for item in ['1', '2', '3', '4']:
+        await mutations.put('create', calls.append, item)
+      await mutations.join()
+      return mutations.results
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      results = asyncio.run(run())
+
+    self.assertEqual(results['create'].succeeded, ['1', '2'])
+    self.assertEqual(results['create'].deferred, ['3', '4'])
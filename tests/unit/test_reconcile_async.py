@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from budget import app
+from budget.timing import PhaseTimer
+
+
+def _configuration():
+  return SimpleNamespace(
+    synapse_max_workers=4,
+    budgets_max_workers=2,
+    team_snapshot_max_age=3600
+  )
+
+
+class TestReconcileAsync(unittest.TestCase):
+
+  def _reconcile(self, rosters, budget_user_ids, drifted=()):
+    calls = []
+
+    def find_drifted_budgets(synapse_ids, *args):
+      return [synapse_id for synapse_id in synapse_ids if synapse_id in drifted]
+
+    timer = PhaseTimer()
+    with patch('budget.app.configuration', _configuration()), \
+      patch('budget.app.get_team_roster',
+        lambda team_id, *args: rosters[team_id]), \
+      patch('budget.app.list_budget_user_ids', lambda: set(budget_user_ids)), \
+      patch('budget.app.find_drifted_budgets', find_drifted_budgets), \
+      patch('budget.app.create_user_budget',
+        lambda synapse_id, team, fingerprints:
+          calls.append(('create', synapse_id, team))), \
+      patch('budget.app.update_user_budget',
+        lambda synapse_id, team, fingerprints:
+          calls.append(('update', synapse_id, team))), \
+      patch('budget.app.delete_user_budget',
+        lambda synapse_id, fingerprints: calls.append(('delete', synapse_id))):
+      result = asyncio.run(
+        app.reconcile_async(list(rosters), MagicMock(), MagicMock(), timer)
+      )
+    return result, calls, timer
+
+
+  def test_reconcile(self):
+    rosters = {'A': ['1', '2', '3'], 'B': ['3', '4']}
+    (result, calls, timer) = self._reconcile(
+      rosters,
+      budget_user_ids=['2', '3', '9'],
+      drifted=['3']
+    )
+    (teams_by_user_id, budgets_seen, created, updated, removed) = result
+
+    self.assertEqual(
+      teams_by_user_id,
+      {'1': ['A'], '2': ['A'], '3': ['A', 'B'], '4': ['B']}
+    )
+    self.assertEqual(budgets_seen, 3)
+    # users in several teams get the budget of the first team
+    self.assertCountEqual(calls, [
+      ('create', '1', 'A'),
+      ('create', '4', 'B'),
+      ('update', '3', 'A'),
+      ('delete', '9')
+    ])
+    self.assertCountEqual(created.succeeded, ['1', '4'])
+    self.assertEqual(updated.succeeded, ['3'])
+    self.assertEqual(removed.succeeded, ['9'])
+    self.assertCountEqual(timer.timings, ['roster', 'inventory'])
+
+
+  def test_reconcile_rosters_already_read(self):
+    teams_by_user_id = {'1': ['A'], '3': ['A', 'B'], '4': ['B']}
+    calls = []
+    with patch('budget.app.configuration', _configuration()), \
+      patch('budget.app.get_team_roster') as get_team_roster_mock, \
+      patch('budget.app.list_budget_user_ids', lambda: {'3'}), \
+      patch('budget.app.find_drifted_budgets', MagicMock(return_value=[])), \
+      patch('budget.app.create_user_budget',
+        lambda synapse_id, team, fingerprints:
+          calls.append(('create', synapse_id, team))):
+      result = asyncio.run(app.reconcile_async(
+        ['A', 'B'],
+        MagicMock(),
+        MagicMock(),
+        PhaseTimer(),
+        teams_by_user_id=teams_by_user_id
+      ))
+
+    get_team_roster_mock.assert_not_called()
+    self.assertEqual(result[0], teams_by_user_id)
+    self.assertCountEqual(calls, [('create', '1', 'A'), ('create', '4', 'B')])
+
+
+  def test_roster_and_inventory_overlap(self):
+    # the inventory only finishes once a roster has started, so this only
+    # finishes if both are read at the same time
+    roster_started = threading.Event()
+
+    def get_team_roster(team_id, *args):
+      roster_started.set()
+      return ['1']
+
+    def list_budget_user_ids():
+      if not roster_started.wait(5):
+        raise TimeoutError('the roster was not read during the inventory')
+      return set()
+
+    with patch('budget.app.configuration', _configuration()), \
+      patch('budget.app.get_team_roster', get_team_roster), \
+      patch('budget.app.list_budget_user_ids', list_budget_user_ids), \
+      patch('budget.app.find_drifted_budgets', MagicMock(return_value=[])), \
+      patch('budget.app.create_user_budget') as create_mock:
+      result = asyncio.run(
+        app.reconcile_async(['A'], MagicMock(), MagicMock(), PhaseTimer())
+      )
+
+    self.assertEqual(result[2].succeeded, ['1'])
+    create_mock.assert_called_once()
+
+
+  def test_failed_changes_do_not_stop_others(self):
+    with patch('budget.app.configuration', _configuration()), \
+      patch('budget.app.get_team_roster', lambda team_id, *args: ['1', '2']), \
+      patch('budget.app.list_budget_user_ids', lambda: set()), \
+      patch('budget.app.find_drifted_budgets', MagicMock(return_value=[])), \
+      patch('budget.app.create_user_budget',
+        MagicMock(side_effect=[ValueError('oops'), None])):
+      result = asyncio.run(
+        app.reconcile_async(['A'], MagicMock(), MagicMock(), PhaseTimer())
+      )
+
+    created = result[2]
+    self.assertEqual(len(created.succeeded), 1)
+    self.assertEqual(len(created.failed), 1)
+
+
+  def test_roster_error_is_raised(self):
+    with patch('budget.app.configuration', _configuration()), \
+      patch('budget.app.get_team_roster',
+        MagicMock(side_effect=ValueError('no roster'))), \
+      patch('budget.app.list_budget_user_ids', lambda: set()):
+      with self.assertRaises(ValueError):
+        asyncio.run(
+          app.reconcile_async(['A'], MagicMock(), MagicMock(), PhaseTimer())
+        )
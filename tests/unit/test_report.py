@@ -0,0 +1,126 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from budget import app
+from budget.report import get_spend_record, write_spend_report
+from tests.unit.helpers import HandlerTestCase
+
+
+def _budget(synapse_id, limit, spend, time_unit='MONTHLY'):
+  return {
+    'BudgetName': f'service-catalog_{synapse_id}',
+    'BudgetLimit': {'Amount': limit, 'Unit': 'USD'},
+    'TimeUnit': time_unit,
+    'BudgetType': 'COST',
+    'CalculatedSpend': {
+      'ActualSpend': {'Amount': spend, 'Unit': 'USD'},
+      'ForecastedSpend': {'Amount': '95.0', 'Unit': 'USD'}
+    }
+  }
+
+
+class TestSpendRecord(unittest.TestCase):
+
+  def test_spend_record(self):
+    record = get_spend_record('1', '111', _budget('1', '100.0', '42.5'))
+    self.assertEqual(record, {
+      'synapse_id': '1',
+      'team': '111',
+      'budget_name': 'service-catalog_1',
+      'time_unit': 'MONTHLY',
+      'limit': '100.0',
+      'actual_spend': '42.5',
+      'forecasted_spend': '95.0',
+      'unit': 'USD',
+      'percent_used': 42.5,
+      'history': None
+    })
+
+
+  def test_spend_record_without_spend(self):
+    budget = _budget('1', '0', '0')
+    del budget['CalculatedSpend']
+    record = get_spend_record('1', None, budget)
+    self.assertIsNone(record['actual_spend'])
+    self.assertIsNone(record['percent_used'])
+
+
+  def test_write_csv(self):
+    records = [
+      get_spend_record('1', '111', _budget('1', '100.0', '42.5'), []),
+      get_spend_record('2', None, _budget('2', '100.0', '1.0'))
+    ]
+    with tempfile.TemporaryDirectory() as output_dir:
+      path = os.path.join(output_dir, 'report.csv')
+      count = write_spend_report(path, iter(records), 'csv')
+      with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    self.assertEqual(count, 2)
+    self.assertEqual(rows[0]['synapse_id'], '1')
+    self.assertEqual(rows[0]['history'], '[]')
+    self.assertEqual(rows[1]['team'], '')
+    self.assertEqual(rows[1]['history'], '')
+
+
+class TestSpendReport(HandlerTestCase):
+
+  period = 'MONTHLY'
+  amounts = {'111': '100'}
+
+
+  def setUp(self):
+    super().setUp()
+    self.budgets_client.max_page_size = 2
+    self.budgets_client.add_budget(_budget('1', '100.0', '90.0'))
+    self.budgets_client.add_budget(_budget('2', '100.0', '10.0'))
+    self.budgets_client.add_budget(_budget('3', '50.0', '5.0', 'ANNUALLY'))
+    self.budgets_client.add_budget({'BudgetName': 'other', 'BudgetLimit': {}})
+
+
+  def test_report(self):
+    result = app.lambda_handler({'report': True}, None)
+
+    path = os.path.join(self.state_dir.name, 'spend-report.csv')
+    self.assertEqual(result['report'], {'path': path, 'format': 'csv', 'count': 3})
+    with open(path, newline='') as f:
+      rows = list(csv.DictReader(f))
+    self.assertEqual(
+      [(row['synapse_id'], row['team'], row['percent_used']) for row in rows],
+      [('1', '111', '90.0'), ('2', '111', '10.0'), ('3', '', '10.0')]
+    )
+    # the spend comes with the budget pages, and nothing is changed
+    self.assertEqual(dict(self.budgets_client.calls), {'describe_budgets': 2})
+
+
+  def test_report_with_history(self):
+    path = os.path.join(self.state_dir.name, 'report.jsonl')
+    result = app.lambda_handler({
+      'report': True,
+      'report_format': 'jsonl',
+      'report_output': path,
+      'history': True
+    }, None)
+
+    self.assertEqual(result['report']['count'], 3)
+    with open(path) as f:
+      records = [json.loads(line) for line in f]
+    self.assertEqual(records[0]['history'], [{
+      'start': '2024-01-01',
+      'end': '2024-02-01',
+      'budgeted': '100.0',
+      'actual': '90.0'
+    }])
+    # annual budgets have no history
+    self.assertIsNone(records[2]['history'])
+    self.assertEqual(
+      self.budgets_client.calls['describe_budget_performance_history'],
+      2
+    )
+
+
+  def test_report_format_invalid(self):
+    result = app.lambda_handler({'report': True, 'report_format': 'xml'}, None)
+    self.assertIn('Report format', result['error'])
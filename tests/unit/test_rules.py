@@ -0,0 +1,79 @@
+import io
+import os
+import tempfile
+import unittest
+
+import boto3
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from budget import clients
+from budget.rules import (
+  FileRulesSource,
+  S3RulesSource,
+  get_rules_source
+)
+
+
+class TestRulesSources(unittest.TestCase):
+
+  def tearDown(self):
+    clients.reset()
+
+
+  def test_get_rules_source(self):
+    self.assertIsInstance(get_rules_source('/etc/rules.yaml'), FileRulesSource)
+    self.assertEqual(str(get_rules_source('file:///etc/rules.yaml')), 'file:///etc/rules.yaml')
+    self.assertEqual(str(get_rules_source('s3://bucket/rules/budgets.yaml')), 's3://bucket/rules/budgets.yaml')
+    with self.assertRaises(ValueError):
+      get_rules_source('s3://bucket')
+
+
+  def test_file_source(self):
+    with tempfile.TemporaryDirectory() as rules_dir:
+      path = os.path.join(rules_dir, 'rules.yaml')
+      with open(path, 'w') as f:
+        f.write('teams: {}')
+      source = FileRulesSource(path)
+      self.assertTrue(source.fetch())
+      self.assertFalse(source.fetch())
+      version = source.version
+
+      with open(path, 'w') as f:
+        f.write('teams: {\'1\': {}}')
+      self.assertTrue(source.fetch())
+    self.assertEqual(source.text, 'teams: {\'1\': {}}')
+    self.assertNotEqual(source.version, version)
+
+
+  def test_s3_source(self):
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    clients.set_client('s3', s3_client)
+    source = S3RulesSource('bucket', 'rules.yaml')
+    body = b'teams: {}'
+    with Stubber(s3_client) as stubber:
+      stubber.add_response(
+        'get_object',
+        {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ETag': '"abc"'},
+        {'Bucket': 'bucket', 'Key': 'rules.yaml'}
+      )
+      stubber.add_client_error(
+        'get_object',
+        service_error_code='304',
+        http_status_code=304,
+        expected_params={'Bucket': 'bucket', 'Key': 'rules.yaml', 'IfNoneMatch': '"abc"'}
+      )
+      stubber.add_client_error(
+        'get_object',
+        service_error_code='AccessDenied',
+        http_status_code=403
+      )
+      self.assertTrue(source.fetch())
+      self.assertFalse(source.fetch())
+      with self.assertRaises(ClientError):
+        source.fetch()
+      stubber.assert_no_pending_responses()
+
+    self.assertEqual(source.text, 'teams: {}')
+    self.assertEqual(source.version, '"abc"')
@@ -0,0 +1,197 @@
+import io
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from budget import app, clients
+from budget.shards import (
+  LambdaInvoker,
+  LocalInvoker,
+  get_shard,
+  invoke_shards,
+  split_users
+)
+from tests.unit.helpers import HandlerTestCase, team_rules
+
+
+class TestShards(unittest.TestCase):
+
+  def tearDown(self):
+    clients.reset()
+
+
+  def test_get_shard_is_stable(self):
+    # the same in every process, unlike hash()
+    self.assertEqual(get_shard('3388489', 4), 0)
+    self.assertEqual(get_shard('3388489', 7), 2)
+
+
+  def test_split_users(self):
+    teams_by_user_id = {str(user_id): ['A'] for user_id in range(1000)}
+    shards = split_users(teams_by_user_id, 4)
+    self.assertEqual(len(shards), 4)
+    self.assertEqual(sum(len(shard) for shard in shards), 1000)
+    for (index, shard) in enumerate(shards):
+      # every shard gets a fair share of the users
+      self.assertGreater(len(shard), 150)
+      for user_id in shard:
+        self.assertEqual(get_shard(user_id, 4), index)
+
+
+  def test_lambda_invoker(self):
+    lambda_client = MagicMock()
+    lambda_client.invoke.return_value = {
+      'StatusCode': 200,
+      'Payload': io.BytesIO(b'{"message": "done"}')
+    }
+    clients.set_client('lambda', lambda_client)
+
+    result = LambdaInvoker('budget-maker')({'shard': {'index': 0}})
+
+    self.assertEqual(result, {'message': 'done'})
+    lambda_client.invoke.assert_called_once_with(
+      FunctionName='budget-maker',
+      InvocationType='RequestResponse',
+      Payload=b'{"shard": {"index": 0}}'
+    )
+
+
+  def test_lambda_invoker_function_error(self):
+    lambda_client = MagicMock()
+    lambda_client.invoke.return_value = {
+      'StatusCode': 200,
+      'FunctionError': 'Unhandled',
+      'Payload': io.BytesIO(b'{"errorMessage": "Task timed out"}')
+    }
+    clients.set_client('lambda', lambda_client)
+
+    with self.assertRaises(RuntimeError) as context_manager:
+      LambdaInvoker('budget-maker')({})
+    self.assertIn('Task timed out', str(context_manager.exception))
+
+
+  def test_invoke_shards(self):
+    def invoke(event):
+      if event['shard'] == 1:
+        raise RuntimeError('no capacity')
+      return {'message': f'shard {event["shard"]}'}
+
+    results = invoke_shards(invoke, [{'shard': 0}, {'shard': 1}])
+    self.assertEqual(results, [
+      {'message': 'shard 0'},
+      {'error': 'no capacity'}
+    ])
+
+
+class TestShardedHandler(HandlerTestCase):
+
+  members_by_team = {'3412821': [str(user_id) for user_id in range(20)]}
+  amounts = {'3412821': '100'}
+
+
+  def get_environment(self):
+    return dict(
+      super().get_environment(),
+      SHARD_COUNT='3',
+      SHARD_INVOCATION='local'
+    )
+
+
+  def test_sharded_run_in_process(self):
+    # a budget for a user who has left the team
+    self.budgets_client.add_budget({'BudgetName': 'service-catalog_999'})
+
+    result = app.lambda_handler({}, None)
+    # nothing has changed, so the next run is skipped
+    skipped_result = app.lambda_handler({}, None)
+    # and a full check finds nothing left to change
+    second_result = app.lambda_handler({'full_check': True}, None)
+
+    self.assertEqual(
+      result['counts'],
+      {'created': 20, 'updated': 0, 'removed': 1, 'failed': 0, 'deferred': 0}
+    )
+    self.assertIn('complete in 3 shards', result['message'])
+    self.assertEqual(
+      sorted(self.budgets_client.budgets),
+      sorted(f'service-catalog_{user_id}' for user_id in range(20))
+    )
+    self.assertIn('skipped', skipped_result['message'])
+    self.assertEqual(
+      second_result['counts'],
+      {'created': 0, 'updated': 0, 'removed': 0, 'failed': 0, 'deferred': 0}
+    )
+    # the rosters are only read by the coordinator
+    self.assertEqual(self.syn.calls['team_members_count'], 3)
+
+
+  def test_duplicates_warned_once(self):
+    self.syn.members_by_team['3412822'] = ['1', '2']
+    budget_rules = self.environment['BUDGET_RULES'] + team_rules('3412822')
+
+    with patch.dict('os.environ', {'BUDGET_RULES': budget_rules}), \
+      patch.object(app.log, 'warning') as warning_mock:
+      for _ in range(3):
+        app.lambda_handler({'full_check': True}, None)
+
+    warnings = [
+      call for call in warning_mock.call_args_list
+      if call[0][0].startswith('Duplicate team memberships')
+    ]
+    self.assertEqual(len(warnings), 1)
+
+
+  def test_shards_stop_at_coordinator_deadline(self):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 60000
+    invoke_mock = MagicMock(return_value=[
+      {'counts': {'created': 0, 'updated': 0, 'removed': 0, 'failed': 0, 'deferred': 0}}
+    ] * 2)
+    with patch.dict('os.environ', {'SHARD_COUNT': '2'}), \
+      patch('budget.app.get_users', MagicMock(return_value={'1': ['A']})), \
+      patch('budget.app.invoke_shards', invoke_mock):
+      app.lambda_handler({}, context)
+
+    (invoke, events) = invoke_mock.call_args[0]
+    for event in events:
+      self.assertAlmostEqual(event['deadline'], time.time() + 55, delta=1)
+    # local shards share the invocation's context
+    self.assertIs(invoke._context, context)
+
+
+  def test_shards_share_the_rate(self):
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 60000
+    invoke_mock = MagicMock(return_value=[
+      {'counts': {'created': 0, 'updated': 0, 'removed': 0, 'failed': 0, 'deferred': 0}}
+    ] * 4)
+    with patch.dict('os.environ', {
+        'SHARD_COUNT': '4',
+        'SHARD_INVOCATION': 'lambda',
+        'BUDGETS_MAX_TPS': '10'
+      }), \
+      patch('budget.app.invoke_shards', invoke_mock):
+      app.lambda_handler({}, context)
+      (_, events) = invoke_mock.call_args[0]
+      self.assertEqual([event['max_tps'] for event in events], [2.5] * 4)
+
+      # and a shard worker sends no more than its share
+      app.lambda_handler(events[0], None)
+      self.assertEqual(app.budgets_rate_limiter.max_rate, 2.5)
+
+
+  def test_failed_shard(self):
+    results = [
+      {
+        'message': 'ok',
+        'counts': {'created': 1, 'updated': 0, 'removed': 0, 'failed': 0, 'deferred': 0}
+      },
+      {'error': 'boom'}
+    ]
+    with patch.dict('os.environ', {'SHARD_COUNT': '2'}), \
+      patch('budget.app.get_users', MagicMock(return_value={'1': ['A']})), \
+      patch('budget.app.invoke_shards', MagicMock(return_value=results)):
+      result = app.lambda_handler({}, None)
+
+    self.assertEqual(result['error'], '1 of 2 shards failed: shard 1 (boom)')
+    self.assertEqual(result['counts']['created'], 1)
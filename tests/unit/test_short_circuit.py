@@ -0,0 +1,102 @@
+from unittest.mock import patch
+
+from budget import app
+from budget.fingerprints import RECONCILED_STATE_KEY
+from tests.unit.helpers import HandlerTestCase
+
+
+class TestShortCircuit(HandlerTestCase):
+
+  def _run(self, event=None):
+    self.budgets_client.calls.clear()
+    return app.lambda_handler(event or {}, None)
+
+
+  def test_unchanged_run_is_skipped(self):
+    self._run()
+    result = self._run()
+
+    self.assertEqual(result, {
+      'message': (
+        'Budget maker run skipped; nothing has changed since the last full check'
+      )
+    })
+    self.assertEqual(sum(self.budgets_client.calls.values()), 0)
+
+
+  def test_full_check_event(self):
+    self._run()
+    result = self._run({'full_check': True})
+
+    self.assertIn('run complete', result['message'])
+    self.assertEqual(self.budgets_client.calls['describe_budgets'], 1)
+
+
+  def test_membership_change(self):
+    self._run()
+    self.syn.members_by_team['111'].append('3')
+    result = self._run()
+
+    self.assertIn('Budgets created for synapse ids: 3', result['message'])
+
+
+  def test_membership_swap(self):
+    self._run()
+    # the team's member count stays the same
+    self.syn.members_by_team['111'][1] = '3'
+    result = self._run()
+
+    self.assertIn('Budgets created for synapse ids: 3', result['message'])
+    self.assertIn('Budgets removed for synapse ids: 2', result['message'])
+
+
+  def test_async_engine_reuses_rosters(self):
+    with patch.dict('os.environ', {'ENGINE': 'async'}):
+      self._run()
+      self.syn.members_by_team['111'].append('3')
+      self.syn.calls.clear()
+      result = self._run()
+
+    self.assertIn('Budgets created for synapse ids: 3', result['message'])
+    # read once to check for changes, and not again to reconcile
+    self.assertEqual(self.syn.calls['team_members_count'], 1)
+    self.assertEqual(self.syn.calls['team_members_page'], 1)
+
+
+  def test_configuration_change(self):
+    self._run()
+    with patch.dict('os.environ', {
+      'BUDGET_RULES': self.environment['BUDGET_RULES'].replace('10', '20')
+    }):
+      result = self._run()
+
+    self.assertIn('Budgets updated for synapse ids: ', result['message'])
+    self.assertEqual(self.budgets_client.calls['update_budget'], 2)
+
+
+  def test_full_check_interval(self):
+    self._run()
+    state = self.store.get(RECONCILED_STATE_KEY)
+    self.store.put(RECONCILED_STATE_KEY, dict(state, checked=state['checked'] - 3600))
+    result = self._run()
+
+    self.assertIn('run complete', result['message'])
+    self.assertEqual(self.budgets_client.calls['describe_budgets'], 1)
+
+
+  def test_failed_run_is_not_skipped(self):
+    with patch.object(self.budgets_client, 'create_budget',
+        side_effect=ValueError('oops')):
+      self._run()
+    result = self._run()
+
+    self.assertIn('Budgets created for synapse ids: ', result['message'])
+    self.assertEqual(self.budgets_client.calls['create_budget'], 2)
+
+
+  def test_targeted_event_forces_full_check(self):
+    self._run()
+    self._run({'remove_user': '1'})
+    result = self._run()
+
+    self.assertIn('Budgets created for synapse ids: 1', result['message'])
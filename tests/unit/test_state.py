@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from budget.state import FileStore
+
+
+class TestFileStore(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    # the store makes its directory on first write
+    self.store = FileStore(os.path.join(self.directory.name, 'state'))
+
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+
+  def test_get_missing(self):
+    self.assertIsNone(self.store.get('nothing'))
+
+
+  def test_put_get_delete(self):
+    self.store.put('key', {'count': 2, 'member_ids': ['1', '2']})
+    self.assertEqual(self.store.get('key'), {'count': 2, 'member_ids': ['1', '2']})
+    self.store.put('key', {'count': 0})
+    self.assertEqual(self.store.get('key'), {'count': 0})
+    self.store.delete('key')
+    self.assertIsNone(self.store.get('key'))
+    # deleting twice is harmless
+    self.store.delete('key')
+
+
+  def test_damaged_document_is_missing(self):
+    self.store.put('key', {})
+    with open(os.path.join(self.directory.name, 'state', 'key.json'), 'w') as f:
+      f.write('{"count": ')
+    self.assertIsNone(self.store.get('key'))
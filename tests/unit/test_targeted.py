@@ -0,0 +1,83 @@
+from budget import app
+from tests.unit.helpers import HandlerTestCase
+
+
+class TestTargetedEvents(HandlerTestCase):
+
+  members_by_team = {'111': ['1', '2'], '222': ['2', '3']}
+  amounts = {'111': '10', '222': '20'}
+
+
+  def _amount(self, synapse_id):
+    budget = self.budgets_client.budgets[f'service-catalog_{synapse_id}']
+    return budget['BudgetLimit']['Amount']
+
+
+  def test_reconcile_user(self):
+    result = app.lambda_handler({'reconcile_user': '2'}, None)
+
+    self.assertIn('Budgets created for synapse ids: 2', result['message'])
+    # the budget of the first team the user is in
+    self.assertEqual(self._amount('2'), '10')
+    self.assertEqual(self.budgets_client.calls['describe_budgets'], 0)
+    self.assertEqual(self.syn.calls['team_members_page'], 0)
+
+    # the budget is now known, and is not looked up again
+    result = app.lambda_handler({'reconcile_user': 2}, None)
+    self.assertIn('Budgets created for synapse ids: none', result['message'])
+    self.assertEqual(self.budgets_client.calls['describe_budget'], 1)
+    self.assertEqual(self.budgets_client.calls['create_budget'], 1)
+
+
+  def test_reconcile_user_without_team(self):
+    self.budgets_client.add_budget({'BudgetName': 'service-catalog_9'})
+
+    result = app.lambda_handler({'reconcile_user': '9'}, None)
+
+    self.assertIn('Budgets removed for synapse ids: 9', result['message'])
+    self.assertEqual(self.budgets_client.budgets, {})
+
+
+  def test_remove_user(self):
+    self.budgets_client.add_budget({'BudgetName': 'service-catalog_1'})
+
+    result = app.lambda_handler({'remove_user': '1'}, None)
+
+    self.assertIn('Budgets removed for synapse ids: 1', result['message'])
+    self.assertEqual(sum(self.syn.calls.values()), 0)
+
+
+  def test_reconcile_team(self):
+    result = app.lambda_handler({'reconcile_team': '222'}, None)
+
+    self.assertIn('Budgets created for synapse ids: ', result['message'])
+    self.assertEqual(
+      sorted(self.budgets_client.budgets),
+      ['service-catalog_2', 'service-catalog_3']
+    )
+    # user 2 is also in team 111, which comes first
+    self.assertEqual(self._amount('2'), '10')
+    self.assertEqual(self._amount('3'), '20')
+
+    # user 3 leaves the team, and user 4 joins it
+    self.syn.members_by_team['222'] = ['2', '4']
+    result = app.lambda_handler({'reconcile_team': '222'}, None)
+
+    self.assertEqual(
+      sorted(self.budgets_client.budgets),
+      ['service-catalog_2', 'service-catalog_4']
+    )
+    self.assertEqual(self.budgets_client.calls['describe_budgets'], 0)
+
+
+  def test_reconcile_team_without_rules(self):
+    result = app.lambda_handler({'reconcile_team': '333'}, None)
+    self.assertEqual(result, {'error': 'Team 333 has no budget rules'})
+
+
+  def test_targeted_event_in_plan_mode(self):
+    result = app.lambda_handler({'reconcile_user': '1', 'plan': True}, None)
+    self.assertEqual(
+      result,
+      {'error': 'Targeted events cannot be run in plan mode'}
+    )
@@ -0,0 +1,184 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+
+from budget import throttle
+from tests.unit.helpers import FakeBudgetsClient
+
+
+def _client_error(code):
+  return ClientError({'Error': {'Code': code, 'Message': code}}, 'CreateBudget')
+
+
+class TestThrottle(unittest.TestCase):
+
+  def test_rate_limiter_allows_burst_up_to_rate(self):
+    rate_limiter = throttle.RateLimiter(3)
+    with patch('budget.throttle.time.sleep') as sleep_mock:
+      for _ in range(3):
+        rate_limiter.acquire()
+    sleep_mock.assert_not_called()
+
+
+  def test_rate_limiter_waits_when_empty(self):
+    rate_limiter = throttle.RateLimiter(2)
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+    with patch('budget.throttle.time.sleep',
+      side_effect=lambda wait: rate_limiter.set_rate(1000)) as sleep_mock:
+      rate_limiter.acquire()
+    sleep_mock.assert_called()
+    self.assertGreater(sleep_mock.call_args[0][0], 0)
+
+
+  def test_is_throttling_error(self):
+    self.assertTrue(throttle.is_throttling_error(_client_error('ThrottlingException')))
+    self.assertFalse(throttle.is_throttling_error(_client_error('NotFoundException')))
+    self.assertFalse(throttle.is_throttling_error(ValueError('ThrottlingException')))
+
+
+  @patch('budget.throttle.time.sleep')
+  def test_call_with_backoff_retries_throttling(self, sleep_mock):
+    func = MagicMock(side_effect=[
+      _client_error('ThrottlingException'),
+      _client_error('ThrottlingException'),
+      'done'
+    ])
+    result = throttle.call_with_backoff(throttle.RateLimiter(100), func, foo='bar')
+    self.assertEqual(result, 'done')
+    self.assertEqual(func.call_count, 3)
+    func.assert_called_with(foo='bar')
+    # backoff grows with each attempt, and is jittered below that ceiling
+    delays = [call[0][0] for call in sleep_mock.call_args_list]
+    self.assertEqual(len(delays), 2)
+    self.assertLessEqual(delays[0], 0.25)
+    self.assertLessEqual(delays[1], 0.5)
+
+
+  @patch('budget.throttle.time.sleep', MagicMock())
+  def test_call_with_backoff_gives_up(self):
+    func = MagicMock(side_effect=_client_error('ThrottlingException'))
+    with self.assertRaises(ClientError):
+      throttle.call_with_backoff(throttle.RateLimiter(100), func, max_attempts=3)
+    self.assertEqual(func.call_count, 3)
+
+
+  def test_call_with_backoff_raises_other_errors(self):
+    func = MagicMock(side_effect=_client_error('NotFoundException'))
+    with self.assertRaises(ClientError):
+      throttle.call_with_backoff(throttle.RateLimiter(100), func)
+    func.assert_called_once()
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+
+  def test_throttle_cuts_rate(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(10, decrease_interval=0)
+    started = throttle.time.monotonic()
+    rate_limiter.record_throttle(started)
+    self.assertEqual(rate_limiter.rate, 5)
+    # calls made before the cut were sent at the old rate
+    rate_limiter.record_throttle(started)
+    self.assertEqual(rate_limiter.rate, 5)
+    rate_limiter.record_throttle(throttle.time.monotonic())
+    self.assertEqual(rate_limiter.rate, 2.5)
+    self.assertEqual(rate_limiter.throttles, 3)
+
+
+  def test_rate_floor(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(
+      10, min_rate=4, decrease_interval=0
+    )
+    for _ in range(3):
+      rate_limiter.record_throttle(throttle.time.monotonic())
+    self.assertEqual(rate_limiter.rate, 4)
+
+
+  def test_acquire_at_min_rate(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(5, decrease_interval=0)
+    for _ in range(4):
+      rate_limiter.record_throttle(throttle.time.monotonic())
+    self.assertEqual(rate_limiter.rate, 0.5)
+    start = throttle.time.monotonic()
+    clock = [start]
+
+    def sleep(wait):
+      clock[0] += wait
+
+    with patch('budget.throttle.time.monotonic', lambda: clock[0]), \
+      patch('budget.throttle.time.sleep', side_effect=sleep):
+      for _ in range(3):
+        rate_limiter.acquire()
+    # the first call takes the token left, and each of the others waits two
+    # seconds for the bucket to fill to one token
+    self.assertAlmostEqual(clock[0] - start, 4, places=3)
+
+
+  def test_throttle_cuts_rate_once_per_interval(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(10, decrease_interval=60)
+    for _ in range(3):
+      rate_limiter.record_throttle(throttle.time.monotonic())
+    self.assertEqual(rate_limiter.rate, 5)
+    self.assertEqual(rate_limiter.throttles, 3)
+
+
+  def test_success_raises_rate_up_to_max(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(10)
+    rate_limiter.record_throttle(throttle.time.monotonic())
+    # about one call per second more after a second's worth of calls
+    for _ in range(5):
+      rate_limiter.record_success(0, latency=0.1)
+    self.assertAlmostEqual(rate_limiter.rate, 6, delta=0.1)
+    for _ in range(100):
+      rate_limiter.record_success(0, latency=0.1)
+    self.assertEqual(rate_limiter.rate, 10)
+
+
+  def test_slow_success_holds_rate(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(10, slow_latency=1.0)
+    rate_limiter.record_throttle(throttle.time.monotonic())
+    rate_limiter.record_success(0, latency=1.5)
+    self.assertEqual(rate_limiter.rate, 5)
+
+
+  def test_set_max_rate(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(10)
+    rate_limiter.record_throttle(throttle.time.monotonic())
+    rate_limiter.set_max_rate(10)
+    self.assertEqual(rate_limiter.rate, 5)
+    rate_limiter.set_max_rate(20)
+    self.assertEqual(rate_limiter.rate, 20)
+    self.assertEqual(rate_limiter.max_rate, 20)
+
+
+  def test_botocore_retries_count_as_throttles(self):
+    rate_limiter = throttle.AdaptiveRateLimiter(10)
+    func = MagicMock(return_value={'ResponseMetadata': {'RetryAttempts': 2}})
+    throttle.call_with_backoff(rate_limiter, func)
+    self.assertEqual(rate_limiter.throttles, 1)
+    self.assertEqual(rate_limiter.rate, 5)
+
+
+  def test_adapts_to_throttling_api(self):
+    # the fake throttles callers over 40 calls a second, far below the
+    # rate the limiter starts at
+    budgets_client = FakeBudgetsClient(max_tps=40)
+    rate_limiter = throttle.AdaptiveRateLimiter(400)
+
+    def describe_budgets(_):
+      return throttle.call_with_backoff(
+        rate_limiter,
+        budgets_client.describe_budgets,
+        max_attempts=10,
+        base_delay=0.05,
+        AccountId='012345678901'
+      )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+      pages = list(executor.map(describe_budgets, range(60)))
+
+    self.assertEqual(len(pages), 60)
+    self.assertGreater(rate_limiter.throttles, 0)
+    self.assertLess(rate_limiter.rate, 400)
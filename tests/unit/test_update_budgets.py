@@ -0,0 +1,205 @@
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import boto3
+from botocore.stub import Stubber
+
+from budget import app, clients
+from budget.fingerprints import (
+  FINGERPRINT_INDEX_KEY,
+  FingerprintIndex,
+  get_budget_fingerprint
+)
+from budget.state import FileStore
+
+
+class TestUpdateBudgets(unittest.TestCase):
+
+  def setUp(self):
+    app.configuration = MagicMock()
+    app.configuration.account_id = '012345678901'
+    app.configuration.end_user_role_name = 'ServiceCatalogEndusers'
+    app.configuration.notification_topic_arn = 'arn:aws:sns:us-east-1:012345678901:topic'
+    app.configuration.budget_rules = {
+      'teams': {
+        '12345': {
+          'amount': '100',
+          'period': 'ANNUALLY',
+          'community_manager_emails': ['admin@example.org']
+        },
+        '67890': {
+          'amount': '200',
+          'period': 'ANNUALLY',
+          'community_manager_emails': ['other-admin@example.org']
+        }
+      }
+    }
+    app.configuration.thresholds = {
+      'notify_user_only': [50.0],
+      'notify_admins_too': [100.0]
+    }
+    self.directory = tempfile.TemporaryDirectory()
+    self.fingerprints = FingerprintIndex(FileStore(self.directory.name))
+
+
+  def tearDown(self):
+    app.configuration = None
+    clients.reset()
+    self.directory.cleanup()
+
+
+  def _fingerprint(self, synapse_id, team):
+    return get_budget_fingerprint(*app._get_budget_definitions(synapse_id, team))
+
+
+  def test_find_drifted_budgets_from_index(self):
+    teams_by_user_id = {'3388489': ['12345'], '3406211': ['12345']}
+    self.fingerprints.set('3388489', self._fingerprint('3388489', '12345'))
+    # this user has moved from team 67890 to team 12345
+    self.fingerprints.set('3406211', self._fingerprint('3406211', '67890'))
+    # no API calls are needed when every fingerprint is in the index
+    with patch('budget.app._call_budgets') as call_mock:
+      result = app.find_drifted_budgets(
+        ['3388489', '3406211'],
+        teams_by_user_id,
+        self.fingerprints
+      )
+    self.assertEqual(result, ['3406211'])
+    call_mock.assert_not_called()
+
+
+  def test_find_drifted_budgets_reads_missing_tags(self):
+    teams_by_user_id = {'3388489': ['12345'], '3406211': ['12345']}
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      clients.set_client('budgets', budgets_client)
+      stubber.add_response('list_tags_for_resource', {
+        'ResourceTags': [{
+          'Key': 'lambda-budgets:fingerprint',
+          'Value': self._fingerprint('3388489', '12345')
+        }]
+      }, {
+        'ResourceARN': 'arn:aws:budgets::012345678901:budget/service-catalog_3388489'
+      })
+      # a budget made before budgets were tagged
+      stubber.add_response('list_tags_for_resource', {'ResourceTags': []})
+      result = app.find_drifted_budgets(
+        ['3388489', '3406211'],
+        teams_by_user_id,
+        self.fingerprints,
+        max_workers=1
+      )
+    self.assertEqual(result, ['3406211'])
+    # the tag that was read is kept in the index for the next run
+    self.assertEqual(
+      self.fingerprints.get('3388489'),
+      self._fingerprint('3388489', '12345')
+    )
+
+
+  @patch('budget.app.FINGERPRINT_LOOKUP_BATCH_SIZE', 1)
+  def test_find_drifted_budgets_saves_index_as_tags_are_read(self):
+    teams_by_user_id = {'3388489': ['12345'], '3406211': ['12345']}
+    store = FileStore(self.directory.name)
+    saved = []
+
+    def get_tag(synapse_id):
+      # what an invocation killed at this point would leave for the next one
+      saved.append(store.get(FINGERPRINT_INDEX_KEY))
+      return self._fingerprint(synapse_id, '12345')
+
+    with patch('budget.app._get_budget_fingerprint_tag', get_tag):
+      result = app.find_drifted_budgets(
+        ['3388489', '3406211'],
+        teams_by_user_id,
+        self.fingerprints
+      )
+    self.assertEqual(result, [])
+    self.assertIsNone(saved[0])
+    self.assertEqual(len(saved[1]), 1)
+    self.assertEqual(len(store.get(FINGERPRINT_INDEX_KEY)), 2)
+
+
+  def test_update_budget(self):
+    budget_definition, notification_definitions = app._get_budget_definitions(
+      '3388489', '67890'
+    )
+    budget_name = 'service-catalog_3388489'
+    stale_notification = {
+      'NotificationType': 'ACTUAL',
+      'ComparisonOperator': 'GREATER_THAN',
+      'Threshold': 25.0,
+      'ThresholdType': 'PERCENTAGE'
+    }
+    admin_notification = dict(
+      notification_definitions[1]['Notification'],
+      NotificationState='OK'
+    )
+    budgets_client = boto3.client('budgets')
+    with Stubber(budgets_client) as stubber:
+      clients.set_client('budgets', budgets_client)
+      stubber.add_response('update_budget', {}, {
+        'AccountId': '012345678901',
+        'NewBudget': budget_definition
+      })
+      stubber.add_response('describe_notifications_for_budget', {
+        'Notifications': [stale_notification, admin_notification]
+      })
+      # the 25% notification is no longer wanted
+      stubber.add_response('delete_notification', {}, {
+        'AccountId': '012345678901',
+        'BudgetName': budget_name,
+        'Notification': stale_notification
+      })
+      # the 50% notification is missing
+      stubber.add_response('create_notification', {}, {
+        'AccountId': '012345678901',
+        'BudgetName': budget_name,
+        'Notification': notification_definitions[0]['Notification'],
+        'Subscribers': notification_definitions[0]['Subscribers']
+      })
+      # the 100% notification still goes to the admin of the old team
+      stubber.add_response('describe_subscribers_for_notification', {
+        'Subscribers': [
+          {'SubscriptionType': 'EMAIL', 'Address': 'admin@example.org'},
+          {'SubscriptionType': 'SNS', 'Address': 'arn:aws:sns:us-east-1:012345678901:topic'}
+        ]
+      })
+      stubber.add_response('create_subscriber', {}, {
+        'AccountId': '012345678901',
+        'BudgetName': budget_name,
+        'Notification': admin_notification,
+        'Subscriber': {'SubscriptionType': 'EMAIL', 'Address': 'other-admin@example.org'}
+      })
+      stubber.add_response('delete_subscriber', {}, {
+        'AccountId': '012345678901',
+        'BudgetName': budget_name,
+        'Notification': admin_notification,
+        'Subscriber': {'SubscriptionType': 'EMAIL', 'Address': 'admin@example.org'}
+      })
+      stubber.add_response('tag_resource', {}, {
+        'ResourceARN': f'arn:aws:budgets::012345678901:budget/{budget_name}',
+        'ResourceTags': [{
+          'Key': 'lambda-budgets:fingerprint',
+          'Value': get_budget_fingerprint(budget_definition, notification_definitions)
+        }]
+      })
+      app.update_budget(budget_definition, notification_definitions)
+      stubber.assert_no_pending_responses()
+
+
+  def test_update_budgets_records_fingerprints(self):
+    teams_by_user_id = {'3388489': ['67890']}
+    with patch('budget.app.update_budget') as update_mock:
+      result = app.update_budgets(
+        ['3388489'],
+        teams_by_user_id,
+        fingerprints=self.fingerprints
+      )
+    self.assertEqual(result.succeeded, ['3388489'])
+    update_mock.assert_called_once()
+    self.assertEqual(
+      self.fingerprints.get('3388489'),
+      self._fingerprint('3388489', '67890')
+    )